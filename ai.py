@@ -1,19 +1,25 @@
 import networkx as nx
-import json
-import random
 import math
+import itertools
+import numpy as np
 from operator import itemgetter
+from risk import battle
+from risk.cache import LRUCache
+from risk.zobrist import ZobristKeys
+from risk.decisionlog import LOG, DEBUG
+from risk.metrics import METRICS
 
 PREF = 3
+ATTACK_THRESHOLD = 5
+RISK_DECAY = 0.5
+RISK_DEPTH = 6
+EVAL_CACHE_SIZE = 4096
 
-with open('./risk/attacking_win_probs_50_50.json') as prob_file:
-    PROBS = {tuple(int(i) for i in k.strip('()').split(',')) : v 
-                for k, v in json.load(prob_file).items()}
-
-with open('./risk/expected_troop_loss_50_50.json') as troop_file:
-    TROOP_LOSS = {tuple(int(i) for i in k.strip('()').split(',')) : v 
-                for k, v in json.load(troop_file).items()}
+# ev_attack and country_risk results, keyed by what they depend on; hits and misses are on the app's /metrics
+EVAL_CACHE = LRUCache(EVAL_CACHE_SIZE)
+_graph_seeds = itertools.count()
 
+@METRICS.timed('best_country')
 def best_country(G, board, player):
     """
 
@@ -25,23 +31,26 @@ def best_country(G, board, player):
 
     if unoccupied:
         k = lambda country : position_value(G, country, board, player)
-        # print "Country value map: " + str({c.name : k(c) for c in unoccupied})
+        if LOG.enabled(DEBUG):
+            LOG.debug('country_values', player=player.name, values={c.name : k(c) for c in unoccupied})
         return max(unoccupied, key = k)
     return None
 
-def deploy_troops(G, player, board):
+@METRICS.timed('deploy_troops')
+def deploy_troops(G, player, board, decay=RISK_DECAY):
     """
         The best deployment is such that troops are sent proportionally to those countries with the highest
         risk
 
     :param player:
     :param board:
+    :param decay: see country_risk
     :return:
     """
 
     num_to_deploy = num_troops = player.troops_to_deploy
-    risk = country_risk(G, player, board)
-    print "%s troops to deploy, with a risk schedule of %s" % (num_troops, str(risk))
+    risk = country_risk(G, player, board, decay)
+    LOG.debug('risk_schedule', player=player.name, troops=num_troops, risk=risk)
     tv = sum(v for v in risk.values() if v > 0)
     orders = {}
     for country, val in sorted(risk.items(), key = itemgetter(1), reverse = True):
@@ -53,25 +62,22 @@ def deploy_troops(G, player, board):
     return orders
 
 
-def best_attack(G, player, board):
+@METRICS.timed('best_attack')
+def best_attack(G, player, board, threshold=ATTACK_THRESHOLD):
     """
         The best attack is simply the attack with the highest expected value.
 
     :param player:
     :param board:
+    :param threshold: the expected value the best attack must beat to be made at all
     :return:
     """
-    possible_attacks = [(c1,c2)
-                            for c1 in player.countries
-                            for c2 in c1.border_countries
-                            if c1.troops > 1 
-                            and c2 not in player.countries]
-    if not possible_attacks: return None
-    k = lambda (base, target): ev_attack(G, base, target, player, board)
-    base, target = attack = max(possible_attacks, key = k)
-    if k(attack) > 5:
-        print "%s attacking %s, with an attack estimated value of %s" % (base.name, target.name, k((base, target)))
-        return attack
+    ranked = rank_attacks(G, player, board, 1)
+    if not ranked: return None
+    value, base, target = ranked[0]
+    LOG.debug('attack_ev', player=player.name, base=base.name, target=target.name, value=value, threshold=threshold)
+    if value > threshold:
+        return base, target
     # attacks = sorted(possible_attacks, key=k, reverse = True)
     # while attacks:
     #     base, target = attacks.pop(0)
@@ -84,6 +90,35 @@ def best_attack(G, player, board):
     # if k(attack) > 0: return attack
 
 
+@METRICS.timed('rank_attacks')
+def rank_attacks(G, player, board, k = None):
+    """
+        Scores every possible attack at once and returns (value, base, target) tuples, best first. The value
+        of each attack is the same as ev_attack's, but the battle tables and position values are looked up for
+        the whole frontier in one array pass.
+
+    :param player:
+    :param board:
+    :param k: if given, only the k best attacks are returned
+    :return:
+    """
+    possible_attacks = [(c1,c2)
+                            for c1 in board.ownership.frontier(player)
+                            for c2 in c1.border_countries
+                            if c1.troops > 1
+                            and c2.owner is not None
+                            and c2.owner != player]
+    if not possible_attacks: return []
+    pv = position_values(G)
+    attackers = np.array([base.troops - 1 for base, _ in possible_attacks])
+    defenders = np.array([target.troops for _, target in possible_attacks])
+    positions = np.array([pv[target.name] for _, target in possible_attacks])
+    a_troop_loss, d_troop_loss = battle.expected_losses(attackers, defenders)
+    values = d_troop_loss / a_troop_loss * positions * battle.win_probabilities(attackers, defenders)
+    order = np.argsort(-values, kind='mergesort')[:k]
+    return [(float(values[i]),) + possible_attacks[i] for i in order]
+
+
 def make_graph(board):
     G = nx.Graph()
     for name, country in board.countries.items():
@@ -109,20 +144,29 @@ def bonus_value(board, country, player):
     :param country:
     :param player:
     """
-    continent = board.continent_lookup[country.name]
-    # print "%s countries in %s, of which player has %s" % (len(continent.countries), continent.name, len([c for c in player.countries if c in continent.countries]))
-    unconquered = len(continent.countries) - len([c for c in player.countries if c in continent.countries])
+    continent = board.ownership.continent(country)
+    unconquered = len(continent.countries) - board.ownership.held_in(player, continent)
     if unconquered > 0: return float(continent.bonus) / unconquered
     return 1
 
+def position_values(G):
+    """
+        The position value of every country in G, computed once per graph and kept in G.graph. Both terms are
+        taken over the whole border graph, so they depend on the map alone and stay valid as countries change
+        hands.
+    """
+    if 'position_values' not in G.graph:
+        fort = nx.degree_centrality(G)
+        clustering = nx.clustering(G)
+        G.graph['position_values'] = {name : math.sqrt(clustering[name]) / fort[name] for name in G}
+    return G.graph['position_values']
+
 def position_value(G, country, board, player):
     """
         The position value of a country increases proportionately to its value as a bonus component
         along with the square of its fortifiability value
     """
-    fort = nx.degree_centrality(G)[country.name]
-    clustering = nx.clustering(G, player.countries + [country.name])[country.name]
-    return  math.sqrt(clustering) / fort
+    return position_values(G)[country.name]
 
 def ev_attack(G, base, target, player, board):
     """
@@ -139,77 +183,185 @@ def ev_attack(G, base, target, player, board):
     attackers = base.troops - 1
     if target.owner == base.owner: return 0
     if attackers == 0: return 0
-    prob_win_attacker, (a_troop_loss, d_troop_loss), = get_probs_and_troops(attackers, defenders)
-    ev_target_position = position_value(G, target, board, player) * prob_win_attacker
-    troop_change_ratio = d_troop_loss / a_troop_loss
-    return troop_change_ratio * ev_target_position
+    key = ('ev_attack', zobrist_keys(G).seed, target.name, attackers, defenders)
+    value = EVAL_CACHE.get(key)
+    if value is None:
+        prob_win_attacker, (a_troop_loss, d_troop_loss), = get_probs_and_troops(attackers, defenders)
+        ev_target_position = position_value(G, target, board, player) * prob_win_attacker
+        troop_change_ratio = d_troop_loss / a_troop_loss
+        value = troop_change_ratio * ev_target_position
+        EVAL_CACHE.put(key, value)
+    return value
     # * troop_change_ratio
 
 
-def get_probs_and_troops(attackers, defenders, n = 50):
+def get_probs_and_troops(attackers, defenders):
     """
-        Returns the expected probability of attacker win, and expected troop loss on both sides for a conflaguration
-        of a against d troops.
+        Returns the probability of attacker win, and expected troop loss on both sides for a conflaguration
+        of a against d troops, solved exactly from the dice rules.
 
     :param attackers:
     :param defenders:
-    :param n:
     :return:
     """
-    if attackers > n or defenders > n:
-        m = float(max(attackers, defenders))
-        attackers = max(1, min(n-1, int(round(n * attackers / m))))
-        defenders = min(n-1, max(int(round(n * defenders / m)) , 1))
-    return PROBS[(attackers, defenders)], tuple(TROOP_LOSS[(attackers, defenders)])
+    attacker_loss, defender_loss = battle.expected_losses(attackers, defenders)
+    return float(battle.win_probabilities(attackers, defenders)), (float(attacker_loss), float(defender_loss))
+
+
+def risk_index(G, decay=RISK_DECAY, depth=RISK_DEPTH):
+    """
+        Sparse decay weights between every pair of countries at most `depth` borders apart, computed once per
+        graph and kept in G.graph. Row i of (indptr, indices, weights) lists the countries near country i,
+        each weighted by decay ** distance. Distances are symmetric, so a row doubles as a column.
 
+    :param G:
+    :param decay:
+    :param depth:
+    :return:
+    """
+    key = ('risk_index', decay, depth)
+    if key not in G.graph:
+        names = sorted(G)
+        position = {name : i for i, name in enumerate(names)}
+        indptr, indices, weights = [0], [], []
+        for name in names:
+            distance = {name : 0}
+            frontier = [name]
+            for d in range(1, depth + 1):
+                reached = []
+                for current in frontier:
+                    for neighbor in G.adj[current]:
+                        if neighbor not in distance:
+                            distance[neighbor] = d
+                            reached.append(neighbor)
+                frontier = reached
+            for neighbor, d in distance.items():
+                indices.append(position[neighbor])
+                weights.append(decay ** d)
+            indptr.append(len(indices))
+        neighbors = [[position[n] for n in G.adj[name]] for name in names]
+        G.graph[key] = {'names' : names,
+                        'position' : position,
+                        'borders' : (np.array([i for i, ns in enumerate(neighbors) for _ in ns], dtype=int),
+                                     np.array([j for ns in neighbors for j in ns], dtype=int)),
+                        'indptr' : np.array(indptr, dtype=int),
+                        'rows' : np.repeat(np.arange(len(names)), np.diff(indptr)),
+                        'indices' : np.array(indices, dtype=int),
+                        'weights' : np.array(weights)}
+    return G.graph[key]
+
+
+class RiskMap(object):
+    """
+        The risk of every country from one player's point of view. A country's threat is the enemy troops on
+        its borders, and its risk is the threat on every country within RISK_DEPTH borders of it, its own
+        included, discounted by RISK_DECAY for each border crossed on the shortest way there. The whole map is
+        scored in one sparse pass.
+    """
 
-def country_risk(G, player, board):
+    def __init__(self, G, player, board, decay=RISK_DECAY, depth=RISK_DEPTH):
+        self.index = risk_index(G, decay, depth)
+        self.player = player
+        self.board = board
+        names = self.index['names']
+        self.enemy_troops = np.array([self._enemy_troops(board.countries[name]) for name in names], dtype=float)
+        source, border = self.index['borders']
+        self.threat = np.bincount(source, weights=self.enemy_troops[border], minlength=len(names))
+        self.values = 10e-10 + np.bincount(self.index['rows'],
+                                           weights=self.index['weights'] * self.threat[self.index['indices']],
+                                           minlength=len(names))
+
+    def _enemy_troops(self, country):
+        return country.troops if country.owner != self.player else 0
+
+    def risk(self):
+        """
+            The risk of each of the player's countries, by name.
+        """
+        position = self.index['position']
+        return {c.name : float(self.values[position[c.name]]) for c in self.player.countries}
+
+
+@METRICS.timed('country_risk')
+def country_risk(G, player, board, decay=RISK_DECAY):
     """
-        The risk of a player's countries is the networked troop positions in connected enemy countries
+        The risk of a player's countries is the networked troop positions in connected enemy countries.
+        Results are kept by the board's Zobrist hash, so asking again about an unchanged board is a lookup.
+        The board keeps its hash current as it changes, so finding the key costs nothing after the first call.
 
     :param player:
     :param board:
+    :param decay: the discount on threat for each border crossed
     :return:
     """
-    # G = make_graph(board)
-    def walk(current, visited):
-        val = 10e-10
-        for neighbor in G.neighbors(current):
-            if neighbor not in visited:
-                visited.append(neighbor)
-                val += sum(c.troops for c in board.countries[neighbor].border_countries if c.owner != player) + \
-                0.5 * walk(neighbor, visited)
-        return val
-
-    risk = {}
-    for country in player.countries:
-        visited = []
-        risk[country.name] = walk(country.name, visited)
+    keys = zobrist_keys(G)
+    key = ('country_risk', keys.seed, decay, player.name, board.zobrist_hash(keys))
+    risk = EVAL_CACHE.get(key)
+    if risk is None:
+        risk = RiskMap(G, player, board, decay).risk()
+        EVAL_CACHE.put(key, risk)
     return risk
 
 
+def zobrist_keys(G):
+    """
+        The Zobrist keys for the countries of G, created once per graph and kept in G.graph. Each graph's keys
+        get their own seed, which also tells apart cache entries for different graphs.
+    """
+    if 'zobrist' not in G.graph:
+        G.graph['zobrist'] = ZobristKeys(sorted(G), next(_graph_seeds))
+    return G.graph['zobrist']
+
+
 # def country_risk(G, player, board):
 #     return {c.name : max(10e-10, sum(e.troops for e in c.border_countries if e.owner != player)) for c in player.countries}
 
 
-def reinforce(G, reinforce_countries, player, board):
+@METRICS.timed('reinforce')
+def reinforce(G, player, board, decay=RISK_DECAY):
     """
-        A reinforcemnt is send to the country with the lowest troop to risk ratio from the boardering country with
-        the highest troop to risk ratio.
+        A reinforcement is sent to the country with the lowest troop to risk ratio from the bordering country with
+        the highest troop to risk ratio. Each country's ratio is worked out once.
 
-    :param reinforce_countries:
     :param player:
     :param board:
-    :return:
+    :param decay: see country_risk
+    :return: (origin, destination, troops), or None if the player has no troops to move
+    """
+    risk = country_risk(G, player, board, decay)
+    ratio = dict((country.name, country.troops / risk[country.name]) for country in player.countries)
+    best = None
+    for a in player.countries:
+        if a.troops < 2:
+            continue
+        for b in a.border_countries:
+            if b.name in ratio:
+                gap = ratio[a.name] / ratio[b.name]
+                if best is None or gap > best[0]:
+                    best = gap, a, b
+    if best is None:
+        return None
+    _, a, b = best
+    return a, b, reinforcement_size(a.troops, risk[a.name], b.troops, risk[b.name])
+
+
+def reinforcement_size(source_troops, source_risk, destination_troops, destination_risk):
+    """
+        The troops to move: the fewest, and at least one, for which source_troops - move / source_risk no
+        longer exceeds destination_troops + move / destination_risk, keeping at least one troop behind. That is
+        the first whole number at or above (source_troops - destination_troops) / (1 / source_risk +
+        1 / destination_risk), the point where the two sides meet.
     """
-    risk = country_risk(G, player, board)
-    k = lambda (c1, c2): (float(c1.troops) / risk[c1.name]) / (float(c2.troops) / risk[c2.name])
-    a, b = max(reinforce_countries, key = k)
-    move = 1
-    while (a.troops - move / risk[a.name]) > (b.troops + move / risk[b.name]) and a.troops - move > 1:
+    exceeds = lambda move: source_troops - move / source_risk > destination_troops + move / destination_risk
+    move = max(1, int(math.ceil((source_troops - destination_troops) / (1 / source_risk + 1 / destination_risk))))
+    # the division can land a hair either side of a whole number
+    if move > 1 and not exceeds(move - 1):
+        move -= 1
+    elif exceeds(move):
         move += 1
-    return a, b, move
+    return min(move, max(1, source_troops - 1))
 
+@METRICS.timed('troops_to_move')
 def troops_to_move(G, attacking_country, defending_country, player, board, attacking_troops):
     """
         Calculates how many troops to invade with, given a win. Attempts to equalize troop / risk ratios between
@@ -223,11 +375,11 @@ def troops_to_move(G, attacking_country, defending_country, player, board, attac
     :return:
     """
     t = {}
+    val = ev_attack(G, attacking_country, defending_country, player, board)
     for country in [attacking_country, defending_country]:
         t[country.name] = 10e-10
         for border in country.border_countries:
-            if border not in player.countries:
-                val = ev_attack(G, attacking_country, defending_country, player, board)
+            if border.owner != player:
                 t[country.name] += val
 
     staying, moving = (attacking_country.troops - attacking_troops), 0
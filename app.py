@@ -1,115 +1,159 @@
 import sys
-from flask import Flask, request
+import time
+from flask import Flask, request, abort
 from risk.models import *
+from risk.template import board_template
 import json
-import random
 from ai import *
+from turnplan import PLANS, plan_key, plan_turn, next_attack, end_attacks, planned_reinforcement
+from session import Sessions, ResyncRequired
+from risk.decisionlog import LOG, DEBUG, INFO, WARNING, records
+from risk.metrics import METRICS, PROFILE, PROFILE_ENDPOINT, phase_of, cache_exposition
 
 app = Flask(__name__)
+BOARD = board_template('./risk/board_graph.json')
+SESSIONS = Sessions(BOARD)
 
 def unpack_json(r):
-    board = import_board_data('./risk/board_graph.json')
-    me_data = r['you']
-    game = r['game']
-    me = Player(me_data['name'])
-    me.earned_cards_this_turn = me_data['earned_cards_this_turn']
-    me.is_eliminated = me_data['is_eliminated']
-    me.troops_to_deploy = me_data['troops_to_deploy']
-    me.available_actions = me_data['available_actions']
-    me.countries = [board.countries[c] for c in me_data['countries']]
-    me.cards = [board.cards[c['country_name']] for c in me_data['cards']]
-    players = {n:Player(n) for n in game['players'] if n != me.name}
-    players[me.name] = me
-    players['none'] = None
-    for country_name in game['countries']:
-        board.countries[country_name].owner = players[game['countries'][country_name]['owner']]
-        board.countries[country_name].troops = game['countries'][country_name]['troops']
-    return me, players, board
+    """
+        Returns me, the players by name and the board for a /turn payload, full or delta (see session.py).
+        Raises ResyncRequired when a delta cannot be applied.
+    """
+    return SESSIONS.unpack(r)
 
 @app.route("/status")
 def status():
-    print 'got status check'
+    LOG.debug('status')
     return ''
 
-@app.route("/not_turn")
+@app.route("/not_turn", methods=["GET", "POST"])
 def not_turn():
-    print 'got board'
+    LOG.debug('not_turn')
     return ''
 
+@app.route("/metrics")
+def metrics():
+    caches = {'evaluation': EVAL_CACHE, 'plans': PLANS, 'sessions': SESSIONS.cache}
+    return METRICS.exposition() + cache_exposition(caches), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+@app.route("/profile", methods=["POST"])
+def profile():
+    """
+        Profiles the next /turn request with cProfile; its stats are written to a file in PROFILE.directory,
+        whose name is logged. As it writes files on the bot's host, it is only served when the environment
+        sets PROFILE_ENDPOINT=1, and is a 404 otherwise.
+    """
+    if not PROFILE_ENDPOINT:
+        abort(404)
+    PROFILE.arm()
+    return json.dumps({'armed': True, 'directory': PROFILE.directory})
+
 @app.route('/turn', methods=['POST'])
 def turn():
-    ind = "     "
-    me, players, board = unpack_json(json.loads(request.data))
-    G = make_graph(board)
-    board.continent_lookup = {c_name : cont for cont_name, cont in board.continents.items() for c_name, country in cont.countries.items()}
-    print "Starting turn with the following allocation: \n" + str('\n'.join([ind + c.name + " : " + str(c.troops) for c in me.countries]))
-    print "List of countries with total enemy troops bordering: \n" + str('\n'.join([ind + c.name + " : " + str(sum([e.troops for e in c.border_countries if e.owner != me]))
-                                                                        for c in me.countries]))
-    print me.available_actions
+    return PROFILE.run(answer_turn)
+
+def answer_turn():
+    start = time.time()
+    r = json.loads(request.data)
+    parsed = time.time()
+    try:
+        me, players, board = unpack_json(r)
+    except ResyncRequired as error:
+        LOG.warning('resync', game=r['game'].get('id'), reason=str(error))
+        return json.dumps({'error': 'resync'}), 409
+    unpacked = time.time()
+    phase = phase_of(me.available_actions)
+    with METRICS.request(phase):
+        response = decide(r, me, board)
+    decided = time.time()
+    body = json.dumps(response) if response is not None else ''
+    done = time.time()
+    for stage, began, ended in (('parse', start, parsed), ('unpack_json', parsed, unpacked),
+                                ('decide', unpacked, decided), ('serialize', decided, done), ('total', start, done)):
+        METRICS.observe(phase, stage, 1000 * (ended - began))
+    fields = {'game': r['game'].get('id'), 'version': r['game'].get('version'), 'player': me.name,
+              'actions': me.available_actions, 'response': response, 'ms': round(1000 * (done - start), 2)}
+    if LOG.enabled(DEBUG):
+        fields['request'] = r
+    LOG.log(INFO if response is not None else WARNING, 'turn', **fields)
+    return body
+
+def decide(r, me, board):
+    """
+        The response to a /turn request: the order for the first of the player's available actions, or None
+        if there is none this bot knows.
+    """
+    G = BOARD.graph
+    key = plan_key(r['game'], me)
     if "choose_country" in me.available_actions:
         country_choice = best_country(G, board, me)
-        response = {"action":"choose_country", "data":country_choice.name}
-        print "choose: %s" % country_choice.name
-        return json.dumps(response)
+        return {"action":"choose_country", "data":country_choice.name}
 
     elif "spend_cards" in me.available_actions:
-        combos = itertools.combinations(me.cards,3)
-        potential_sets = [c for c in combos if c[0].is_set_with(c[1],c[2])]
-        trade_in = random.choice(potential_sets)
-        trade_in = [c.country_name for c in trade_in]
-        response = {'action':'spend_cards', 'data':trade_in}
-        print "traded in cards %s" % trade_in
-        return json.dumps(response)
+        trade_in = [c.country_name for c in me.best_card_set(board)]
+        return {'action':'spend_cards', 'data':trade_in}
 
     elif "deploy_troops" in me.available_actions:
         orders = deploy_troops(G, me, board)
-        response = {"action":"deploy_troops", "data":orders}
-        print "deploy orders: %s" % orders
-        return json.dumps(response)
+        if key is not None:
+            plan_turn(BOARD, me, board, key, deploy=orders)
+        return {"action":"deploy_troops", "data":orders}
 
     elif "attack" in me.available_actions:
-        best = best_attack(G, me, board)
+        best = next_attack(BOARD, me, board, key)
         if best is None:
-            response = {"action":"end_attack_phase"}
-            print "I choose not to fight"
-        else:
+            end_attacks(G, me, board, key)
+            return {"action":"end_attack_phase"}
 
-            attacking_country, defending_country = best
-            attacking_troops = min(3, attacking_country.troops-1)
-            moving_troops = troops_to_move(G, attacking_country,defending_country,me, board, attacking_troops)
+        attacking_country, defending_country = best
+        attacking_troops = min(3, attacking_country.troops-1)
+        moving_troops = troops_to_move(G, attacking_country,defending_country,me, board, attacking_troops)
+        if "blitz" in me.available_actions:
+            # fight the battle out in one request; as many troops move in as a lossless roll would leave
             data = {'attacking_country':attacking_country.name,
                     'defending_country':defending_country.name,
-                    'attacking_troops':attacking_troops,
-                    'moving_troops':moving_troops}
-            response = {'action':'attack', 'data':data}
-            print "attacking %s, which has %s troops,  from %s with %s troops, with an occupying force of %s" \
-                                                        % (defending_country.name,
-                                                            defending_country.troops,
-                                                           attacking_country.name,
-                                                           attacking_troops,
-                                                           moving_troops)
-        return json.dumps(response)
+                    'stop_at':1,
+                    'moving_troops':attacking_troops + moving_troops}
+            return {'action':'blitz', 'data':data}
+        data = {'attacking_country':attacking_country.name,
+                'defending_country':defending_country.name,
+                'attacking_troops':attacking_troops,
+                'moving_troops':moving_troops}
+        return {'action':'attack', 'data':data}
 
     elif "reinforce" in me.available_actions:
-        reinforce_countries = [(c1,c2) for c1 in me.countries
-                                for c2 in c1.border_countries
-                                if c1.troops > 1
-                                and c2 in me.countries]
-
-        if not reinforce_countries:
-            print "ended turn"
-            response = {"action":"end_turn"}
-            return json.dumps(response)
-        origin_country, destination_country, moving_troops = reinforce(G, reinforce_countries, me, board)
-        print "reinforced %s from %s with %s troops" % (destination_country.name, origin_country.name, moving_troops)
-        response = {'action':'reinforce', 'data':{'origin_country':origin_country.name,
-                                                  'destination_country':destination_country.name,
-                                                  'moving_troops':moving_troops}}
-        return json.dumps(response)
-
-    print "something broke"
-    return ''
+        reinforcement = planned_reinforcement(G, me, board, key)
+        if reinforcement is None:
+            return {"action":"end_turn"}
+        origin_country, destination_country, moving_troops = reinforcement
+        return {'action':'reinforce', 'data':{'origin_country':origin_country.name,
+                                              'destination_country':destination_country.name,
+                                              'moving_troops':moving_troops}}
+
+    return None
+
+def replay(path):
+    """
+        Replays the /turn requests kept in a decision log written at debug level, in order, and yields each
+        logged record with the response given now. Randomized choices aside, the responses should match.
+
+    :param path:
+    :return:
+    """
+    client = app.test_client()
+    for record in records(path, 'turn'):
+        if 'request' not in record:
+            continue
+        response = client.post('/turn', data=json.dumps(record['request']))
+        yield record, json.loads(response.data) if response.data else None
 
 if __name__ == '__main__':
-    port = int(sys.argv[1])
-    app.run(debug=True, host="0.0.0.0", port=port)
+    if sys.argv[1] == 'replay':
+        # python app.py replay <decision log>: prints the turns whose response has changed
+        for record, response in replay(sys.argv[2]):
+            if response != record['response']:
+                print json.dumps({'game': record['game'], 'version': record['version'], 'player': record['player'],
+                                  'logged': record['response'], 'now': response})
+    else:
+        port = int(sys.argv[1])
+        app.run(debug=True, host="0.0.0.0", port=port)
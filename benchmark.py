@@ -0,0 +1,399 @@
+"""
+    A benchmark of the /turn decision pipeline on recorded request bodies.
+
+        python benchmark.py                    run the corpus and the synthetic boards, compare with the baseline
+        python benchmark.py --save-baseline    the same, then keep the results as the new baseline
+        python benchmark.py --check            exit non-zero if anything regressed
+        python benchmark.py --record           record a new corpus from seeded self-play
+
+    The corpus, benchmarks/corpus.jsonl.gz, holds /turn request bodies from games on the classic map, each
+    labelled with the stage of the game it comes from (early, mid or late) and its phase. There is no early
+    spend_cards: a set takes three cards, a player earns at most one a turn, so the first trade-in is offered in
+    their fourth turn, which is already mid. A decision log written at debug level can be used in its place
+    with --corpus, as it keeps every request. The synthetic cases are random positions on maps of
+    SYNTHETIC_SIZES countries from risk.mapcompiler.generate_map.
+
+    Each body is taken REPEATS times through the stages app.turn runs: parse, unpack_json, decide and
+    serialize. decide is the ai.py strategy for the phase without the attack planner, whose running time is its
+    budget; deploy and attack are timed as ai.deploy_troops and ai.best_attack with troops_to_move. The
+    evaluation cache is cleared before every run, so each request is timed as a board seen for the first time.
+
+    For every (case, phase, stage) the p50 and p99 latency are reported along with the gc growth per run: the
+    net change in gc-tracked objects with collection off, that is container objects created less those freed.
+    It is not an allocation count, as Python 2 has no tracemalloc, but a stage that starts keeping more
+    objects alive shows up in it.
+    Results are compared with benchmarks/baseline.json. As that may have been saved on a faster or slower
+    machine, and a machine's speed drifts within a run, every phase of every case also times a fixed piece of
+    pure Python work, the calibration, next to its requests. A baseline p50 is scaled by the ratio of this
+    run's calibration to the one saved with it before comparing: a p50 more than TOLERANCE slower than the
+    scaled baseline's, and by more than MIN_REGRESSION_MS, is a regression.
+"""
+import gc
+import sys
+import json
+import gzip
+import time
+import random
+import argparse
+from timeit import default_timer
+from ai import EVAL_CACHE, best_country, deploy_troops, best_attack, troops_to_move
+from policies import HeuristicPolicy
+from session import Sessions
+from turnplan import choose_reinforcement
+from risk.game import Game, RandomPolicy
+from risk.host import turn_payload
+from risk.metrics import PHASES, phase_of
+from risk.mapcompiler import compile_map, generate_map
+from risk.template import BoardTemplate, board_template
+from risk.decisionlog import records
+
+BOARD_PATH = './risk/board_graph.json'
+CORPUS_PATH = './benchmarks/corpus.jsonl.gz'
+BASELINE_PATH = './benchmarks/baseline.json'
+STAGES = ('parse', 'unpack_json', 'decide', 'serialize', 'total')
+GAME_STAGES = ('early', 'mid', 'late')
+REPEATS = 5
+SYNTHETIC_SIZES = (200, 1000)
+SYNTHETIC_POSITIONS = 4
+CORPUS_PER_BUCKET = 5
+TOLERANCE = 0.25
+MIN_REGRESSION_MS = 0.05
+CALIBRATION_ROUNDS = 9
+
+
+def game_stage(game, phase):
+    """
+        early, mid or late: how far through the claims a country choice is made, or otherwise how many rounds
+        have been played, up to 2 for early and 15 for mid.
+    """
+    if phase == 'choose_country':
+        claimed = sum(1 for country in game.board.countries.values() if country.owner is not None)
+        return GAME_STAGES[min(2, 3 * claimed // len(game.board.countries))]
+    rounds = game.turns // len(game.players)
+    return 'early' if rounds <= 2 else 'mid' if rounds <= 15 else 'late'
+
+
+class RecordingPolicy(object):
+    """
+        Plays policy, keeping the /turn body the app would have been sent before each order, labelled with its
+        stage and phase, in bodies.
+    """
+
+    def __init__(self, policy, bodies):
+        self.policy = policy
+        self.bodies = bodies
+
+    def record(self, game, player, actions):
+        self.bodies.append({'stage': game_stage(game, actions[0]), 'phase': actions[0],
+                            'body': json.dumps(turn_payload(game, player, actions), separators=(',', ':'))})
+
+    def choose_country(self, game, player):
+        self.record(game, player, ['choose_country'])
+        return self.policy.choose_country(game, player)
+
+    def spend_cards(self, game, player, force):
+        self.record(game, player, ['spend_cards'] if force else ['spend_cards', 'deploy_troops'])
+        return self.policy.spend_cards(game, player, force)
+
+    def deploy_troops(self, game, player):
+        self.record(game, player, ['deploy_troops'])
+        return self.policy.deploy_troops(game, player)
+
+    def attack(self, game, player):
+        self.record(game, player, ['attack'])
+        return self.policy.attack(game, player)
+
+    def reinforce(self, game, player):
+        self.record(game, player, ['reinforce'])
+        return self.policy.reinforce(game, player)
+
+
+def record_corpus(path=CORPUS_PATH, per_bucket=CORPUS_PER_BUCKET, seed=0, max_games=20):
+    """
+        Plays seeded games between a heuristic player and two random ones until every (stage, phase) has
+        per_bucket bodies, or max_games have been played, and writes per_bucket of each, evenly spread over what
+        was seen, to path.
+
+    :param path:
+    :param per_bucket:
+    :param seed:
+    :param max_games:
+    :return: the number of bodies written
+    """
+    template = board_template(BOARD_PATH)
+    buckets = dict(((stage, phase), []) for stage in GAME_STAGES for phase in PHASES)
+    for game_seed in range(seed, seed + max_games):
+        bodies = []
+        policies = {'heuristic': RecordingPolicy(HeuristicPolicy(), bodies),
+                    'random1': RecordingPolicy(RandomPolicy(), bodies),
+                    'random2': RecordingPolicy(RandomPolicy(), bodies)}
+        Game(template, policies, game_seed, max_turns=300).play()
+        for body in bodies:
+            buckets[(body['stage'], body['phase'])].append(body)
+        if all(len(bucket) >= per_bucket * 10 for bucket in buckets.values()):
+            break
+    chosen = []
+    for key in sorted(buckets):
+        bucket = buckets[key]
+        step = max(1, len(bucket) // per_bucket)
+        chosen.extend(bucket[::step][:per_bucket])
+    out = gzip.open(path, 'wb')
+    try:
+        for body in chosen:
+            out.write(json.dumps(body, separators=(',', ':')) + '\n')
+    finally:
+        out.close()
+    return len(chosen)
+
+
+def load_corpus(path):
+    """
+        The bodies of a corpus file, gzipped or not, or of a decision log's turn records that kept their request.
+    """
+    if path.endswith('.gz'):
+        with gzip.open(path, 'rb') as f:
+            return [json.loads(line) for line in f if line.strip()]
+    bodies = []
+    for record in records(path):
+        if 'body' in record:
+            bodies.append(record)
+        elif record.get('ev') == 'turn' and 'request' in record:
+            bodies.append({'stage': 'log', 'phase': phase_of(record['request']['you']['available_actions']),
+                           'body': json.dumps(record['request'])})
+    return bodies
+
+
+def synthetic_template(countries, seed=0):
+    """
+        The template of a map generated by risk.mapcompiler with `countries` countries.
+    """
+    return BoardTemplate(compile_map(generate_map(countries, seed)))
+
+
+def synthetic_bodies(template, positions=SYNTHETIC_POSITIONS, seed=0):
+    """
+        Random positions on template for every phase: half the map claimed for choose_country, otherwise all of
+        it, split between three players with 1 to 12 troops a country.
+    """
+    rng = random.Random(seed)
+    players = ['me', 'p2', 'p3']
+    bodies = []
+    for phase in PHASES:
+        for _ in range(positions):
+            owned = 0.5 if phase == 'choose_country' else 1.0
+            countries = {}
+            for name in template.country_names:
+                if rng.random() < owned:
+                    countries[name] = {'owner': rng.choice(players), 'troops': rng.randint(1, 12)}
+                else:
+                    countries[name] = {'owner': 'none', 'troops': 0}
+            cards = rng.sample(sorted(template.cards), 5) if phase == 'spend_cards' else []
+            you = {'name': 'me', 'earned_cards_this_turn': False, 'is_eliminated': False, 'troops_to_deploy': 10,
+                   'available_actions': [phase],
+                   'countries': sorted(name for name, c in countries.items() if c['owner'] == 'me'),
+                   'cards': [{'country_name': name} for name in cards]}
+            bodies.append({'stage': 'synthetic', 'phase': phase,
+                           'body': json.dumps({'you': you, 'game': {'players': players, 'countries': countries}})})
+    return bodies
+
+
+def decide(G, me, board):
+    """
+        The response app.turn would give, by the ai.py strategies alone (see the module docstring).
+    """
+    actions = me.available_actions
+    if 'choose_country' in actions:
+        return {'action': 'choose_country', 'data': best_country(G, board, me).name}
+    if 'spend_cards' in actions:
+        return {'action': 'spend_cards', 'data': [card.country_name for card in me.best_card_set(board)]}
+    if 'deploy_troops' in actions:
+        return {'action': 'deploy_troops', 'data': deploy_troops(G, me, board)}
+    if 'attack' in actions:
+        best = best_attack(G, me, board)
+        if best is None:
+            return {'action': 'end_attack_phase'}
+        base, target = best
+        attacking_troops = min(3, base.troops - 1)
+        return {'action': 'attack', 'data': {'attacking_country': base.name, 'defending_country': target.name,
+                                             'attacking_troops': attacking_troops,
+                                             'moving_troops': troops_to_move(G, base, target, me, board,
+                                                                             attacking_troops)}}
+    reinforcement = choose_reinforcement(G, me, board)
+    if reinforcement is None:
+        return {'action': 'end_turn'}
+    origin, destination, troops = reinforcement
+    return {'action': 'reinforce', 'data': {'origin_country': origin.name, 'destination_country': destination.name,
+                                            'moving_troops': troops}}
+
+
+def measure(template, body, samples, gc_growth):
+    """
+        Runs one body through every stage once, adding each stage's seconds to samples[stage] and its net
+        growth in gc-tracked objects to gc_growth[stage].
+    """
+    sessions = Sessions(template)
+    EVAL_CACHE.clear()
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        marks = [(default_timer(), gc.get_count()[0])]
+        r = json.loads(body)
+        r['game'].pop('id', None)
+        marks.append((default_timer(), gc.get_count()[0]))
+        me, _, board = sessions.unpack(r)
+        marks.append((default_timer(), gc.get_count()[0]))
+        response = decide(template.graph, me, board)
+        marks.append((default_timer(), gc.get_count()[0]))
+        json.dumps(response)
+        marks.append((default_timer(), gc.get_count()[0]))
+    finally:
+        if enabled:
+            gc.enable()
+    for stage, (start, start_count), (end, end_count) in zip(STAGES, marks, marks[1:]) + \
+            [('total', marks[0], marks[-1])]:
+        samples.setdefault(stage, []).append(end - start)
+        gc_growth.setdefault(stage, []).append(end_count - start_count)
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def run_case(template, bodies, repeats=REPEATS):
+    """
+        Results for one case, {(phase, stage): {'n', 'p50', 'p99' in milliseconds, 'gc_growth',
+        'calibration_ms'}}, the calibration taken before and after the phase's requests.
+    """
+    by_phase = {}
+    for body in bodies:
+        by_phase.setdefault(body['phase'], []).append(body['body'])
+    results = {}
+    for phase, phase_bodies in sorted(by_phase.items()):
+        samples, gc_growth = {}, {}
+        # once untimed, so what is built once per map, like the risk index, is not counted against a request
+        measure(template, phase_bodies[0], {}, {})
+        calibrations = [calibrate()]
+        for _ in range(repeats):
+            for body in phase_bodies:
+                measure(template, body, samples, gc_growth)
+        calibrations.append(calibrate())
+        for stage in STAGES:
+            results[(phase, stage)] = {'n': len(samples[stage]),
+                                       'p50': 1000 * percentile(samples[stage], 0.5),
+                                       'p99': 1000 * percentile(samples[stage], 0.99),
+                                       'gc_growth': float(sum(gc_growth[stage])) / len(gc_growth[stage]),
+                                       'calibration_ms': sum(calibrations) / len(calibrations)}
+    return results
+
+
+def run(corpus_path=CORPUS_PATH, synthetic_sizes=SYNTHETIC_SIZES, repeats=REPEATS):
+    """
+        Results for every case, keyed by 'case/phase/stage'. The corpus is one case per game stage.
+    """
+    results = {}
+    classic = board_template(BOARD_PATH)
+    bodies = load_corpus(corpus_path)
+    for stage in sorted(set(body['stage'] for body in bodies)):
+        case = [body for body in bodies if body['stage'] == stage]
+        for (phase, step), result in run_case(classic, case, repeats).items():
+            results['%s/%s/%s' % (stage, phase, step)] = result
+    for size in synthetic_sizes:
+        template = synthetic_template(size)
+        for (phase, step), result in run_case(template, synthetic_bodies(template), repeats).items():
+            results['synthetic%d/%s/%s' % (size, phase, step)] = result
+    return results
+
+
+def calibrate(rounds=CALIBRATION_ROUNDS):
+    """
+        Milliseconds this machine takes for a fixed piece of pure Python work much like a request's, json and
+        dicts of countries, the median of `rounds` runs with gc off. It does not touch the code being
+        benchmarked, so it only changes with the machine and the interpreter.
+    """
+    rng = random.Random(0)
+    countries = dict(('c%d' % i, {'owner': rng.choice(['me', 'p2', 'p3']), 'troops': rng.randint(1, 12)})
+                     for i in range(1000))
+    timings = []
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(rounds):
+            start = default_timer()
+            totals = {}
+            for name, country in json.loads(json.dumps(countries)).items():
+                totals[country['owner']] = totals.get(country['owner'], 0) + country['troops']
+            sorted(countries, key=lambda name: (countries[name]['troops'], name))
+            timings.append(default_timer() - start)
+    finally:
+        if enabled:
+            gc.enable()
+    return 1000 * percentile(timings, 0.5)
+
+
+def scaled(results, baseline):
+    """
+        baseline with each result's latencies scaled to the machine as results found it: multiplied by the
+        ratio of the result's calibration to the baseline's.
+    """
+    scaled_baseline = {}
+    for key, result in baseline.items():
+        if key in results:
+            factor = results[key]['calibration_ms'] / result['calibration_ms']
+            result = dict(result, p50=result['p50'] * factor, p99=result['p99'] * factor)
+        scaled_baseline[key] = result
+    return scaled_baseline
+
+
+def compare(results, baseline):
+    """
+        The keys of results whose p50 regressed against the (scaled) baseline, as the module docstring defines it.
+    """
+    return sorted(key for key, result in results.items() if key in baseline
+                  and result['p50'] > baseline[key]['p50'] * (1 + TOLERANCE) + MIN_REGRESSION_MS)
+
+
+def report(results, baseline, regressions):
+    print '%-44s %5s %9s %9s %10s %9s' % ('case/phase/stage', 'n', 'p50 ms', 'p99 ms', 'gc growth', 'vs base')
+    for key in sorted(results, key=lambda k: (k.split('/')[:2], STAGES.index(k.split('/')[2]))):
+        result = results[key]
+        change = ''
+        if key in baseline and baseline[key]['p50']:
+            change = '%+.0f%%' % (100 * (result['p50'] / baseline[key]['p50'] - 1))
+        print '%-44s %5d %9.3f %9.3f %10.0f %9s%s' % (key, result['n'], result['p50'], result['p99'],
+                                                       result['gc_growth'], change,
+                                                       '  REGRESSED' if key in regressions else '')
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark the /turn decision pipeline.')
+    parser.add_argument('--corpus', default=CORPUS_PATH)
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--repeats', type=int, default=REPEATS)
+    parser.add_argument('--synthetic', type=int, nargs='*', default=list(SYNTHETIC_SIZES),
+                        help='sizes of the synthetic maps')
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--check', action='store_true', help='exit with status 1 on a regression')
+    parser.add_argument('--record', action='store_true', help='record a new corpus to --corpus and exit')
+    args = parser.parse_args(argv)
+    if args.record:
+        print 'recorded %d bodies to %s' % (record_corpus(args.corpus), args.corpus)
+        return 0
+    start = time.time()
+    results = run(args.corpus, args.synthetic, args.repeats)
+    try:
+        with open(args.baseline) as f:
+            baseline = scaled(results, json.load(f))
+    except IOError:
+        baseline = {}
+    regressions = compare(results, baseline)
+    report(results, baseline, regressions)
+    print '%d results in %.1fs, %d regressed' % (len(results), time.time() - start, len(regressions))
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True, separators=(',', ': '))
+    return 1 if args.check and regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
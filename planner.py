@@ -0,0 +1,210 @@
+"""
+    An anytime attack planner: Monte Carlo tree search over sequences of attacks within a time budget.
+
+    Each iteration replays a path of attacks from the current position on one CompactState, sampling every
+    battle's result from its exact outcome distribution, scores the position it reaches and takes the moves
+    back with a MoveLog. The tree is open loop: nodes are keyed by the attacks chosen, and the dice are drawn
+    fresh on every pass, so a node's value averages over the battles' outcomes. When the deadline passes, the
+    most visited first attack is returned, or None if ending the attack phase looks best.
+"""
+import time
+import math
+import random
+import numpy as np
+from ai import position_values
+from risk import battle
+from risk.moves import MoveLog
+from risk.state import compact_map, CompactState, NO_OWNER
+from risk.metrics import METRICS
+
+ATTACK_BUDGET = 0.2
+MAX_BRANCHING = 6
+MAX_DEPTH = 6
+EXPLORATION = 1.0
+HORIZON = 3
+STOP = None
+
+_position_arrays = {}
+
+
+class Node(object):
+    __slots__ = ('visits', 'total', 'children')
+
+    def __init__(self):
+        self.visits = 0
+        self.total = 0.0
+        self.children = {}
+
+
+def evaluate(state, player):
+    """
+        The value of a position to a player, in troops: their reinforcements over the next HORIZON turns,
+        counting countries smoothly rather than in steps of three, plus their troops on the board, less all
+        enemy troops on the board.
+
+    :param state:
+    :param player:
+    :return:
+    """
+    mine = state.owner == player
+    enemies = (state.owner != player) & (state.owner != NO_OWNER)
+    income = np.count_nonzero(mine) / 3.0 + state.map.continent_bonus[state.continents_held(player)].sum()
+    return HORIZON * income + state.troops[mine].sum() - state.troops[enemies].sum()
+
+
+def candidate_attacks(state, player, values):
+    """
+        The MAX_BRANCHING most promising attacks for the player, scored the way ai.rank_attacks scores them,
+        as (base, target) pairs.
+
+    :param state:
+    :param player:
+    :param values: position value of each country, by id
+    :return:
+    """
+    bases, targets = state.frontier(player)
+    able = (state.troops[bases] > 1) & (state.owner[targets] != NO_OWNER)
+    bases, targets = bases[able], targets[able]
+    if not len(bases):
+        return []
+    attackers, defenders = state.troops[bases] - 1, state.troops[targets]
+    attacker_loss, defender_loss = battle.expected_losses(attackers, defenders)
+    scores = defender_loss / attacker_loss * values[targets] * battle.win_probabilities(attackers, defenders)
+    best = np.argsort(-scores, kind='mergesort')[:MAX_BRANCHING]
+    return [(int(bases[i]), int(targets[i])) for i in best]
+
+
+def play_attack(log, base, target, rng):
+    """
+        Fights a whole battle from base into target with every troop that can attack. On a win, half of the
+        surviving attackers (rounded up) move in.
+    """
+    state = log.state
+    attackers = int(state.troops[base]) - 1
+    attacker_loss, defender_loss = battle.sample_battle(attackers, int(state.troops[target]), rng)
+    survivors = attackers - attacker_loss
+    log.attack(base, target, attacker_loss, defender_loss, (survivors + 1) // 2)
+
+
+def search(state, player, values, deadline, rng):
+    """
+        Runs the tree search on state until the deadline and returns the root node.
+
+    :param state:
+    :param player:
+    :param values:
+    :param deadline:
+    :param rng:
+    :return:
+    """
+    log = MoveLog(state)
+    root = Node()
+    low, high = float('inf'), float('-inf')
+    while True:
+        node, path = root, [root]
+        for depth in range(MAX_DEPTH + 1):
+            actions = [STOP] + (candidate_attacks(state, player, values) if depth < MAX_DEPTH else [])
+            untried = [a for a in actions if a not in node.children]
+            if untried:
+                action = untried[0]
+                node.children[action] = Node()
+            else:
+                scale = max(high - low, 1e-9)
+                log_visits = math.log(node.visits)
+                action = max(actions, key=lambda a: (node.children[a].total / node.children[a].visits - low) / scale
+                             + EXPLORATION * math.sqrt(log_visits / node.children[a].visits))
+            node = node.children[action]
+            path.append(node)
+            if action is STOP:
+                break
+            play_attack(log, action[0], action[1], rng)
+            if untried:
+                break
+        value = float(evaluate(state, player))
+        log.unmake_to(0)
+        low, high = min(low, value), max(high, value)
+        for n in path:
+            n.visits += 1
+            n.total += value
+        if time.time() >= deadline:
+            return root
+
+
+def principal_variation(root):
+    """
+        The line of play the search prefers: from the root, the most visited child at each node, until ending
+        the attack phase or an unexpanded node. Returns the attacks along it as (base, target) ids, and whether
+        the line ends by ending the attack phase rather than where the tree runs out.
+
+    :param root:
+    :return:
+    """
+    line, node = [], root
+    while node.children:
+        action = max(node.children, key=lambda a: node.children[a].visits)
+        if action is STOP:
+            return line, True
+        line.append(action)
+        node = node.children[action]
+    return line, False
+
+
+@METRICS.timed('plan_attacks')
+def plan_attacks(template, player, board, budget=ATTACK_BUDGET, rng=None, deploy=None):
+    """
+        The attacks to make this turn, in order, as (base, target) pairs of country names, and whether the
+        attack phase should end after them; no attacks means ending it now. deploy, if given, maps country
+        names to troops the player is about to deploy, and the attacks are planned for the board after it.
+        Returns within roughly `budget` seconds.
+
+    :param template: the BoardTemplate board was made from
+    :param player:
+    :param board:
+    :param budget:
+    :param rng:
+    :param deploy:
+    :return:
+    """
+    deadline = time.time() + budget
+    cmap = compact_map(template)
+    others = sorted(set(owner.name for owner in board.ownership.owners()) - set([player.name]))
+    state = CompactState.from_board(cmap, board, [player.name] + others)
+    for name, troops in (deploy or {}).items():
+        state.troops[cmap.index[name]] += int(troops)
+    values = position_array(template)
+    if not candidate_attacks(state, 0, values):
+        return [], True
+    line, finished = principal_variation(search(state, 0, values, deadline, rng or random.Random()))
+    return [(cmap.names[base], cmap.names[target]) for base, target in line], finished
+
+
+def plan_attack(template, player, board, budget=ATTACK_BUDGET, rng=None):
+    """
+        The attack to make next, as a (base, target) pair of board countries, or None to end the attack phase.
+        Returns within roughly `budget` seconds.
+
+    :param template: the BoardTemplate board was made from
+    :param player:
+    :param board:
+    :param budget:
+    :param rng:
+    :return:
+    """
+    attacks, _ = plan_attacks(template, player, board, budget, rng)
+    if not attacks:
+        return None
+    base, target = attacks[0]
+    return board.countries[base], board.countries[target]
+
+
+def position_array(template):
+    """
+        ai.position_values for the template's map as an array indexed by country id.
+
+    :param template:
+    :return:
+    """
+    if template not in _position_arrays:
+        pv = position_values(template.graph)
+        _position_arrays[template] = np.array([pv[name] for name in compact_map(template).names])
+    return _position_arrays[template]
@@ -0,0 +1,64 @@
+"""
+    In-process policies for risk.game that play the same way app.turn does over HTTP.
+"""
+from ai import best_country, deploy_troops, best_attack, troops_to_move, reinforce, ATTACK_THRESHOLD, RISK_DECAY
+from planner import plan_attack, ATTACK_BUDGET
+from risk.game import Blitz
+
+
+class HeuristicPolicy(object):
+    """
+        Plays the ai.py heuristics: the same decisions app.turn makes for each available action, with the
+        attack threshold and risk decay as given. With blitz, each chosen attack is fought to the end in one
+        order instead of one roll at a time.
+    """
+
+    def __init__(self, threshold=ATTACK_THRESHOLD, decay=RISK_DECAY, blitz=False):
+        self.threshold = threshold
+        self.decay = decay
+        self.blitz = blitz
+
+    def choose_country(self, game, player):
+        return best_country(game.graph, game.board, player)
+
+    def spend_cards(self, game, player, force):
+        return player.best_card_set(game.board)
+
+    def deploy_troops(self, game, player):
+        orders = deploy_troops(game.graph, player, game.board, self.decay)
+        return {game.board.countries[name]: int(troops) for name, troops in orders.items()}
+
+    def attack(self, game, player):
+        best = best_attack(game.graph, player, game.board, self.threshold)
+        if best is None:
+            return None
+        return self.attack_order(game, player, *best)
+
+    def attack_order(self, game, player, attacking_country, defending_country):
+        attacking_troops = min(3, attacking_country.troops - 1)
+        moving_troops = troops_to_move(game.graph, attacking_country, defending_country, player, game.board,
+                                       attacking_troops)
+        if self.blitz:
+            # as many troops as a single roll would move in if it won without losses
+            return Blitz(attacking_country, defending_country, 1, attacking_troops + moving_troops)
+        return attacking_country, defending_country, attacking_troops, moving_troops
+
+    def reinforce(self, game, player):
+        return reinforce(game.graph, player, game.board, self.decay)
+
+
+class PlannerPolicy(HeuristicPolicy):
+    """
+        The heuristics, with attacks chosen by the tree search planner as app.turn does, given `budget`
+        seconds per attack.
+    """
+
+    def __init__(self, budget=ATTACK_BUDGET, decay=RISK_DECAY, blitz=False):
+        super(PlannerPolicy, self).__init__(decay=decay, blitz=blitz)
+        self.budget = budget
+
+    def attack(self, game, player):
+        best = plan_attack(game.template, player, game.board, self.budget, game.random)
+        if best is None:
+            return None
+        return self.attack_order(game, player, *best)
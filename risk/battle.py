@@ -0,0 +1,515 @@
+"""
+    Exact battle outcomes for the dice rules used in Country.attack.
+
+    A battle is a run of rolls between `attackers` troops able to attack and `defenders` troops, fought until
+    one side has no troops left. The attacker rolls min(3, attackers) dice, the defender min(2, defenders),
+    the highest dice are compared pairwise and ties go to the defender.
+
+    Outcomes for every (attackers, defenders) pair up to the largest one asked for are solved together in one
+    dynamic programming pass over the anti-diagonals of the matchup grid, and kept for the life of the process.
+    A precompiled copy of the tables ships in battle_tables.npy and is memory mapped on first use, so workers
+    neither parse nor solve anything at startup and share the pages through the OS cache. Regenerate it with
+
+        python -m risk.battle [size]
+
+    The tables stop growing at MAX_TABLE_SIZE a side, as their size is quadratic. A battle with more troops on
+    either side is solved on its own: while both sides roll full dice, every roll takes exactly two troops, so
+    the battle is a one dimensional walk in the attacker's losses. The walk is followed until it leaves that
+    bulk, and where it leaves is finished with the strips of the grid along its edges, where one side rolls
+    fewer dice, solved once and kept. Parts of the walk that reach the tables, or whose battle is decided, are
+    finished there and then. That keeps the rest away from the edges, so it is mostly followed many rolls at a
+    time, with the walk over 2 ** j rolls worked out once for each j.
+"""
+import os
+import sys
+import bisect
+import random
+import itertools
+import numpy as np
+
+TABLE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'battle_tables.npy')
+TABLE_SIZE = 100
+DICE = [(a, d) for a in (1, 2, 3) for d in (1, 2)]
+
+_roll_outcomes = {}
+_tables = None
+_distributions = {}
+_cumulative_distributions = {}
+_edges = None
+_large_battles = {}
+_bulk_kernels = []
+MAX_CACHED_DISTRIBUTIONS = 4096
+MAX_SAMPLED_GRID = 2500
+MAX_TABLE_SIZE = 512
+DECIDED_SPREAD = 10
+DECIDED_MARGIN = 64
+# walk probabilities below this are dropped, which changes no result by more than rounding does
+NEGLIGIBLE = 1e-20
+
+
+def roll_outcomes(attacking_die, defending_die):
+    """
+        Enumerates every roll of the given dice and returns the distinct (attacker loss, defender loss)
+        results with their probabilities. Enumerated on first use only, as nothing needs them when the
+        precompiled tables cover the battle.
+
+    :param attacking_die:
+    :param defending_die:
+    :return:
+    """
+    if (attacking_die, defending_die) in _roll_outcomes:
+        return _roll_outcomes[(attacking_die, defending_die)]
+    counts = {}
+    rolls = list(itertools.product(range(1, 7), repeat=attacking_die + defending_die))
+    for roll in rolls:
+        attacking_rolls = sorted(roll[:attacking_die], reverse=True)
+        defending_rolls = sorted(roll[attacking_die:], reverse=True)
+        attacker_loss, defender_loss = 0, 0
+        for i in range(min(attacking_die, defending_die)):
+            if attacking_rolls[i] > defending_rolls[i]:
+                defender_loss += 1
+            else:
+                attacker_loss += 1
+        counts[(attacker_loss, defender_loss)] = counts.get((attacker_loss, defender_loss), 0) + 1
+    outcomes = sorted((losses, float(n) / len(rolls)) for losses, n in counts.items())
+    _roll_outcomes[(attacking_die, defending_die)] = outcomes
+    return outcomes
+
+
+def _diagonals(max_attackers, max_defenders):
+    """
+        Yields, for each anti-diagonal a + d = s of the grid in increasing order, the attacker and defender
+        counts of its cells split by the dice each side rolls.
+    """
+    for s in range(2, max_attackers + max_defenders + 1):
+        a = np.arange(max(1, s - max_defenders), min(max_attackers, s - 1) + 1)
+        d = s - a
+        attacking_die = np.minimum(a, 3)
+        defending_die = np.minimum(d, 2)
+        groups = []
+        for dice in DICE:
+            mask = (attacking_die == dice[0]) & (defending_die == dice[1])
+            if mask.any():
+                groups.append((a[mask], d[mask], roll_outcomes(*dice)))
+        yield groups
+
+
+def _solve(n):
+    """
+        Solves the win probability and expected losses on both sides for every matchup up to n against n.
+
+        The tables are solved in a skewed layout where row s holds the anti-diagonal a + d = s, indexed by a.
+        Every cell a roll can reach from a diagonal then lies in a contiguous run of an earlier row, so the bulk
+        of each diagonal, where both sides roll full dice, is solved with plain slices. Only the few cells next
+        to the edges, where fewer dice are rolled, are solved one at a time.
+    """
+    skewed = np.zeros((2 * n + 1, n + 1, 3))
+    skewed[range(1, n + 1), range(1, n + 1), 0] = 1.0
+    full_dice = [(lost_a, lost_d, p, np.array([0.0, p * lost_a, p * lost_d]))
+                 for (lost_a, lost_d), p in roll_outcomes(3, 2)]
+    for s in range(2, 2 * n + 1):
+        lo, hi = max(3, s - n), min(n, s - 2)
+        if lo <= hi:
+            cells = 0.0
+            for lost_a, lost_d, p, losses in full_dice:
+                cells += p * skewed[s - lost_a - lost_d, lo - lost_a:hi + 1 - lost_a] + losses
+            skewed[s, lo:hi + 1] = cells
+        for a in sorted(set([1, 2, s - 1])):
+            d = s - a
+            if not (1 <= a <= n and 1 <= d <= n):
+                continue
+            cell = 0.0
+            for (lost_a, lost_d), p in roll_outcomes(min(a, 3), min(d, 2)):
+                cell += p * (skewed[s - lost_a - lost_d, a - lost_a] + (0, lost_a, lost_d))
+            skewed[s, a] = cell
+    a = np.arange(n + 1)[:, np.newaxis]
+    tables = tuple(skewed[a + a.T, a, i] for i in range(3))
+    for table in tables:
+        table.setflags(write=False)
+    return tables
+
+
+def save_tables(path=TABLE_PATH, n=TABLE_SIZE):
+    """
+        Solves every matchup up to n against n and writes the win, attacker loss and defender loss tables to
+        path as one dense float array of shape (3, n + 1, n + 1).
+
+    :param path:
+    :param n:
+    """
+    np.save(path, np.array(_solve(n)))
+
+
+def load_tables(path=TABLE_PATH):
+    """
+        Memory maps the precompiled tables at path. Returns None if there is no usable file there.
+
+    :param path:
+    :return:
+    """
+    try:
+        stacked = np.load(path, mmap_mode='r')
+    except IOError:
+        return None
+    if stacked.ndim != 3 or stacked.shape[0] != 3 or stacked.shape[1] != stacked.shape[2]:
+        return None
+    # plain ndarray views of the mapping, as indexing a np.memmap goes through much slower Python code
+    stacked = np.asarray(stacked)
+    return stacked[0], stacked[1], stacked[2]
+
+
+def battle_tables(attackers, defenders):
+    """
+        Returns the win probability, expected attacker loss and expected defender loss matrices, indexed by
+        [attackers, defenders], covering at least the given matchup, up to MAX_TABLE_SIZE a side. The tables
+        are grown by doubling, so asking for slightly larger battles does not trigger a full solve every time.
+
+    :param attackers:
+    :param defenders:
+    :return:
+    """
+    global _tables
+    needed = min(max(attackers, defenders), MAX_TABLE_SIZE)
+    if _tables is None:
+        _tables = load_tables()
+    if _tables is None or needed >= len(_tables[0]):
+        current = 0 if _tables is None else len(_tables[0]) - 1
+        _tables = _solve(min(max(needed, 2 * current, 64), MAX_TABLE_SIZE))
+    return _tables
+
+
+def win_probabilities(attackers, defenders):
+    """
+        The probability that the attacker wipes out the defender, for a single matchup or any broadcastable
+        arrays of attacker and defender counts.
+
+    :param attackers:
+    :param defenders:
+    :return:
+    """
+    attackers, defenders = np.asarray(attackers), np.asarray(defenders)
+    if max(attackers.max(), defenders.max()) > MAX_TABLE_SIZE:
+        return _lookup(attackers, defenders)[0]
+    win, _, _ = battle_tables(attackers.max(), defenders.max())
+    return win[attackers, defenders]
+
+
+def expected_losses(attackers, defenders):
+    """
+        The expected troop loss of the attacker and defender, for a single matchup or any broadcastable arrays
+        of attacker and defender counts.
+
+    :param attackers:
+    :param defenders:
+    :return:
+    """
+    attackers, defenders = np.asarray(attackers), np.asarray(defenders)
+    if max(attackers.max(), defenders.max()) > MAX_TABLE_SIZE:
+        return tuple(_lookup(attackers, defenders)[1:])
+    _, attacker_loss, defender_loss = battle_tables(attackers.max(), defenders.max())
+    return attacker_loss[attackers, defenders], defender_loss[attackers, defenders]
+
+
+def _lookup(attackers, defenders):
+    """
+        Win probability and expected losses for matchups some of which are beyond the tables.
+    """
+    attackers, defenders = np.broadcast_arrays(attackers, defenders)
+    shape, attackers, defenders = attackers.shape, attackers.ravel(), defenders.ravel()
+    large = (attackers > MAX_TABLE_SIZE) | (defenders > MAX_TABLE_SIZE)
+    tables = battle_tables(MAX_TABLE_SIZE, MAX_TABLE_SIZE)
+    values = [table[np.where(large, 0, attackers), np.where(large, 0, defenders)] for table in tables]
+    for i in np.flatnonzero(large):
+        for value, result in zip(values, large_battle(int(attackers[i]), int(defenders[i]))):
+            value[i] = result
+    return [value.reshape(shape)[()] for value in values]
+
+
+def large_battle(attackers, defenders):
+    """
+        The win probability and expected attacker and defender losses of one battle, solved on its own as the
+        module docstring describes, in time roughly linear in the troops involved. Results are kept.
+
+    :param attackers:
+    :param defenders:
+    :return:
+    """
+    key = (attackers, defenders)
+    if key in _large_battles:
+        return _large_battles[key]
+    edge = _edge_values(attackers, defenders)
+    if attackers < 3 or defenders < 2:
+        result = edge(attackers, defenders)
+    elif _decided(attackers, defenders) is not None:
+        result = _decided_battle(attackers, defenders, _decided(attackers, defenders))
+    else:
+        _, roll = _bulk_kernel(0)
+        win = attacker_loss = defender_loss = 0.0
+        # mass[i] is the chance of still being in the bulk after k rolls, having lost first + i attackers
+        mass, first, k, settled = np.ones(1), 0, 0, -1
+        while len(mass):
+            if settled < k:
+                settled = k
+                lost = first + np.arange(len(mass))
+                a, d = attackers - lost, defenders - 2 * k + lost
+                done, (w, lost_a, lost_d) = _finishable(a, d)
+                if done.any():
+                    chances = np.where(done, mass, 0.0)
+                    win += chances.dot(w)
+                    attacker_loss += chances.dot(attackers - a + lost_a)
+                    defender_loss += chances.dot(defenders - d + lost_d)
+                    mass, first = _trimmed(np.where(done, 0.0, mass), first)
+                continue
+            # losses only grow, so a part of the walk still in the bulk after 2 ** j rolls was in it all along
+            j = max(0, (defenders + first - 2 - 2 * k) // 2).bit_length() - 1
+            while j > 0:
+                offset, kernel = _bulk_kernel(j)
+                if (defenders - 2 * (k + 2 ** j) + first + offset >= 2 and
+                        attackers - (first + offset + len(mass) + len(kernel) - 2) >= 3):
+                    break
+                j -= 1
+            if j > 0:
+                mass, first = _trimmed(np.convolve(mass, kernel), first + offset)
+                k += 2 ** j
+                continue
+            k += 1
+            walked = np.convolve(mass, roll)
+            # in the bulk, the attacker has at least 3 troops and the defender at least 2
+            low, high = 2 * k + 2 - defenders - first, attackers - 3 - first
+            for i in range(0, min(low, len(walked))) + range(max(high + 1, 0), len(walked)):
+                if not walked[i]:
+                    continue
+                a, d = attackers - first - i, defenders - 2 * k + first + i
+                w, lost_a, lost_d = edge(a, d)
+                win += walked[i] * w
+                attacker_loss += walked[i] * (attackers - a + lost_a)
+                defender_loss += walked[i] * (defenders - d + lost_d)
+                walked[i] = 0.0
+            mass, first = _trimmed(walked, first)
+        result = win, attacker_loss, defender_loss
+    if len(_large_battles) >= MAX_CACHED_DISTRIBUTIONS:
+        _large_battles.clear()
+    _large_battles[key] = result
+    return result
+
+
+def _finishable(attackers, defenders):
+    """
+        Which of the matchups in two arrays, all in the bulk, need not be walked any further, and the win
+        probability and expected losses of each of them: from the tables when neither side has more than
+        MAX_TABLE_SIZE troops, or in closed form when the battle is decided. The values are 0 for the others.
+    """
+    tables = battle_tables(MAX_TABLE_SIZE, MAX_TABLE_SIZE)
+    small = (attackers <= MAX_TABLE_SIZE) & (defenders <= MAX_TABLE_SIZE)
+    attacker_wins, defender_wins = _decided_cells(attackers, defenders)
+    attacker_wins &= ~small
+    defender_wins &= ~small & ~attacker_wins
+    values = np.zeros((3, len(attackers)))
+    for row, table in zip(values, tables):
+        row[small] = table[attackers[small], defenders[small]]
+    for wins, decided in ((True, attacker_wins), (False, defender_wins)):
+        if decided.any():
+            for row, value in zip(values, _decided_battle(attackers[decided], defenders[decided], wins)):
+                row[decided] = value
+    return small | attacker_wins | defender_wins, values
+
+
+def _trimmed(walked, first):
+    """
+        walked without the chances below NEGLIGIBLE at either end, and the attacker loss its first entry is for.
+    """
+    kept = np.flatnonzero(walked >= NEGLIGIBLE)
+    if not len(kept):
+        return walked[:0], first
+    return walked[kept[0]:kept[-1] + 1], first + kept[0]
+
+
+def _bulk_kernel(j):
+    """
+        The attacker's losses over 2 ** j rolls in the bulk, as the smallest loss kept and the chances of it and
+        each loss above, with chances below NEGLIGIBLE dropped. Worked out by doubling, and kept.
+    """
+    if not _bulk_kernels:
+        p, _, _, _ = _bulk_walk()
+        _bulk_kernels.append((0, np.array([p[0], p[1], p[2]])))
+    while len(_bulk_kernels) <= j:
+        offset, kernel = _bulk_kernels[-1]
+        doubled, offset = _trimmed(np.convolve(kernel, kernel), 2 * offset)
+        _bulk_kernels.append((offset, doubled))
+    return _bulk_kernels[j]
+
+
+def _bulk_walk():
+    """
+        The chances of each attacker loss, 0, 1 or 2, in a roll of three dice against two, and the mean and
+        variance of the attacker's and of the defender's losses per roll.
+    """
+    p = dict((lost_a, prob) for (lost_a, _), prob in roll_outcomes(3, 2))
+    mean_a = p[1] + 2 * p[2]
+    mean_d = 2 - mean_a
+    variance = p[1] + 4 * p[2] - mean_a ** 2
+    return p, mean_a, mean_d, variance
+
+
+def _decided(attackers, defenders):
+    """
+        True if the attacker is all but certain to win, False if the defender is, None if neither. Certain
+        means the winner is expected to have more than DECIDED_SPREAD standard deviations plus DECIDED_MARGIN
+        troops left when the loser runs out, so the other ending is too unlikely to show in a float.
+    """
+    attacker_wins, defender_wins = _decided_cells(attackers, defenders)
+    return True if attacker_wins else False if defender_wins else None
+
+
+def _decided_cells(attackers, defenders):
+    """
+        Whether the attacker is all but certain to win, and whether the defender is, as _decided means it, for
+        a single matchup or arrays of them.
+    """
+    _, mean_a, mean_d, variance = _bulk_walk()
+    decided = []
+    # the winner's expected losses by the time the loser runs out, and their spread
+    for troops, loser_troops, mean, loser_mean in ((attackers, defenders, mean_a, mean_d),
+                                                   (defenders, attackers, mean_d, mean_a)):
+        rolls = loser_troops / loser_mean
+        spread = 2 / loser_mean * (variance * rolls) ** 0.5
+        decided.append(troops - mean * rolls > DECIDED_SPREAD * spread + DECIDED_MARGIN)
+    return decided
+
+
+def _decided_battle(attackers, defenders, attacker_wins):
+    """
+        The result of a decided battle. As neither side's losses ever go down, the loser's run through the bulk
+        is a renewal process that ignores the winner's edge, so where it ends is known in closed form: each
+        level is landed on exactly with probability 1 / (1 + q) + q / (1 + q) * (-q) ** level, q being the
+        chance a non-zero step is two, and Wald's identity gives the mean number of rolls it takes. The
+        winner's strip has settled to constants that far along it. Works on arrays of matchups as well.
+    """
+    p, mean_a, mean_d, _ = _bulk_walk()
+    edge = _edge_values(DECIDED_MARGIN, DECIDED_MARGIN)
+    if attacker_wins:
+        # the defender's losses step by 2, 1 or 0, and the walk ends on defenders - 1 or defenders
+        q = p[0] / (p[0] + p[1])
+        exact = 1 / (1 + q) + q / (1 + q) * (-q) ** (defenders - 1)
+        defender_lost = defenders - exact
+        attacker_lost = defender_lost * (2 / mean_d - 1)
+        _, strip_loss, _ = edge(DECIDED_MARGIN, 1)
+        return 1.0, attacker_lost + exact * strip_loss, defenders + 0.0
+    q = p[2] / (p[1] + p[2])
+    exact = 1 / (1 + q) + q / (1 + q) * (-q) ** (attackers - 2)
+    attacker_lost = attackers - 1 - exact
+    defender_lost = attacker_lost * (2 / mean_a - 1)
+    _, _, two_left = edge(2, DECIDED_MARGIN)
+    _, _, one_left = edge(1, DECIDED_MARGIN)
+    return 0.0, attackers + 0.0, defender_lost + exact * two_left + (1 - exact) * one_left
+
+
+def _edge_values(attackers, defenders):
+    """
+        Returns a function giving (win probability, attacker loss, defender loss) from any matchup with at
+        most 2 attackers or at most 1 defender, up to the given counts. The strips are solved one cell at a
+        time, and extended as bigger battles need them.
+    """
+    global _edges
+    if _edges is None:
+        _edges = ([(0.0, 0.0, 0.0)], [None, None], [None, None])
+    one_defender, one_attacker, two_attackers = _edges
+
+    def edge(a, d):
+        if a == 0:
+            return 0.0, 0.0, 0.0
+        if d == 0:
+            return 1.0, 0.0, 0.0
+        if d == 1:
+            return one_defender[a]
+        return (one_attacker if a == 1 else two_attackers)[d]
+
+    def solve(a, d):
+        cell = [0.0, 0.0, 0.0]
+        for (lost_a, lost_d), p in roll_outcomes(min(a, 3), min(d, 2)):
+            w, la, ld = edge(a - lost_a, d - lost_d)
+            cell[0] += p * w
+            cell[1] += p * (la + lost_a)
+            cell[2] += p * (ld + lost_d)
+        return tuple(cell)
+
+    while len(one_defender) <= max(attackers, 2):
+        one_defender.append(solve(len(one_defender), 1))
+    while len(one_attacker) <= defenders:
+        d = len(one_attacker)
+        one_attacker.append(solve(1, d))
+        two_attackers.append(solve(2, d))
+    return edge
+
+
+def outcome_distribution(attackers, defenders):
+    """
+        The full distribution of a battle's result. Returns two arrays: the probability the attacker wins with
+        k troops left (indexed by k, 0 <= k <= attackers), and the probability the defender holds with k troops
+        left (0 <= k <= defenders). Together they sum to one.
+
+    :param attackers:
+    :param defenders:
+    :return:
+    """
+    key = (attackers, defenders)
+    if key in _distributions:
+        return _distributions[key]
+    mass = np.zeros((attackers + 1, defenders + 1))
+    mass[attackers, defenders] = 1.0
+    for groups in reversed(list(_diagonals(attackers, defenders))):
+        for a, d, outcomes in groups:
+            p_cells = mass[a, d]
+            for (lost_a, lost_d), p in outcomes:
+                mass[a - lost_a, d - lost_d] += p * p_cells
+    attacker_remaining, defender_remaining = mass[:, 0].copy(), mass[0, :].copy()
+    attacker_remaining.setflags(write=False)
+    defender_remaining.setflags(write=False)
+    if len(_distributions) >= MAX_CACHED_DISTRIBUTIONS:
+        _distributions.clear()
+    _distributions[key] = attacker_remaining, defender_remaining
+    return attacker_remaining, defender_remaining
+
+
+def sample_battle(attackers, defenders, rng=random):
+    """
+        Draws the result of a whole battle and returns (attacker loss, defender loss). Battles up to
+        MAX_SAMPLED_GRID matchups in size draw once from their cached outcome distribution; bigger ones are
+        rolled out round by round, which has the same distribution without solving a large grid.
+
+    :param attackers:
+    :param defenders:
+    :param rng: anything with a random() method
+    :return:
+    """
+    if attackers * defenders > MAX_SAMPLED_GRID:
+        return _roll_battle(attackers, defenders, rng)
+    key = (attackers, defenders)
+    if key not in _cumulative_distributions:
+        if len(_cumulative_distributions) >= MAX_CACHED_DISTRIBUTIONS:
+            _cumulative_distributions.clear()
+        attacker_remaining, defender_remaining = outcome_distribution(attackers, defenders)
+        _cumulative_distributions[key] = np.cumsum(np.concatenate((attacker_remaining[1:],
+                                                                   defender_remaining[1:]))).tolist()
+    cumulative = _cumulative_distributions[key]
+    i = min(bisect.bisect_right(cumulative, rng.random() * cumulative[-1]), len(cumulative) - 1)
+    if i < attackers:
+        return attackers - (i + 1), defenders
+    return attackers, defenders - (i - attackers + 1)
+
+
+def _roll_battle(attackers, defenders, rng):
+    a, d = attackers, defenders
+    while a and d:
+        u = rng.random()
+        for (lost_a, lost_d), p in roll_outcomes(min(a, 3), min(d, 2)):
+            u -= p
+            if u < 0:
+                break
+        a, d = a - lost_a, d - lost_d
+    return attackers - a, defenders - d
+
+
+if __name__ == '__main__':
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else TABLE_SIZE
+    save_tables(TABLE_PATH, size)
@@ -0,0 +1,56 @@
+"""
+    A bounded least-recently-used cache with hit and miss counters, for sizing caches from real traffic.
+"""
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+        Maps keys to values, evicting the least recently used entry once more than maxsize are held.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        if key in self.entries:
+            self.hits += 1
+            value = self.entries.pop(key)
+            self.entries[key] = value
+            return value
+        self.misses += 1
+        return default
+
+    def put(self, key, value):
+        if key in self.entries:
+            del self.entries[key]
+        elif len(self.entries) >= self.maxsize:
+            self.entries.popitem(last=False)
+        self.entries[key] = value
+
+    def discard(self, key):
+        self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = self.misses = 0
+
+    def stats(self):
+        """
+            A dict of size, maxsize, hits, misses and hit rate.
+        """
+        lookups = self.hits + self.misses
+        return {'size': len(self.entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0}
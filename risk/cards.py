@@ -0,0 +1,134 @@
+"""
+    Card hands, and which sets they can trade in.
+
+    Three cards make a set when they are all of one type, one of each of cannon, horse and soldier, or include
+    a wild. Which sets a hand can make depends only on how many cards of each type it holds, and never on more
+    than three of any one type, so SETS lists the sets open to every such count, worked out once on import.
+    A Hand keeps its counts as cards come and go, so asking whether it holds a set is a table lookup, and
+    choosing which one to trade in only looks at the handful of sets the table gives.
+
+    The best set keeps as many wilds as it can, and among the sets using the fewest wilds, prefers one with a
+    card naming a country the player owns, as the first such card traded in puts risk.game.OWNED_CARD_BONUS
+    troops on that country.
+"""
+import itertools
+
+CARD_TYPES = ('cannon', 'horse', 'soldier', 'wild')
+TYPE_INDEX = dict((value, i) for i, value in enumerate(CARD_TYPES))
+WILD = TYPE_INDEX['wild']
+# no set uses more than this many cards of one type
+MOST_OF_A_TYPE = 3
+
+
+def is_set(types):
+    """
+        Whether three card types, given as indices into CARD_TYPES, make a set.
+
+    :param types:
+    :return:
+    """
+    return WILD in types or len(set(types)) in (1, 3)
+
+
+def hand_key(counts):
+    """
+        The index into SETS of a hand holding counts[t] cards of type CARD_TYPES[t].
+    """
+    key = 0
+    for count in counts:
+        key = key * (MOST_OF_A_TYPE + 1) + min(count, MOST_OF_A_TYPE)
+    return key
+
+
+def _set_table():
+    """
+        For every hand_key, the sets such a hand can make as counts per type, fewest wilds first.
+    """
+    patterns = sorted((tuple(types.count(t) for t in range(len(CARD_TYPES)))
+                       for types in itertools.combinations_with_replacement(range(len(CARD_TYPES)), 3)
+                       if is_set(types)), key=lambda pattern: (pattern[WILD], pattern))
+    table = []
+    for counts in itertools.product(range(MOST_OF_A_TYPE + 1), repeat=len(CARD_TYPES)):
+        table.append(tuple(pattern for pattern in patterns
+                           if all(used <= held for used, held in zip(pattern, counts))))
+    return tuple(table)
+
+
+SETS = _set_table()
+
+
+class Hand(object):
+    """
+        A player's cards, as a set of risk.models Card objects that also keeps how many of each type it holds.
+    """
+
+    def __init__(self, cards=()):
+        self.cards = set()
+        self.counts = [0] * len(CARD_TYPES)
+        self.update(cards)
+
+    def __iter__(self):
+        return iter(self.cards)
+
+    def __len__(self):
+        return len(self.cards)
+
+    def __contains__(self, card):
+        return card in self.cards
+
+    def __repr__(self):
+        return 'Hand(%r)' % sorted(card.country_name for card in self.cards)
+
+    def add(self, card):
+        if card not in self.cards:
+            self.cards.add(card)
+            self.counts[TYPE_INDEX[card.value]] += 1
+
+    def remove(self, card):
+        self.cards.remove(card)
+        self.counts[TYPE_INDEX[card.value]] -= 1
+
+    def discard(self, card):
+        if card in self.cards:
+            self.remove(card)
+
+    def update(self, cards):
+        for card in cards:
+            self.add(card)
+
+    def clear(self):
+        self.cards.clear()
+        self.counts = [0] * len(CARD_TYPES)
+
+    def has_set(self):
+        return bool(SETS[hand_key(self.counts)])
+
+    def best_set(self, owns=None):
+        """
+            The set to trade in, as a list of three cards, or None if the hand holds no set: of the sets using
+            the fewest wilds, one with a card naming a country the player owns if there is one, that card first.
+
+        :param owns: a function telling whether the player owns the country of a given name
+        :return:
+        """
+        patterns = SETS[hand_key(self.counts)]
+        if not patterns:
+            return None
+        by_type = [[] for _ in CARD_TYPES]
+        for card in sorted(self.cards, key=lambda c: c.country_name):
+            by_type[TYPE_INDEX[card.value]].append(card)
+        if owns is not None:
+            # owned cards to the front of each type, so a pattern picks them first
+            for cards in by_type:
+                cards.sort(key=lambda c: not owns(c.country_name))
+        fallback = None
+        for pattern in patterns:
+            if fallback is not None and pattern[WILD] > fallback[1]:
+                break
+            chosen = [card for cards, used in zip(by_type, pattern) for card in cards[:used]]
+            owned = [card for card in chosen if owns is not None and owns(card.country_name)]
+            if owned:
+                return owned[:1] + [card for card in chosen if card is not owned[0]]
+            if fallback is None:
+                fallback = chosen, pattern[WILD]
+        return fallback[0]
@@ -0,0 +1,134 @@
+"""
+    The decision log: a record of what the bot decided and why, written off the request path.
+
+    Each record is one line of compact JSON, {"t": unix time, "lvl": level name, "ev": event, ...fields}, so a log
+    can be read back with records() and a turn replayed from what it was given. A record is built only if its
+    level is enabled, and is then put on a queue that a background thread writes out, flushing whenever the
+    queue runs dry; if the writer falls behind by more than QUEUE_SIZE records, new ones are dropped and
+    counted rather than making the request wait.
+
+    LOG, the process's log, is set up from the environment:
+
+        DECISION_LOG          the file to append to, or - for stdout (the default)
+        DECISION_LOG_LEVEL    debug, info (the default), warning or off
+
+    At info the app logs one record per /turn with the order given; at debug each record also carries the
+    request it answered, and ai.py adds the numbers behind its choices.
+"""
+import os
+import sys
+import json
+import time
+import atexit
+import threading
+import Queue
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+OFF = 100
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'off': OFF}
+LEVEL_NAMES = dict((level, name) for name, level in LEVELS.items())
+QUEUE_SIZE = 10000
+
+
+class DecisionLog(object):
+    """
+        A decision log writing to `stream` (a file object, or a path opened for appending on the first record)
+        every record of `level` or above.
+    """
+
+    def __init__(self, stream=sys.stdout, level=INFO, queue_size=QUEUE_SIZE):
+        self.stream = stream
+        self.level = level
+        self.queue = Queue.Queue(queue_size)
+        self.dropped = 0
+        self.writer = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def enabled(self, level):
+        return level >= self.level
+
+    def log(self, level, event, **fields):
+        if level < self.level:
+            return
+        fields['t'] = round(time.time(), 3)
+        fields['lvl'] = LEVEL_NAMES[level]
+        fields['ev'] = event
+        if self.pid != os.getpid():
+            self._start()
+        try:
+            self.queue.put_nowait(fields)
+        except Queue.Full:
+            self.dropped += 1
+
+    def debug(self, event, **fields):
+        self.log(DEBUG, event, **fields)
+
+    def info(self, event, **fields):
+        self.log(INFO, event, **fields)
+
+    def warning(self, event, **fields):
+        self.log(WARNING, event, **fields)
+
+    def flush(self):
+        """
+            Waits until every record logged so far has been written.
+        """
+        if self.writer is not None and self.pid == os.getpid():
+            self.queue.join()
+
+    def _start(self):
+        # the writer is started by the first record in each process, as threads do not survive a fork
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            if self.pid is not None:
+                self.queue = Queue.Queue(self.queue.maxsize)
+            if not hasattr(self.stream, 'write'):
+                self.stream = open(self.stream, 'a')
+            self.writer = threading.Thread(target=self._write, name='decision-log')
+            self.writer.daemon = True
+            self.writer.start()
+            self.pid = os.getpid()
+
+    def _write(self):
+        while True:
+            record = self.queue.get()
+            try:
+                self.stream.write(json.dumps(record, separators=(',', ':'), default=repr) + '\n')
+                if self.queue.empty():
+                    self.stream.flush()
+            finally:
+                self.queue.task_done()
+
+
+def from_environment(environ=os.environ):
+    """
+        The DecisionLog described by DECISION_LOG and DECISION_LOG_LEVEL in environ.
+    """
+    path = environ.get('DECISION_LOG', '-')
+    level = LEVELS[environ.get('DECISION_LOG_LEVEL', 'info').lower()]
+    return DecisionLog(sys.stdout if path == '-' else path, level)
+
+
+def records(path, event=None):
+    """
+        Yields the records of the log at path, as dicts, optionally only those of one event.
+
+    :param path:
+    :param event:
+    :return:
+    """
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if event is None or record['ev'] == event:
+                yield record
+
+
+LOG = from_environment()
+atexit.register(LOG.flush)
@@ -0,0 +1,124 @@
+"""
+    Dice sources for Country.attack.
+
+    A dice source has two methods, both returning (attacker loss, defender loss): roll(attacking_die,
+    defending_die) rolls that many dice a side once, and battle(attackers, defenders) fights until one side is
+    wiped out, drawing the result from the battle's exact outcome distribution rather than rolling it out.
+    RandomDice rolls every die as the rules describe; BufferedDice draws the losses straight from their
+    distribution in bulk, which is what simulations want; ReplayDice plays back a fixed list of results, and
+    RecordingDice keeps what another source rolled so a game can be replayed exactly.
+"""
+import random
+import numpy as np
+from risk.battle import roll_outcomes, sample_battle
+
+BUFFER_SIZE = 4096
+
+
+class RandomDice(object):
+    """
+        Rolls each die with rng, the random module unless given, and compares the highest dice pairwise.
+    """
+
+    def __init__(self, rng=random):
+        self.rng = rng
+
+    def roll(self, attacking_die, defending_die):
+        attacking_rolls = sorted([self.rng.randint(1, 6) for _ in range(attacking_die)], reverse=True)
+        defending_rolls = sorted([self.rng.randint(1, 6) for _ in range(defending_die)], reverse=True)
+        attacker_loss = sum(1 for a, d in zip(attacking_rolls, defending_rolls) if a <= d)
+        return attacker_loss, min(attacking_die, defending_die) - attacker_loss
+
+    def battle(self, attackers, defenders):
+        return sample_battle(attackers, defenders, self.rng)
+
+
+class BufferedDice(object):
+    """
+        Draws each roll's losses from the exact distribution for its number of dice, as given by
+        battle.roll_outcomes, filling a buffer of `size` results at a time per matchup from a numpy generator
+        seeded with seed. Battles are drawn with uniforms from the same generator, buffered likewise. The same
+        seed and the same sequence of rolls and battles asked for give the same results.
+    """
+
+    def __init__(self, seed=None, size=BUFFER_SIZE):
+        self.generator = np.random.RandomState(seed)
+        self.size = size
+        self.buffers = {}
+        self.uniforms = []
+
+    def roll(self, attacking_die, defending_die):
+        key = (attacking_die, defending_die)
+        buffer = self.buffers.get(key)
+        if not buffer:
+            buffer = self.buffers[key] = self._fill(attacking_die, defending_die)
+        return buffer.pop()
+
+    def battle(self, attackers, defenders):
+        return sample_battle(attackers, defenders, self)
+
+    def random(self):
+        """
+            A uniform draw from [0, 1), so the source can stand in for a random.Random in battle.sample_battle.
+        """
+        if not self.uniforms:
+            self.uniforms = self.generator.random_sample(self.size).tolist()
+        return self.uniforms.pop()
+
+    def _fill(self, attacking_die, defending_die):
+        outcomes = roll_outcomes(attacking_die, defending_die)
+        cumulative = np.cumsum([p for _, p in outcomes])
+        drawn = np.searchsorted(cumulative, self.generator.random_sample(self.size) * cumulative[-1], side='right')
+        losses = [losses for losses, _ in outcomes]
+        return [losses[i] for i in np.minimum(drawn, len(outcomes) - 1).tolist()]
+
+
+class ReplayDice(object):
+    """
+        Returns the given (attacker loss, defender loss) results in order, for tests and replays, whether
+        they are asked for by roll() or battle(). Fails if a result does not fit the dice rolled or the
+        battle fought, or the results run out.
+    """
+
+    def __init__(self, results):
+        self.results = list(results)
+        self.position = 0
+
+    def next(self):
+        assert self.position < len(self.results), 'no more results to replay'
+        self.position += 1
+        return self.results[self.position - 1]
+
+    def roll(self, attacking_die, defending_die):
+        attacker_loss, defender_loss = self.next()
+        assert attacker_loss + defender_loss == min(attacking_die, defending_die)
+        return attacker_loss, defender_loss
+
+    def battle(self, attackers, defenders):
+        attacker_loss, defender_loss = self.next()
+        assert 0 <= attacker_loss <= attackers and 0 <= defender_loss <= defenders
+        assert attacker_loss == attackers or defender_loss == defenders
+        return attacker_loss, defender_loss
+
+
+class RecordingDice(object):
+    """
+        Rolls with another source and keeps every result in `results`, ready for a ReplayDice.
+    """
+
+    def __init__(self, dice):
+        self.dice = dice
+        self.results = []
+
+    def roll(self, attacking_die, defending_die):
+        result = self.dice.roll(attacking_die, defending_die)
+        self.results.append(result)
+        return result
+
+    def battle(self, attackers, defenders):
+        result = self.dice.battle(attackers, defenders)
+        self.results.append(result)
+        return result
+
+
+DICE = RandomDice()
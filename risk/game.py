@@ -0,0 +1,277 @@
+"""
+    A headless game engine for playing complete games in-process between policies.
+
+    A policy is any object with these methods, each given the game and the player whose turn it is:
+
+        choose_country(game, player)         -> an unowned Country
+        spend_cards(game, player, force)     -> three of the player's cards forming a set, or None to keep them
+                                                (only allowed when force is False)
+        deploy_troops(game, player)          -> {Country: troops} placing up to player.troops_to_deploy
+        attack(game, player)                 -> (base, target, attacking_troops, moving_troops) for one roll,
+                                                a Blitz to fight a whole battle at once, or None to stop
+        reinforce(game, player)              -> (origin, destination, troops), or None to end the turn
+
+    The engine applies every order through the methods in risk.models, so an illegal order fails the same
+    assertions it would against the game host.
+"""
+import random
+import itertools
+from collections import namedtuple
+from operator import attrgetter
+from risk.models import Player
+from risk.dice import BufferedDice
+
+
+STARTING_TROOPS = {3: 35, 4: 30, 5: 25, 6: 20}
+# the number of countries STARTING_TROOPS is meant for; larger maps scale it up
+CLASSIC_COUNTRIES = 42
+CARD_TRADE_VALUES = [4, 6, 8, 10, 12, 15]
+OWNED_CARD_BONUS = 2
+MAX_CARDS = 5
+MAX_ATTACKS_PER_TURN = 1000
+
+# an attack order fought to the end in one step with Country.blitz
+Blitz = namedtuple('Blitz', ['base', 'target', 'stop_at', 'moving_troops'])
+
+
+def trade_value(sets_traded):
+    """
+        The troops awarded for the next card set, given how many sets have been traded in so far this game.
+
+    :param sets_traded:
+    :return:
+    """
+    if sets_traded < len(CARD_TRADE_VALUES):
+        return CARD_TRADE_VALUES[sets_traded]
+    return CARD_TRADE_VALUES[-1] + 5 * (sets_traded - len(CARD_TRADE_VALUES) + 1)
+
+
+def starting_troops(players, countries):
+    """
+        Troops each player starts with, counting the one on each country they claim: STARTING_TROOPS on maps up
+        to the classic size, and in proportion to the number of countries on larger ones.
+
+    :param players:
+    :param countries:
+    :return:
+    """
+    return STARTING_TROOPS[players] * max(countries, CLASSIC_COUNTRIES) // CLASSIC_COUNTRIES
+
+
+class Game(object):
+    """
+        One game on a fresh board from template, between the policies in a {player name: policy} dict. Seat
+        order, card draws and every dice roll come from the game's own random generator, so a game is
+        reproducible from its seed. Battles are rolled with `dice`, a source from risk.dice, by default a
+        BufferedDice seeded from that generator. The game ends when one player owns every country, or as a
+        draw after max_turns player turns.
+    """
+
+    def __init__(self, template, policies, seed=None, max_turns=1000, dice=None):
+        assert 3 <= len(policies) <= 6
+        self.template = template
+        self.graph = template.graph
+        self.board = template.board()
+        self.policies = policies
+        self.random = random.Random(seed)
+        self.players = [Player(name) for name in sorted(policies)]
+        self.random.shuffle(self.players)
+        self.deck = sorted(self.board.cards.values(), key=lambda card: card.country_name)
+        self.random.shuffle(self.deck)
+        self.dice = dice if dice is not None else BufferedDice(self.random.getrandbits(32))
+        self.discards = []
+        self.sets_traded = 0
+        self.turns = 0
+        self.max_turns = max_turns
+        self.winner = None
+
+    def play(self):
+        """
+            Plays the game to the end and returns the winning Player, or None for a draw.
+        """
+        self.claim_countries()
+        self.place_starting_troops()
+        for player in itertools.cycle(self.players):
+            if self.winner is not None or self.turns >= self.max_turns:
+                break
+            if not player.is_eliminated:
+                self.play_turn(player)
+        return self.winner
+
+    def claim_countries(self):
+        unowned = len(self.board.countries)
+        for player in itertools.cycle(self.players):
+            if not unowned:
+                break
+            player.choose_country(self.policies[player.name].choose_country(self, player))
+            unowned -= 1
+            self.changed(player)
+
+    def place_starting_troops(self):
+        troops = starting_troops(len(self.players), len(self.board.countries))
+        for player in self.players:
+            player.troops_to_deploy = max(0, troops - len(player.countries))
+            self.deploy_troops(player)
+
+    def play_turn(self, player):
+        self.turns += 1
+        player.troops_to_deploy = self.reinforcements(player)
+        self.spend_cards(player)
+        self.deploy_troops(player)
+        if self.attack(player) and (self.deck or self.discards):
+            player.cards.add(self.draw_card())
+        if self.winner is None:
+            self.reinforce(player)
+
+    def reinforcements(self, player):
+        """
+            Troops a player receives at the start of a turn: a third of their countries, at least three, plus
+            the bonus of every continent they hold outright.
+
+        :param player:
+        :return:
+        """
+        troops = max(3, len(player.countries) // 3)
+        return troops + sum(continent.bonus for continent in self.board.ownership.continents_controlled(player))
+
+    def draw_card(self):
+        if not self.deck:
+            self.deck, self.discards = self.discards, []
+            self.random.shuffle(self.deck)
+        return self.deck.pop()
+
+    def spend_cards(self, player):
+        policy = self.policies[player.name]
+        while player.has_card_set():
+            force = len(player.cards) >= MAX_CARDS
+            cards = policy.spend_cards(self, player, force)
+            if cards is None:
+                assert not force
+                return
+            self.trade_in(player, cards)
+
+    def trade_in(self, player, cards):
+        """
+            Trades in a set of the player's cards for troops. The first traded card naming a country the player
+            owns also puts OWNED_CARD_BONUS troops straight onto that country.
+
+        :param player:
+        :param cards:
+        """
+        assert len(set(cards)) == 3
+        assert all(card in player.cards for card in cards)
+        assert cards[0].is_set_with(cards[1], cards[2])
+        player.troops_to_deploy += trade_value(self.sets_traded)
+        self.sets_traded += 1
+        for card in cards:
+            country = self.board.countries.get(card.country_name)
+            if country is not None and country.owner == player:
+                country.add_troops(player, OWNED_CARD_BONUS)
+                break
+        for card in cards:
+            player.cards.remove(card)
+            self.discards.append(card)
+        self.changed(player)
+
+    def deploy_troops(self, player):
+        orders = self.policies[player.name].deploy_troops(self, player)
+        assert sum(orders.values()) <= player.troops_to_deploy
+        for country, troops in orders.items():
+            if troops > 0:
+                player.deploy_troops(country, troops)
+                player.troops_to_deploy -= troops
+        if player.troops_to_deploy:
+            country = self.random.choice(sorted(player.countries, key=lambda c: c.name))
+            player.deploy_troops(country, player.troops_to_deploy)
+            player.troops_to_deploy = 0
+        self.changed(player)
+
+    def attack(self, player):
+        """
+            Runs the player's attack phase and returns whether they conquered at least one country.
+
+        :param player:
+        :return:
+        """
+        policy = self.policies[player.name]
+        conquered = False
+        for _ in range(MAX_ATTACKS_PER_TURN):
+            order = policy.attack(self, player)
+            if order is None:
+                break
+            base, target = order[0], order[1]
+            assert base.owner == player
+            defender = target.owner
+            if isinstance(order, Blitz):
+                fell = base.blitz(target, order.stop_at, order.moving_troops, self.dice)
+            else:
+                fell = base.attack(target, order[2], order[3], self.dice)
+            self.changed(player)
+            if fell:
+                conquered = True
+                if not defender.countries:
+                    self.eliminate(defender, player)
+                if len(player.countries) == len(self.board.countries):
+                    self.winner = player
+                    break
+        return conquered
+
+    def eliminate(self, player, conqueror):
+        player.is_eliminated = True
+        conqueror.cards.update(player.cards)
+        player.cards.clear()
+
+    def reinforce(self, player):
+        order = self.policies[player.name].reinforce(self, player)
+        if order is not None:
+            player.reinforce(*order)
+            self.changed(player)
+
+    def changed(self, player):
+        """
+            Called after every order is applied, with the player who gave it. Does nothing here; a host with
+            remote players sends them the game.
+        """
+        pass
+
+
+class RandomPolicy(object):
+    """
+        Picks uniformly among sensible orders, drawing from the game's generator: deploys everything on one
+        border country, and attacks from a country with more than `min_troops` troops into a weaker neighbour
+        until there are none left or a `stop` chance ends the phase.
+    """
+
+    def __init__(self, min_troops=3, stop=0.05):
+        self.min_troops = min_troops
+        self.stop = stop
+
+    def choose_country(self, game, player):
+        return game.random.choice([c for _, c in sorted(game.board.countries.items()) if c.owner is None])
+
+    def spend_cards(self, game, player, force):
+        sets = [cards for cards in itertools.combinations(sorted(player.cards, key=lambda c: c.country_name), 3)
+                if cards[0].is_set_with(cards[1], cards[2])]
+        return game.random.choice(sets)
+
+    def deploy_troops(self, game, player):
+        frontier = sorted(game.board.ownership.frontier(player), key=lambda c: c.name)
+        return {game.random.choice(frontier or sorted(player.countries, key=lambda c: c.name)):
+                player.troops_to_deploy}
+
+    def attack(self, game, player):
+        if game.random.random() < self.stop:
+            return None
+        # only bases that can attack are sorted, which is most of the cost on a large frontier
+        bases = sorted((c for c in game.board.ownership.frontier(player) if c.troops > self.min_troops),
+                       key=attrgetter('name'))
+        attacks = [(c1, c2) for c1 in bases for c2 in c1.border_countries
+                   if c2.owner != player and c1.troops > c2.troops]
+        if not attacks:
+            return None
+        base, target = game.random.choice(attacks)
+        attacking_troops = min(3, base.troops - 1)
+        return base, target, attacking_troops, base.troops - attacking_troops - 1
+
+    def reinforce(self, game, player):
+        return None
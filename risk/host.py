@@ -0,0 +1,329 @@
+"""
+    A game host that plays risk.game between remote bots, each an HTTP endpoint like app.py:
+
+        GET  /status      a health check, made before the game starts
+        POST /turn        the game and the player's own state, answered with the player's order
+        POST /not_turn    the game, sent to every other player after each order
+
+    Python 2 has no asyncio, so the host waits on its bots from a thread pool. Each bot has its own
+    requests.Session, so connections are kept alive and reused for the whole game, and every request has a
+    deadline. The game sent after an order goes to all the other bots at once and they are waited on together,
+    so the table waits for its slowest bot once rather than for every bot in turn, and never past the deadline.
+
+    A bot that misses a deadline, fails, or answers with an order that is not legal gets an error on its player
+    (Player.errors) and, on its turn, is asked again, until check_neutralized makes the player neutral. A neutral
+    player's bot is not contacted again and its turns are skipped; where the game cannot go on without its
+    orders, while claiming countries and placing starting troops, the host picks for it at random.
+"""
+import json
+import time
+import uuid
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import requests
+from requests.adapters import HTTPAdapter
+from risk.game import Game, Blitz
+from risk.decisionlog import LOG
+
+DEADLINE = 5.0
+POOL_CONNECTIONS = 4
+JSON_HEADERS = {'Content-Type': 'application/json'}
+
+
+class BotError(Exception):
+    pass
+
+
+# what a bot can get wrong: the request itself, the deadline, or the response's content. Responses are checked
+# through check, field and check_troops below, which raise BotError for anything malformed, so an exception of
+# any other type is a bug in the host and is left to propagate.
+BOT_ERRORS = (BotError, requests.RequestException, multiprocessing.TimeoutError)
+
+
+class BotClient(object):
+    """
+        The connection to the bot at url, such as http://localhost:5000, through a requests.Session holding up
+        to `connections` kept-alive connections to it. timeout is given to each request, in seconds.
+    """
+
+    def __init__(self, url, connections=POOL_CONNECTIONS):
+        self.url = url.rstrip('/')
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=connections)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def status(self, timeout):
+        self.session.get(self.url + '/status', timeout=timeout).raise_for_status()
+
+    def turn(self, payload, timeout):
+        response = self.session.post(self.url + '/turn', data=json.dumps(payload), headers=JSON_HEADERS,
+                                     timeout=timeout)
+        response.raise_for_status()
+        try:
+            return response.json()
+        except ValueError:
+            raise BotError('response is not JSON: %r' % response.content[:100])
+
+    def not_turn(self, payload, timeout):
+        self.session.post(self.url + '/not_turn', data=json.dumps(payload), headers=JSON_HEADERS,
+                          timeout=timeout).raise_for_status()
+
+    def close(self):
+        self.session.close()
+
+
+def check(condition, message):
+    if not condition:
+        raise BotError(message)
+
+
+def field(data, name, *default):
+    """
+        data[name], raising BotError if data is not a JSON object or, unless a default is given, lacks name.
+    """
+    check(isinstance(data, dict), 'expected an object, got %r' % (data,))
+    if default:
+        return data.get(name, default[0])
+    check(name in data, 'missing %r' % name)
+    return data[name]
+
+
+def check_troops(value, low, high=None):
+    """
+        Returns value as an int if it is a whole number from low to high, inclusive, and raises BotError
+        otherwise. Whole floats are accepted, as bots doing arithmetic with numpy tend to send them.
+    """
+    check(isinstance(value, (int, long, float)) and not isinstance(value, bool)
+          and abs(value) != float('inf') and value == int(value), 'troops must be a whole number: %r' % (value,))
+    check(low <= value and (high is None or value <= high), 'troops out of range: %r' % value)
+    return int(value)
+
+
+class RemotePolicy(object):
+    """
+        The policy of a player whose orders the Host asks their bot for. Every order is checked before it is
+        returned, so a bad one costs the bot an error instead of failing the engine's assertions. Once the
+        player is neutral, the host's own choices below stand in.
+    """
+
+    def choose_country(self, game, player):
+        def parse(response):
+            country = game.country(game.expect(response, 'choose_country'))
+            check(country.owner is None, '%s is already taken' % country.name)
+            return country
+        country = game.ask(player, ['choose_country'], parse)
+        if player.is_neutral:
+            return game.random.choice([c for _, c in sorted(game.board.countries.items()) if c.owner is None])
+        return country
+
+    def spend_cards(self, game, player, force):
+        def parse(response):
+            action, data = game.expect(response, 'spend_cards', 'deploy_troops', data=True)
+            if action == 'deploy_troops':
+                # deploying instead of trading in keeps the cards; the deployment is asked for again
+                check(not force, 'cards must be spent')
+                return None
+            cards = dict((card.country_name, card) for card in player.cards)
+            check(isinstance(data, list) and all(isinstance(name, basestring) for name in data)
+                  and len(set(data)) == 3 and all(name in cards for name in data), 'not three held cards: %r' % (data,))
+            chosen = [cards[name] for name in data]
+            check(chosen[0].is_set_with(chosen[1], chosen[2]), 'not a set: %r' % data)
+            return chosen
+        chosen = game.ask(player, ['spend_cards'] if force else ['spend_cards', 'deploy_troops'], parse)
+        if player.is_neutral and force:
+            return player.best_card_set(game.board)
+        return chosen
+
+    def deploy_troops(self, game, player):
+        def parse(response):
+            orders = {}
+            data = game.expect(response, 'deploy_troops')
+            check(isinstance(data, dict), 'expected an object, got %r' % (data,))
+            for name, troops in data.items():
+                country = game.country(name)
+                check(country.owner == player, '%s is not theirs' % name)
+                orders[country] = check_troops(troops, 0)
+            check(sum(orders.values()) <= player.troops_to_deploy, 'more troops than they have')
+            return orders
+        # anything left undeployed, and everything once neutral, the engine places at random
+        return game.ask(player, ['deploy_troops'], parse) or {}
+
+    def attack(self, game, player):
+        def parse(response):
+            action, data = game.expect(response, 'attack', 'blitz', 'end_attack_phase', data=True)
+            if action == 'end_attack_phase':
+                return None
+            base = game.country(field(data, 'attacking_country'))
+            target = game.country(field(data, 'defending_country'))
+            check(base.owner == player, '%s is not theirs' % base.name)
+            check(target in base.border_countries and target.owner not in (None, player),
+                  '%s cannot attack %s' % (base.name, target.name))
+            if action == 'blitz':
+                stop_at = check_troops(field(data, 'stop_at', 1), 1, base.troops - 1)
+                moving_troops = field(data, 'moving_troops', None)
+                if moving_troops is not None:
+                    moving_troops = check_troops(moving_troops, 1)
+                return Blitz(base, target, stop_at, moving_troops)
+            attacking_troops = check_troops(field(data, 'attacking_troops'), 1, min(3, base.troops - 1))
+            moving_troops = check_troops(field(data, 'moving_troops'), 0, base.troops - attacking_troops - 1)
+            return base, target, attacking_troops, moving_troops
+        return game.ask(player, ['attack', 'blitz'], parse)
+
+    def reinforce(self, game, player):
+        def parse(response):
+            action, data = game.expect(response, 'reinforce', 'end_turn', data=True)
+            if action == 'end_turn':
+                return None
+            origin = game.country(field(data, 'origin_country'))
+            destination = game.country(field(data, 'destination_country'))
+            check(origin.owner == player and destination.owner == player
+                  and destination in origin.border_countries,
+                  'cannot reinforce %s from %s' % (destination.name, origin.name))
+            return origin, destination, check_troops(field(data, 'moving_troops'), 1, origin.troops - 1)
+        return game.ask(player, ['reinforce'], parse)
+
+
+class Host(Game):
+    """
+        A Game whose players are the bots in `bots`, {player name: url}. Each request must be answered within
+        deadline seconds. The game is sent with an id, so bots can keep a session for it, and a version that
+        goes up with every order.
+    """
+
+    def __init__(self, template, bots, seed=None, max_turns=1000, deadline=DEADLINE, dice=None, game_id=None):
+        self.clients = dict((name, BotClient(url)) for name, url in bots.items())
+        super(Host, self).__init__(template, dict((name, RemotePolicy()) for name in bots), seed, max_turns, dice)
+        self.deadline = deadline
+        self.id = game_id if game_id is not None else uuid.uuid4().hex
+        self.version = 0
+        # two requests a bot: one waited on, and one a bot past its deadline may still be holding
+        self.pool = ThreadPool(2 * len(bots))
+
+    def play(self):
+        try:
+            self.check_status()
+            return super(Host, self).play()
+        finally:
+            self.close()
+
+    def close(self):
+        self.pool.terminate()
+        for client in self.clients.values():
+            client.close()
+
+    def play_turn(self, player):
+        if player.is_neutral:
+            self.turns += 1
+            return
+        super(Host, self).play_turn(player)
+
+    def check_status(self):
+        """
+            Checks every bot's /status at once, and gives an error to each that does not answer in time.
+        """
+        self.gather([(player, self.clients[player.name].status, ()) for player in self.players])
+
+    def changed(self, player):
+        """
+            Sends the game to every player still in it but the one who just gave an order, all at once.
+        """
+        self.version += 1
+        payload = {'game': self.game_json()}
+        self.gather([(other, self.clients[other.name].not_turn, (payload,)) for other in self.players
+                     if other is not player and not other.is_eliminated and not other.is_neutral])
+
+    def gather(self, calls):
+        """
+            Makes calls, a list of (player, client method, arguments), concurrently, and waits for them all up to
+            one deadline. Each call that fails or is still running then costs its player an error.
+        """
+        pending = [(player, self.pool.apply_async(method, args + (self.deadline,))) for player, method, args in calls]
+        end = time.time() + self.deadline
+        for player, result in pending:
+            try:
+                result.get(max(0.0, end - time.time()))
+            except BOT_ERRORS as error:
+                self.penalize(player, error)
+
+    def ask(self, player, actions, parse):
+        """
+            Asks the player's bot for an order, offering available_actions, and returns parse(response). parse
+            raises BotError for an order that is not legal; the bot is then asked again until it gives a legal
+            one in time or the player is neutralized, in which case None is returned.
+
+        :param player:
+        :param actions: the available_actions sent to the bot
+        :param parse: a function from the decoded response to the order
+        :return:
+        """
+        client = self.clients[player.name]
+        while not player.is_neutral:
+            try:
+                response = self.pool.apply_async(client.turn, (self.payload(player, actions), self.deadline))
+                return parse(response.get(self.deadline))
+            except BOT_ERRORS as error:
+                self.penalize(player, error)
+        return None
+
+    def penalize(self, player, error):
+        player.errors += 1
+        player.check_neutralized()
+        LOG.warning('bot_error', game=self.id, player=player.name, error='%s: %s' % (type(error).__name__, error),
+                    errors=player.errors, neutralized=player.is_neutral)
+
+    def expect(self, response, *actions, **kwargs):
+        """
+            The data of a response whose action is one of actions, or (action, data) with data=True.
+        """
+        action = field(response, 'action')
+        check(action in actions, 'expected one of %s, got %r' % (', '.join(actions), action))
+        return (action, response.get('data')) if kwargs.get('data') else field(response, 'data')
+
+    def country(self, name):
+        check(isinstance(name, basestring) and name in self.board.countries, 'no country %r' % (name,))
+        return self.board.countries[name]
+
+    def game_json(self):
+        return game_json(self, self.id, self.version)
+
+    def payload(self, player, actions):
+        """
+            The /turn request for player, offering actions.
+        """
+        return turn_payload(self, player, actions, self.id, self.version)
+
+
+def game_json(game, game_id=None, version=None):
+    """
+        The "game" part of a /turn or /not_turn request for a risk.game Game, with an id and version if given.
+    """
+    data = {'players': [player.name for player in game.players],
+            'countries': dict((name, {'owner': country.owner.name if country.owner is not None else 'none',
+                                      'troops': country.troops})
+                              for name, country in game.board.countries.items())}
+    if game_id is not None:
+        data['id'], data['version'] = game_id, version
+    return data
+
+
+def turn_payload(game, player, actions, game_id=None, version=None):
+    """
+        The /turn request for player in a risk.game Game, offering actions.
+
+    :param game:
+    :param player:
+    :param actions: the available_actions
+    :param game_id:
+    :param version:
+    :return:
+    """
+    return {'you': {'name': player.name,
+                    'earned_cards_this_turn': player.earned_card_this_turn,
+                    'is_eliminated': player.is_eliminated,
+                    'troops_to_deploy': player.troops_to_deploy,
+                    'available_actions': actions,
+                    'countries': sorted(country.name for country in player.countries),
+                    'cards': [{'country_name': card.country_name, 'value': card.value}
+                              for card in sorted(player.cards, key=lambda c: c.country_name)]},
+            'game': game_json(game, game_id, version)}
@@ -0,0 +1,287 @@
+"""
+    The map compiler: checks a map's JSON and turns it into the arrays the engine and the bots work from.
+
+    A map is the JSON import_board_data reads, continents holding countries:
+
+        {"europe": {"bonus": 5,
+                    "countries": {"iceland": {"border countries": ["greenland", ...], "card": "soldier"}, ...}},
+         ...}
+
+    validate() lists everything wrong with one: borders naming unknown countries or the country itself, borders
+    listed one way only, countries in two continents, unknown card types and maps in more than one piece.
+    compile_map() refuses a map with any of these and otherwise returns a CompiledMap: every country gets an id,
+    its index in sorted name order, and borders, cards and continents become arrays indexed by id. Compiling
+    touches each border a constant number of times, so maps of thousands of countries compile in well under a
+    second, and load_map() keeps the result next to the map file, rebuilding it only when the file changes or
+    the kept copy cannot be read.
+
+    generate_map() makes synthetic maps of any size for testing the bots at scale:
+
+        python -m risk.mapcompiler generate 5000 big_map.json [seed]
+        python -m risk.mapcompiler check big_map.json
+"""
+import os
+import sys
+import json
+import random
+import hashlib
+import tempfile
+import numpy as np
+
+CARD_VALUES = ('cannon', 'horse', 'soldier')
+COMPILED_SUFFIX = '.compiled.npz'
+
+
+class MapError(ValueError):
+    """
+        A map that does not validate. problems lists what is wrong with it.
+    """
+
+    def __init__(self, problems):
+        super(MapError, self).__init__('invalid map:\n  ' + '\n  '.join(problems))
+        self.problems = problems
+
+
+class CompiledMap(object):
+    """
+        A validated map as arrays indexed by country id. The borders of country i are
+        indices[indptr[i]:indptr[i + 1]], in the order the map lists them; continent[i] is the index of its
+        continent in continent_names. source_hash identifies the JSON it was compiled from.
+    """
+    __slots__ = ('names', 'cards', 'indptr', 'indices', 'continent', 'continent_names', 'continent_bonus',
+                 'source_hash')
+
+    def __init__(self, names, cards, indptr, indices, continent, continent_names, continent_bonus, source_hash):
+        self.names = tuple(names)
+        self.cards = tuple(cards)
+        self.indptr = np.asarray(indptr, dtype=np.int32)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.continent = np.asarray(continent, dtype=np.int32)
+        self.continent_names = tuple(continent_names)
+        self.continent_bonus = np.asarray(continent_bonus, dtype=np.int32)
+        self.source_hash = source_hash
+
+    def __len__(self):
+        return len(self.names)
+
+    def borders(self, country):
+        return self.indices[self.indptr[country]:self.indptr[country + 1]]
+
+    def members(self):
+        """
+            The ids of each continent's countries, in continent_names order.
+        """
+        order = np.argsort(self.continent, kind='mergesort')
+        return np.split(order, np.cumsum(np.bincount(self.continent, minlength=len(self.continent_names)))[:-1])
+
+    def save(self, path):
+        np.savez(path, names=np.array(self.names, dtype=np.unicode_), cards=np.array(self.cards, dtype=np.unicode_),
+                 indptr=self.indptr, indices=self.indices, continent=self.continent,
+                 continent_names=np.array(self.continent_names, dtype=np.unicode_),
+                 continent_bonus=self.continent_bonus, source_hash=np.array(self.source_hash))
+
+    @classmethod
+    def load(cls, path):
+        arrays = np.load(path)
+        try:
+            return cls(arrays['names'].tolist(), arrays['cards'].tolist(), arrays['indptr'], arrays['indices'],
+                       arrays['continent'], arrays['continent_names'].tolist(), arrays['continent_bonus'],
+                       str(arrays['source_hash']))
+        finally:
+            arrays.close()
+
+
+def validate(data):
+    """
+        Returns a list of what is wrong with the map JSON data, empty if it is a valid map.
+
+    :param data: the decoded JSON
+    :return:
+    """
+    problems = []
+    if not isinstance(data, dict) or not data:
+        return ['a map is an object of continents']
+    countries = {}
+    for continent_name, continent in sorted(data.items()):
+        if not isinstance(continent, dict) or not isinstance(continent.get('countries'), dict):
+            problems.append('continent %s has no countries object' % continent_name)
+            continue
+        bonus = continent.get('bonus')
+        if not isinstance(bonus, (int, long)) or isinstance(bonus, bool) or bonus < 0:
+            problems.append('continent %s has bonus %r, not a whole number of troops' % (continent_name, bonus))
+        if not continent['countries']:
+            problems.append('continent %s has no countries' % continent_name)
+        for country_name, country in sorted(continent['countries'].items()):
+            if country_name in countries:
+                problems.append('%s is in both %s and %s' % (country_name, countries[country_name][0],
+                                                             continent_name))
+                continue
+            if not isinstance(country, dict) or not isinstance(country.get('border countries'), list):
+                problems.append('%s has no border countries list' % country_name)
+                continue
+            if country.get('card') not in CARD_VALUES:
+                problems.append('%s has card %r, not one of %s' % (country_name, country.get('card'),
+                                                                   ', '.join(CARD_VALUES)))
+            countries[country_name] = (continent_name, country['border countries'])
+    for country_name, (_, borders) in sorted(countries.items()):
+        if len(set(borders)) != len(borders):
+            problems.append('%s lists a border more than once' % country_name)
+        for border in borders:
+            if border == country_name:
+                problems.append('%s borders itself' % country_name)
+            elif border not in countries:
+                problems.append('%s borders %r, which is not a country' % (country_name, border))
+            elif country_name not in countries[border][1]:
+                problems.append('%s borders %s, but not the other way round' % (country_name, border))
+    if countries and not problems:
+        start = min(countries)
+        reached, frontier = set([start]), [start]
+        while frontier:
+            for border in countries[frontier.pop()][1]:
+                if border not in reached:
+                    reached.add(border)
+                    frontier.append(border)
+        if len(reached) != len(countries):
+            problems.append('the map is in pieces: %d of %d countries cannot be reached from %s' %
+                            (len(countries) - len(reached), len(countries), start))
+    return problems
+
+
+def compile_map(data, source_hash=None):
+    """
+        Compiles map JSON data, raising MapError if it does not validate.
+
+    :param data: the decoded JSON
+    :param source_hash: kept in the CompiledMap, to tell whether it is still current
+    :return: a CompiledMap
+    """
+    problems = validate(data)
+    if problems:
+        raise MapError(problems)
+    continent_names = sorted(data)
+    entries = dict((country_name, (c, country)) for c, continent_name in enumerate(continent_names)
+                   for country_name, country in data[continent_name]['countries'].items())
+    names = sorted(entries)
+    index = dict((name, i) for i, name in enumerate(names))
+    indptr, indices = [0], []
+    for name in names:
+        indices.extend(index[border] for border in entries[name][1]['border countries'])
+        indptr.append(len(indices))
+    return CompiledMap(names, [entries[name][1]['card'] for name in names], indptr, indices,
+                       [entries[name][0] for name in names], continent_names,
+                       [data[name]['bonus'] for name in continent_names], source_hash)
+
+
+def load_map(path, cache=True):
+    """
+        The CompiledMap of the map file at path. With cache, the compiled map is kept in a file next to it and
+        reused while the map file's contents are unchanged; a cache that cannot be written is skipped.
+
+    :param path:
+    :param cache:
+    :return:
+    """
+    with open(path, 'rb') as f:
+        source = f.read()
+    source_hash = hashlib.sha1(source).hexdigest()
+    compiled_path = path + COMPILED_SUFFIX
+    if cache and os.path.exists(compiled_path):
+        try:
+            compiled = CompiledMap.load(compiled_path)
+            if compiled.source_hash == source_hash:
+                return compiled
+        except Exception:
+            # a cache that cannot be read, whatever numpy or zipfile makes of it, is rebuilt
+            pass
+    compiled = compile_map(json.loads(source), source_hash)
+    if cache:
+        save_atomically(compiled, compiled_path)
+    return compiled
+
+
+def save_atomically(compiled, path):
+    """
+        Saves compiled to path by way of a temporary file in the same directory renamed over it, so readers
+        only ever see a whole file, even with several processes compiling at once. Returns whether it was saved.
+
+    :param compiled: a CompiledMap
+    :param path:
+    :return:
+    """
+    try:
+        fd, temp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', dir=os.path.dirname(path) or '.')
+    except (IOError, OSError):
+        return False
+    try:
+        # np.savez adds .npz to names that lack it, so it is given a file object instead
+        with os.fdopen(fd, 'wb') as f:
+            compiled.save(f)
+        # mkstemp makes the file readable by its owner alone
+        os.chmod(temp_path, 0o644)
+        os.rename(temp_path, path)
+        return True
+    except (IOError, OSError):
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        return False
+
+
+def generate_map(countries, seed=0, continent_side=3):
+    """
+        A synthetic map of `countries` countries, as JSON data. Countries fill a square grid row by row, each
+        bordering the ones beside, above and below it and, at random, one of its lower diagonals, so every
+        country has from 2 to 7 borders and the map is in one piece. Continents are continent_side by
+        continent_side blocks of the grid, worth half their size in troops, and cards cycle through the types.
+
+    :param countries:
+    :param seed:
+    :param continent_side:
+    :return:
+    """
+    rng = random.Random(seed)
+    side = int(np.ceil(countries ** 0.5))
+    cells = [(i % side, i // side) for i in range(countries)]
+    names = dict((cell, 't%d_%d' % cell) for cell in cells)
+    borders = dict((name, []) for name in names.values())
+    for x, y in cells:
+        for dx, dy in ((1, 0), (0, 1), rng.choice(((1, 1), (-1, 1)))):
+            other = names.get((x + dx, y + dy))
+            if other is not None:
+                borders[names[(x, y)]].append(other)
+                borders[other].append(names[(x, y)])
+    data = {}
+    for i, (x, y) in enumerate(cells):
+        continent_name = 'k%d_%d' % (x // continent_side, y // continent_side)
+        continent = data.setdefault(continent_name, {'bonus': 0, 'countries': {}})
+        continent['countries'][names[(x, y)]] = {'border countries': sorted(borders[names[(x, y)]]),
+                                                 'card': CARD_VALUES[i % len(CARD_VALUES)]}
+    for continent in data.values():
+        continent['bonus'] = max(1, len(continent['countries']) // 2)
+    return data
+
+
+def main(argv):
+    if argv[:1] == ['generate']:
+        data = generate_map(int(argv[1]), int(argv[3]) if len(argv) > 3 else 0)
+        with open(argv[2], 'w') as f:
+            json.dump(data, f, indent=1, sort_keys=True, separators=(',', ': '))
+        print 'wrote %d countries in %d continents to %s' % (int(argv[1]), len(data), argv[2])
+    elif argv[:1] == ['check']:
+        with open(argv[1]) as f:
+            problems = validate(json.load(f))
+        if problems:
+            print '\n'.join(problems)
+            return 1
+        compiled = load_map(argv[1])
+        print '%s: %d countries, %d borders, %d continents' % (argv[1], len(compiled), len(compiled.indices) // 2,
+                                                              len(compiled.continent_names))
+    else:
+        print 'usage: python -m risk.mapcompiler generate <countries> <path> [seed] | check <path>'
+        return 2
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,183 @@
+"""
+    Latency metrics for /turn: histograms of how long each stage of a request took, by the phase of the turn it
+    was for (choose_country, spend_cards, deploy_troops, attack or reinforce).
+
+    The app times its own stages (parse, unpack_json, decide, serialize and the whole request) and strategy
+    functions are wrapped with METRICS.timed(stage). A timed function only records while a request is being
+    answered on its thread, so the same functions run at full speed in simulations and tournaments.
+    exposition() renders every histogram in the Prometheus text format, for the app's /metrics endpoint.
+
+    cache_exposition() renders hit, miss and size counts of LRU caches in the same format, so /metrics also
+    shows how well the evaluation cache and the session and plan caches are doing.
+
+    PROFILE captures one request with cProfile when armed: the next request run through PROFILE.run is
+    profiled and its stats dumped to a file in PROFILE_DIR, which pstats can read. The app only lets it be
+    armed over HTTP when PROFILE_ENDPOINT=1 is in the environment.
+"""
+import os
+import time
+import bisect
+import cProfile
+import tempfile
+import threading
+import functools
+from contextlib import contextmanager
+from risk.decisionlog import LOG
+
+# upper bounds, in milliseconds, of every bucket but the last, which takes everything slower
+BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+PHASES = ('choose_country', 'spend_cards', 'deploy_troops', 'attack', 'reinforce')
+PROFILE_DIR = os.environ.get('PROFILE_DIR', tempfile.gettempdir())
+PROFILE_ENDPOINT = os.environ.get('PROFILE_ENDPOINT', '0') == '1'
+
+
+def phase_of(available_actions):
+    """
+        The phase a request is for: the first of PHASES offered, as that is the one the app answers, or
+        'other'.
+    """
+    for phase in PHASES:
+        if phase in available_actions:
+            return phase
+    return 'other'
+
+
+class Histogram(object):
+    """
+        Counts of observed latencies per bucket of BUCKETS_MS, with their number and sum.
+    """
+    __slots__ = ('counts', 'count', 'total')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS_MS) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, ms):
+        self.counts[bisect.bisect_left(BUCKETS_MS, ms)] += 1
+        self.count += 1
+        self.total += ms
+
+
+class Metrics(object):
+    """
+        Histograms by (phase, stage), and the phase of the request each thread is answering.
+    """
+
+    def __init__(self):
+        self.histograms = {}
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def request(self, phase):
+        """
+            Marks this thread as answering a request for phase, so timed functions record under it.
+        """
+        self.local.phase = phase
+        try:
+            yield
+        finally:
+            self.local.phase = None
+
+    def observe(self, phase, stage, ms):
+        with self.lock:
+            histogram = self.histograms.get((phase, stage))
+            if histogram is None:
+                histogram = self.histograms[(phase, stage)] = Histogram()
+            histogram.observe(ms)
+
+    def timed(self, stage):
+        """
+            A decorator recording how long each call of a function takes as stage, when made while answering a
+            request.
+        """
+        def decorate(function):
+            @functools.wraps(function)
+            def timed_function(*args, **kwargs):
+                phase = getattr(self.local, 'phase', None)
+                if phase is None:
+                    return function(*args, **kwargs)
+                start = time.time()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.observe(phase, stage, 1000 * (time.time() - start))
+            return timed_function
+        return decorate
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+
+    def exposition(self, name='turn_latency_ms'):
+        """
+            Every histogram in the Prometheus text format, as one metric family labelled by phase and stage.
+        """
+        lines = ['# HELP %s Latency of each stage of a /turn request, by phase, in milliseconds.' % name,
+                 '# TYPE %s histogram' % name]
+        with self.lock:
+            histograms = sorted((key, list(h.counts), h.count, h.total) for key, h in self.histograms.items())
+        for (phase, stage), counts, count, total in histograms:
+            labels = 'phase="%s",stage="%s"' % (phase, stage)
+            cumulative = 0
+            for bound, bucket in zip(BUCKETS_MS + ('+Inf',), counts):
+                cumulative += bucket
+                lines.append('%s_bucket{%s,le="%s"} %d' % (name, labels, bound, cumulative))
+            lines.append('%s_sum{%s} %.3f' % (name, labels, total))
+            lines.append('%s_count{%s} %d' % (name, labels, count))
+        return '\n'.join(lines) + '\n'
+
+
+def cache_exposition(caches, name='cache'):
+    """
+        The stats of risk.cache LRUCaches, given as {label: cache}, in the Prometheus text format: hits and
+        misses as counters, and the number of entries held and allowed as gauges.
+    """
+    lines = []
+    stats = sorted((label, cache.stats()) for label, cache in caches.items())
+    for metric, field, kind, help in (('hits_total', 'hits', 'counter', 'Lookups that found an entry.'),
+                                      ('misses_total', 'misses', 'counter', 'Lookups that found nothing.'),
+                                      ('entries', 'size', 'gauge', 'Entries held.'),
+                                      ('max_entries', 'maxsize', 'gauge', 'Entries held before evicting.')):
+        lines.append('# HELP %s_%s %s' % (name, metric, help))
+        lines.append('# TYPE %s_%s %s' % (name, metric, kind))
+        for label, values in stats:
+            lines.append('%s_%s{cache="%s"} %d' % (name, metric, label, values[field]))
+    return '\n'.join(lines) + '\n'
+
+
+class OneShotProfile(object):
+    """
+        Profiles the next call of run() after arm(), and only that one. The file written is logged, and kept
+        in last_path.
+    """
+
+    def __init__(self, directory=PROFILE_DIR):
+        self.directory = directory
+        self.armed = False
+        self.last_path = None
+        self.lock = threading.Lock()
+
+    def arm(self):
+        self.armed = True
+
+    def run(self, function, *args):
+        """
+            Returns function(*args), profiling the call and dumping its stats to a new file if armed.
+        """
+        with self.lock:
+            armed, self.armed = self.armed, False
+        if not armed:
+            return function(*args)
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(function, *args)
+        finally:
+            self.last_path = os.path.join(self.directory, 'turn-%d-%d.prof' % (os.getpid(), int(time.time() * 1000)))
+            profile.dump_stats(self.last_path)
+            LOG.info('profile', path=self.last_path)
+
+
+METRICS = Metrics()
+PROFILE = OneShotProfile()
@@ -1,15 +1,55 @@
 import random
 import json
 import itertools
+from risk.dice import DICE
+from risk.cards import Hand
+from risk.zobrist import BoardHash
 
 class Country(object):
     def __init__(self, name, border_countries):
-        self.border_countries = border_countries
-        self.name = name
-        self.owner = None
-        self.troops = 0
-
-    def attack(self, country, attacking_troops, moving_troops):
+        # straight into the instance, as there is nothing to keep in step yet (see __setattr__)
+        self.__dict__.update(border_countries=border_countries, name=name, owner=None, troops=0, ownership=None,
+                             hashing=None)
+
+    def __setattr__(self, name, value):
+        # assigning troops or owner goes through the setters, so nothing can leave the hash or index behind;
+        # reads stay plain attribute lookups, which the hot paths make far more of than writes
+        if name == 'troops':
+            self.set_troops(value)
+        elif name == 'owner':
+            self.set_owner(value)
+        else:
+            object.__setattr__(self, name, value)
+
+    def set_troops(self, troops):
+        """
+            Sets the country's troops, keeping the board's Zobrist hash in step. Assigning to troops does the same.
+        """
+        if self.hashing is not None:
+            self.hashing.changed(self, self.owner, self.troops, self.owner, troops)
+        self.__dict__['troops'] = troops
+
+    def set_owner(self, owner):
+        """
+            Hands the country to owner, or to no one, keeping both owners' countries, the board's Ownership
+            index and its Zobrist hash in step. Assigning to owner does the same.
+        """
+        previous = self.owner
+        if previous is not None:
+            previous.countries.discard(self)
+        self.__dict__['owner'] = owner
+        if owner is not None:
+            owner.countries.add(self)
+        if self.ownership is not None:
+            self.ownership.moved(self, previous)
+        if self.hashing is not None:
+            self.hashing.changed(self, previous, self.troops, owner, self.troops)
+
+    def attack(self, country, attacking_troops, moving_troops, dice=None):
+        """
+            Rolls once against country, with dice (a source from risk.dice, fair dice by default), and moves in
+            if it falls. Returns whether it fell.
+        """
         assert country in self.border_countries
         assert country.owner is not None
         assert country.owner is not self.owner
@@ -33,24 +73,49 @@ class Country(object):
         else:
             raise NameError('attacking country has no troops')
 
-        defending_rolls = sorted([random.randint(1, 6) for i in range(defending_die)],
-                                 reverse=True)
-        attacking_rolls = sorted([random.randint(1, 6) for i in range(attacking_die)],
-                                 reverse=True)
+        attacker_loss, defender_loss = (dice or DICE).roll(attacking_die, defending_die)
+        country.set_troops(country.troops - defender_loss)
+        self.set_troops(self.troops - attacker_loss)
+        attacking_troops -= attacker_loss  # Kept track in case of invasion
+
+        if country.troops == 0:
+            country.set_owner(self.owner)
+            country.set_troops(attacking_troops + moving_troops)
+            self.set_troops(self.troops - (attacking_troops + moving_troops))
+            return True
+        return False
+
+    def blitz(self, country, stop_at=1, moving_troops=None, dice=None):
+        """
+            Attacks country until it falls or this country is down to stop_at troops, resolved in one step: the
+            troops above stop_at fight the whole battle, rolling as many dice as they can each time, and the
+            result is drawn from its exact distribution with dice (fair dice by default). If country falls, the
+            survivors move in, or moving_troops if given (at least one, and leaving at least one behind).
+            Returns whether it fell.
+
+        :param country:
+        :param stop_at:
+        :param moving_troops:
+        :param dice:
+        :return:
+        """
+        assert country in self.border_countries
+        assert country.owner is not None
+        assert country.owner is not self.owner
+        assert country.troops > 0
+        assert 1 <= stop_at < self.troops
 
-        for i in range(min(defending_die, attacking_die)):
-            if attacking_rolls[i] > defending_rolls[i]:
-                country.troops -= 1
-            else:
-                self.troops -= 1
-                attacking_troops -= 1  # Kept track in case of invasion
+        attackers = self.troops - stop_at
+        attacker_loss, defender_loss = (dice or DICE).battle(attackers, country.troops)
+        self.set_troops(self.troops - attacker_loss)
+        country.set_troops(country.troops - defender_loss)
 
         if country.troops == 0:
-            country.owner.countries.remove(country)
-            self.owner.countries.add(country)
-            country.owner = self.owner
-            country.troops = attacking_troops + moving_troops
-            self.troops -= (attacking_troops + moving_troops)
+            survivors = attackers - attacker_loss
+            moving_troops = survivors if moving_troops is None else max(1, min(moving_troops, self.troops - 1))
+            country.set_owner(self.owner)
+            country.set_troops(moving_troops)
+            self.set_troops(self.troops - moving_troops)
             return True
         return False
 
@@ -60,9 +125,8 @@ class Country(object):
         assert troops > 0
 
         if(self.owner is None):
-            self.owner = owner
-            self.owner.countries.add(self)
-        self.troops += troops
+            self.set_owner(owner)
+        self.set_troops(self.troops + troops)
 
     def __hash__(self):
         return hash(self.name)
@@ -76,6 +140,7 @@ class Continent(object):
         self.name = name
         self.countries = {}
         self.bonus = bonus
+        self.ownership = None
 
     def get_country_set(self):
         return set([country for country in self.countries])
@@ -87,6 +152,8 @@ class Continent(object):
         return isinstance(other, Continent) and self.name == other.name
 
     def get_player_set(self):
+        if self.ownership is not None:
+            return self.ownership.owners_in(self)
         keys = self.countries.keys()
         return set([self.countries[key].owner for key in keys])
 
@@ -96,6 +163,166 @@ class Board(object):
         self.continents = {}
         self.countries = {}
         self.cards = {}
+        self._ownership = None
+        self._hash = None
+
+    @property
+    def ownership(self):
+        """
+            The board's Ownership index, built from the owners its countries have when first asked for and kept
+            current by Country.set_owner from then on. Loading a whole position before that costs no index
+            updates at all.
+        """
+        if self._ownership is None:
+            self._ownership = Ownership(self)
+        return self._ownership
+
+    def zobrist_hash(self, keys):
+        """
+            The board's Zobrist hash under keys, a risk.zobrist.ZobristKeys. Worked out in full the first time
+            it is asked for with these keys, and kept current by Country.set_owner and Country.set_troops from
+            then on, so later calls cost nothing however much has happened on the board.
+        """
+        if self._hash is None or self._hash.keys is not keys:
+            self._hash = BoardHash(keys, self)
+            for country in self.countries.values():
+                country.hashing = self._hash
+        return self._hash.value
+
+
+class Ownership(object):
+    """
+        Who owns what on one board, kept current as countries change hands: the countries of each owner (None
+        for the unowned ones), how many countries of each continent each owner holds and who holds every one of
+        them, and each owner's frontier, the countries they own that border a country they do not.
+
+        A change of owner updates a constant number of sets and counts for the country and each of its borders,
+        and every query below is answered from those without looking at the rest of the board. A frontier is
+        only built, from the owner's countries, the first time it is asked for, so an index that is built for
+        one request and dropped costs no more than the scans it replaces. The sets returned are the index's own
+        and must not be changed.
+    """
+
+    def __init__(self, board):
+        self.continent_of = {}
+        self.owned = {None: set()}
+        self.held = {}
+        self.controllers = {}
+        self.controlled = {}
+        self.frontiers = {}
+        for continent in board.continents.values():
+            continent.ownership = self
+            members = {}
+            for country in continent.countries.values():
+                country.ownership = self
+                self.continent_of[country.name] = continent
+                group = members.get(country.owner)
+                if group is None:
+                    members[country.owner] = [country]
+                else:
+                    group.append(country)
+            self.held[continent.name] = dict((owner, len(countries)) for owner, countries in members.items())
+            for owner, countries in members.items():
+                self.owned.setdefault(owner, set()).update(countries)
+                if owner is not None and len(countries) == len(continent.countries):
+                    self.controllers[continent.name] = owner
+                    self.controlled.setdefault(owner, set()).add(continent)
+
+    def countries(self, owner):
+        return self.owned.get(owner, frozenset())
+
+    def owners(self):
+        """
+            Everyone who owns at least one country.
+        """
+        return set(owner for owner, countries in self.owned.items() if owner is not None and countries)
+
+    def continent(self, country):
+        return self.continent_of[country.name]
+
+    def held_in(self, owner, continent):
+        """
+            How many of continent's countries owner holds.
+        """
+        return self.held[continent.name].get(owner, 0)
+
+    def owners_in(self, continent):
+        return set(owner for owner, n in self.held[continent.name].items() if n)
+
+    def controller(self, continent):
+        """
+            The owner holding every country of continent, or None.
+        """
+        return self.controllers.get(continent.name)
+
+    def controls(self, owner, continent):
+        return owner is not None and self.controllers.get(continent.name) == owner
+
+    def continents_controlled(self, owner):
+        """
+            The continents owner holds outright.
+        """
+        return self.controlled.get(owner, frozenset())
+
+    def frontier(self, owner):
+        """
+            owner's countries with at least one border they do not own.
+        """
+        if owner is None:
+            return frozenset()
+        frontier = self.frontiers.get(owner)
+        if frontier is None:
+            frontier = self.frontiers[owner] = set(country for country in self.owned.get(owner, ())
+                                                   if on_frontier(country))
+        return frontier
+
+    def moved(self, country, previous):
+        """
+            Brings the index up to date after country passed from previous to its current owner.
+
+        :param country:
+        :param previous:
+        """
+        owner = country.owner
+        if owner == previous:
+            return
+        self.owned[previous].discard(country)
+        self.owned.setdefault(owner, set()).add(country)
+        continent = self.continent_of[country.name]
+        held = self.held[continent.name]
+        if previous is not None and held[previous] == len(continent.countries):
+            del self.controllers[continent.name]
+            self.controlled[previous].discard(continent)
+        held[previous] -= 1
+        held[owner] = held.get(owner, 0) + 1
+        if owner is not None and held[owner] == len(continent.countries):
+            self.controllers[continent.name] = owner
+            self.controlled.setdefault(owner, set()).add(continent)
+        if previous in self.frontiers:
+            self.frontiers[previous].discard(country)
+        # only the country and its borders can have crossed a frontier
+        self._place_on_frontier(country)
+        for border in country.border_countries:
+            self._place_on_frontier(border)
+
+    def _place_on_frontier(self, country):
+        frontier = self.frontiers.get(country.owner)
+        if frontier is None:
+            return
+        if on_frontier(country):
+            frontier.add(country)
+        else:
+            frontier.discard(country)
+
+
+def on_frontier(country):
+    """
+        Whether country borders a country its owner does not own.
+    """
+    for border in country.border_countries:
+        if border.owner != country.owner:
+            return True
+    return False
 
 
 class Card(object):
@@ -107,14 +334,15 @@ class Card(object):
         assert card_two is not None
         assert card_three is not None
         wild_cards = [card for card in [self, card_two, card_three] if card.value == 'wild']
-        return (len(wild_cards) >= 1) or (self.value == card_two.value == card_three.value) or (self.value != card_two.value != card_three.value)
+        return (len(wild_cards) >= 1) or (self.value == card_two.value == card_three.value) or \
+            (len(set([self.value, card_two.value, card_three.value])) == 3)
 
 
 class Player(object):
 
     def __init__(self, name):
         self.name = name
-        self.cards = set()
+        self.cards = Hand()
         self.is_eliminated = False
         self.is_neutral = False
         self.countries = set()
@@ -130,16 +358,31 @@ class Player(object):
     def deploy_troops(self, country, troops):
         country.add_troops(self,troops)
 
+    def reinforce(self, origin, destination, troops):
+        assert origin.owner == self
+        assert destination.owner == self
+        assert destination in origin.border_countries
+        assert 0 < troops < origin.troops
+
+        origin.set_troops(origin.troops - troops)
+        destination.set_troops(destination.troops + troops)
+
     def check_neutralized(self):
         if self.errors >= 3:
             self.is_neutral = True
 
     def has_card_set(self):
-        combos = itertools.combinations(self.cards, 3)
-        for potential_set in combos:
-            if potential_set[0].is_set_with(potential_set[1], potential_set[2]):
-                return True
-        return False
+        return self.cards.has_set()
+
+    def best_card_set(self, board):
+        """
+            The set of cards to trade in (see risk.cards.Hand.best_set), or None if the player holds no set.
+
+        :param board: the board the player's countries are on
+        :return:
+        """
+        countries = board.countries
+        return self.cards.best_set(lambda name: name in countries and countries[name].owner == self)
 
     def get_country_choice(self):
         pass
@@ -0,0 +1,167 @@
+"""
+    Reversible moves on a CompactState.
+
+    A MoveLog applies deploy, attack, reinforce and card trade-in moves to its state in place and records an
+    undo entry for each, so unmake() puts the state back exactly as it was. A search can then walk a tree of
+    moves on a single state instead of cloning one per node.
+
+    Given ZobristKeys, a MoveLog also keeps the state's Zobrist hash current, updating it per country touched.
+
+    Attacks take their battle outcome as given (attacker and defender losses), so a search decides which dice
+    results to explore. Eliminated players keep their cards, as nothing in a short lookahead depends on them.
+"""
+from risk.state import NO_OWNER
+from risk.cards import is_set
+from risk.game import trade_value, OWNED_CARD_BONUS
+
+DEPLOY, ATTACK, REINFORCE, TRADE_IN = range(4)
+
+
+class MoveLog(object):
+    """
+        Applies moves to a CompactState and keeps the undo entries to take them back, most recent last. With
+        keys, `hash` is the state's Zobrist hash under them.
+    """
+    __slots__ = ('state', 'undo', 'keys', 'hash', 'hashes')
+
+    def __init__(self, state, keys=None):
+        self.state = state
+        self.undo = []
+        self.keys = keys
+        self.hash = keys.state_hash(state) if keys is not None else None
+        self.hashes = []
+
+    def _rehash(self, *touched):
+        """
+            Updates the hash for countries given as (country, owner, troops) before the move just applied.
+        """
+        self.hashes.append(self.hash)
+        if self.keys is not None:
+            state = self.state
+            for country, owner, troops in touched:
+                self.hash = self.keys.update(self.hash, country, owner, troops,
+                                             int(state.owner[country]), int(state.troops[country]))
+
+    def __len__(self):
+        return len(self.undo)
+
+    def deploy(self, player, country, troops):
+        state = self.state
+        assert state.owner[country] == player
+        assert 0 < troops <= state.reserve[player]
+        touched = (country, player, int(state.troops[country]))
+        state.troops[country] += troops
+        state.reserve[player] -= troops
+        self.undo.append((DEPLOY, player, country, troops))
+        self._rehash(touched)
+
+    def attack(self, base, target, attacker_loss, defender_loss, moving_troops=0):
+        """
+            Applies one battle outcome. If the defender is wiped out, the attacker takes the country and moves
+            moving_troops troops into it.
+
+        :param base:
+        :param target:
+        :param attacker_loss:
+        :param defender_loss:
+        :param moving_troops:
+        :return: whether the country was conquered
+        """
+        state = self.state
+        defender = state.owner[target]
+        assert defender != state.owner[base] and defender != NO_OWNER
+        assert 0 <= attacker_loss < state.troops[base]
+        assert 0 <= defender_loss <= state.troops[target]
+        touched = ((base, int(state.owner[base]), int(state.troops[base])),
+                   (target, int(defender), int(state.troops[target])))
+        state.troops[base] -= attacker_loss
+        state.troops[target] -= defender_loss
+        conquered = bool(state.troops[target] == 0)
+        if conquered:
+            assert 0 < moving_troops < state.troops[base]
+            state.owner[target] = state.owner[base]
+            state.troops[base] -= moving_troops
+            state.troops[target] = moving_troops
+        else:
+            moving_troops = 0
+        self.undo.append((ATTACK, base, target, attacker_loss, defender_loss, moving_troops, defender))
+        self._rehash(*touched)
+        return conquered
+
+    def reinforce(self, origin, destination, troops):
+        state = self.state
+        assert state.owner[origin] == state.owner[destination] != NO_OWNER
+        assert 0 < troops < state.troops[origin]
+        owner = int(state.owner[origin])
+        touched = ((origin, owner, int(state.troops[origin])), (destination, owner, int(state.troops[destination])))
+        state.troops[origin] -= troops
+        state.troops[destination] += troops
+        self.undo.append((REINFORCE, origin, destination, troops))
+        self._rehash(*touched)
+
+    def trade_in(self, player, types, bonus_country=None):
+        """
+            Trades in three cards, given as indices into CARD_TYPES, for the next set's troops. bonus_country,
+            if given, is a country the player owns named on one of the cards, which gets OWNED_CARD_BONUS
+            troops.
+
+        :param player:
+        :param types:
+        :param bonus_country:
+        """
+        state = self.state
+        assert is_set(types)
+        assert all(state.cards[player, t] >= types.count(t) for t in types)
+        assert bonus_country is None or state.owner[bonus_country] == player
+        troops = trade_value(state.sets_traded)
+        touched = [] if bonus_country is None else [(bonus_country, player, int(state.troops[bonus_country]))]
+        for t in types:
+            state.cards[player, t] -= 1
+        state.reserve[player] += troops
+        state.sets_traded += 1
+        if bonus_country is not None:
+            state.troops[bonus_country] += OWNED_CARD_BONUS
+        self.undo.append((TRADE_IN, player, types, bonus_country, troops))
+        self._rehash(*touched)
+
+    def unmake(self):
+        """
+            Takes back the most recent move.
+        """
+        state = self.state
+        entry = self.undo.pop()
+        self.hash = self.hashes.pop()
+        kind = entry[0]
+        if kind == DEPLOY:
+            _, player, country, troops = entry
+            state.troops[country] -= troops
+            state.reserve[player] += troops
+        elif kind == ATTACK:
+            _, base, target, attacker_loss, defender_loss, moving_troops, defender = entry
+            if moving_troops:
+                state.owner[target] = defender
+                state.troops[base] += moving_troops
+                state.troops[target] = 0
+            state.troops[base] += attacker_loss
+            state.troops[target] += defender_loss
+        elif kind == REINFORCE:
+            _, origin, destination, troops = entry
+            state.troops[origin] += troops
+            state.troops[destination] -= troops
+        else:
+            _, player, types, bonus_country, troops = entry
+            for t in types:
+                state.cards[player, t] += 1
+            state.reserve[player] -= troops
+            state.sets_traded -= 1
+            if bonus_country is not None:
+                state.troops[bonus_country] -= OWNED_CARD_BONUS
+
+    def unmake_to(self, mark):
+        """
+            Takes back moves until only `mark` remain, e.g. a length saved before a search branch.
+
+        :param mark:
+        """
+        while len(self.undo) > mark:
+            self.unmake()
@@ -0,0 +1,152 @@
+"""
+    A compact, array-backed game state for search and simulation.
+
+    The fixed part of a map lives in a CompactMap, taken once per BoardTemplate from its compiled map: country
+    ids, a CSR border array and continent membership. A CompactState is only the owner and troop count of
+    every country, as flat integer arrays indexed by country id, plus each player's troops to deploy and cards
+    held per type, so cloning one for lookahead is a few small array copies.
+"""
+import numpy as np
+
+from risk.cards import CARD_TYPES, TYPE_INDEX
+
+NO_OWNER = -1
+
+
+class CompactMap(object):
+    """
+        Country ids, CSR borders and continents of one map. The borders of country i are
+        indices[indptr[i]:indptr[i + 1]], and (sources, indices) lists every border as a directed pair.
+    """
+    __slots__ = ('names', 'index', 'indptr', 'indices', 'sources', 'continent', 'continent_names',
+                 'continent_bonus', 'continent_size')
+
+    def __init__(self, template):
+        compiled = template.compiled
+        self.names = template.country_names
+        self.index = template.country_index
+        self.indptr = compiled.indptr
+        self.indices = compiled.indices
+        self.sources = np.repeat(np.arange(len(self.names), dtype=np.int32), np.diff(self.indptr))
+        self.continent_names = compiled.continent_names
+        self.continent_bonus = compiled.continent_bonus
+        self.continent = compiled.continent
+        self.continent_size = np.bincount(self.continent, minlength=len(self.continent_names))
+
+    def __len__(self):
+        return len(self.names)
+
+    def borders(self, country):
+        return self.indices[self.indptr[country]:self.indptr[country + 1]]
+
+
+_maps = {}
+
+
+def compact_map(template):
+    """
+        Returns the CompactMap of a BoardTemplate, building it the first time it is asked for.
+
+    :param template:
+    :return:
+    """
+    if template not in _maps:
+        _maps[template] = CompactMap(template)
+    return _maps[template]
+
+
+class CompactState(object):
+    """
+        Owner and troops of every country on a CompactMap. Owners are positions in `players`, a tuple of player
+        names, or NO_OWNER. reserve holds each player's troops to deploy and cards[player] their card counts in
+        CARD_TYPES order.
+    """
+    __slots__ = ('map', 'players', 'owner', 'troops', 'reserve', 'cards', 'sets_traded')
+
+    def __init__(self, map, players, owner=None, troops=None, reserve=None, cards=None, sets_traded=0):
+        self.map = map
+        self.players = tuple(players)
+        self.owner = np.empty(len(map), dtype=np.int8) if owner is None else owner
+        self.troops = np.zeros(len(map), dtype=np.int32) if troops is None else troops
+        self.reserve = np.zeros(len(self.players), dtype=np.int32) if reserve is None else reserve
+        self.cards = np.zeros((len(self.players), len(CARD_TYPES)), dtype=np.int32) if cards is None else cards
+        self.sets_traded = sets_traded
+        if owner is None:
+            self.owner.fill(NO_OWNER)
+
+    def clone(self):
+        return CompactState(self.map, self.players, self.owner.copy(), self.troops.copy(), self.reserve.copy(),
+                            self.cards.copy(), self.sets_traded)
+
+    @classmethod
+    def from_board(cls, map, board, players):
+        """
+            Reads owners and troops from a risk.models Board. players is the list of player names, in the
+            order their positions should take, or the Player objects themselves to also read their troops to
+            deploy and cards.
+
+        :param map:
+        :param board:
+        :param players:
+        :return:
+        """
+        state = cls(map, [getattr(player, 'name', player) for player in players])
+        for p, player in enumerate(players):
+            if hasattr(player, 'cards'):
+                state.reserve[p] = player.troops_to_deploy
+                for card in player.cards:
+                    state.cards[p, TYPE_INDEX[card.value]] += 1
+        position = dict((name, p) for p, name in enumerate(state.players))
+        for i, name in enumerate(map.names):
+            country = board.countries[name]
+            if country.owner is not None:
+                state.owner[i] = position[country.owner.name]
+            state.troops[i] = country.troops
+        return state
+
+    def to_board(self, board, players):
+        """
+            Writes owners and troops onto a risk.models Board, keeping each Player's countries in step.
+            players maps player names to the Player objects to use. Reserves, card counts and sets_traded are
+            not written back: counts cannot say which cards a player holds, and callers keep their own.
+
+        :param board:
+        :param players:
+        """
+        for player in players.values():
+            player.countries = set()
+        for i, name in enumerate(self.map.names):
+            country = board.countries[name]
+            owner = self.owner[i]
+            country.set_owner(players[self.players[owner]] if owner != NO_OWNER else None)
+            country.set_troops(int(self.troops[i]))
+
+    def countries(self, player):
+        return np.flatnonzero(self.owner == player)
+
+    def frontier(self, player):
+        """
+            Every border from one of the player's countries into a country they do not own, as (bases, targets)
+            arrays.
+
+        :param player:
+        :return:
+        """
+        sources, indices = self.map.sources, self.map.indices
+        mask = (self.owner[sources] == player) & (self.owner[indices] != player)
+        return sources[mask], indices[mask]
+
+    def continents_held(self, player):
+        owned = np.bincount(self.map.continent, weights=self.owner == player,
+                            minlength=len(self.map.continent_names))
+        return owned == self.map.continent_size
+
+    def reinforcements(self, player):
+        """
+            Troops the player receives at the start of a turn, by the same rule as risk.game.Game.
+
+        :param player:
+        :return:
+        """
+        countries = int(np.count_nonzero(self.owner == player))
+        return max(3, countries // 3) + int(self.map.continent_bonus[self.continents_held(player)].sum())
@@ -0,0 +1,63 @@
+import networkx as nx
+from risk.models import Board, Card, Continent, Country
+from risk.mapcompiler import load_map
+
+
+class BoardTemplate(object):
+    """
+        The fixed part of a map: country names, borders, continents, cards and the border graph, read from the
+        map's CompiledMap, which is kept as `compiled`. A template is built once per process and never changed
+        afterwards; each game or request gets its own Board from board(), which only has to wire up fresh
+        countries for owner and troop state.
+    """
+
+    def __init__(self, compiled):
+        self.compiled = compiled
+        self.country_names = compiled.names
+        self.country_index = dict((name, i) for i, name in enumerate(self.country_names))
+        indptr, indices = compiled.indptr.tolist(), compiled.indices.tolist()
+        self.borders = tuple(tuple(indices[indptr[i]:indptr[i + 1]]) for i in range(len(self.country_names)))
+        self.continents = tuple((name, int(bonus), tuple(members.tolist()))
+                                for name, bonus, members in zip(compiled.continent_names, compiled.continent_bonus,
+                                                                compiled.members()))
+        self.continent_names = dict((self.country_names[i], name)
+                                    for name, _, members in self.continents for i in members)
+        self.cards = dict((name, Card(name, value)) for name, value in zip(self.country_names, compiled.cards))
+        self.cards['wild1'] = Card('wild1', 'wild')
+        self.cards['wild2'] = Card('wild2', 'wild')
+        self.graph = nx.Graph()
+        self.graph.add_nodes_from(self.country_names)
+        self.graph.add_edges_from((name, self.country_names[i])
+                                  for name, borders in zip(self.country_names, self.borders) for i in borders)
+
+    def board(self):
+        """
+            Returns a new Board for this map with every country unowned and empty.
+        """
+        board = Board()
+        # borders are filled in place, as assigning to a Country goes through its __setattr__
+        countries = [Country(name, []) for name in self.country_names]
+        for country, borders in zip(countries, self.borders):
+            country.border_countries.extend([countries[i] for i in borders])
+        board.countries = dict(zip(self.country_names, countries))
+        for name, bonus, members in self.continents:
+            continent = Continent(name, bonus)
+            continent.countries = dict((self.country_names[i], countries[i]) for i in members)
+            board.continents[name] = continent
+        board.cards = dict(self.cards)
+        return board
+
+
+_templates = {}
+
+
+def board_template(json_url):
+    """
+        Returns the template for the map at json_url, reading the file the first time it is asked for.
+
+    :param json_url:
+    :return:
+    """
+    if json_url not in _templates:
+        _templates[json_url] = BoardTemplate(load_map(json_url))
+    return _templates[json_url]
@@ -0,0 +1,87 @@
+"""
+    Zobrist hashing of board positions.
+
+    Every (country, owner) and (country, troops) pair gets a random 64-bit key, and a position hashes to the XOR
+    of the keys of its countries. Changing one country's owner or troops changes its two keys only, so a hash is
+    brought up to date after a move in constant time with update(). A BoardHash does so for a risk.models Board
+    as its countries change, see Board.zobrist_hash.
+"""
+import random
+
+
+class ZobristKeys(object):
+    """
+        Random keys for the countries in `names`. Owners can be any hashable value, such as player names or
+        CompactState owner positions; keys for owners and troop counts are drawn as they are first needed.
+    """
+
+    def __init__(self, names, seed=0):
+        self.index = dict((name, i) for i, name in enumerate(names))
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.owner_keys = {}
+        self.troop_keys = [[] for _ in names]
+
+    def owner_key(self, country, owner):
+        if (country, owner) not in self.owner_keys:
+            self.owner_keys[(country, owner)] = self.random.getrandbits(64)
+        return self.owner_keys[(country, owner)]
+
+    def troop_key(self, country, troops):
+        keys = self.troop_keys[country]
+        while len(keys) <= troops:
+            keys.append(self.random.getrandbits(64))
+        return keys[troops]
+
+    def key(self, country, owner, troops):
+        """
+            The key of one country, given by id, with the given owner and troops.
+        """
+        return self.owner_key(country, owner) ^ self.troop_key(country, troops)
+
+    def update(self, h, country, old_owner, old_troops, new_owner, new_troops):
+        """
+            Returns hash h with one country's owner and troops changed.
+        """
+        return h ^ self.key(country, old_owner, old_troops) ^ self.key(country, new_owner, new_troops)
+
+    def board_hash(self, board):
+        """
+            The hash of a risk.models Board, with owners keyed by player name.
+
+        :param board:
+        :return:
+        """
+        h = 0
+        for name, country in board.countries.items():
+            h ^= self.key(self.index[name], country.owner.name if country.owner else None, country.troops)
+        return h
+
+    def state_hash(self, state):
+        """
+            The hash of a CompactState, with owners keyed by position.
+
+        :param state:
+        :return:
+        """
+        h = 0
+        for i, (owner, troops) in enumerate(zip(state.owner.tolist(), state.troops.tolist())):
+            h ^= self.key(i, owner, troops)
+        return h
+
+
+class BoardHash(object):
+    """
+        The hash of a risk.models Board under keys, as board_hash gives it, brought up to date by the board's
+        countries each time one changes owner or troops through Country.set_owner or Country.set_troops.
+    """
+    __slots__ = ('keys', 'value')
+
+    def __init__(self, keys, board):
+        self.keys = keys
+        self.value = keys.board_hash(board)
+
+    def changed(self, country, old_owner, old_troops, new_owner, new_troops):
+        self.value = self.keys.update(self.value, self.keys.index[country.name],
+                                      old_owner.name if old_owner else None, int(old_troops),
+                                      new_owner.name if new_owner else None, int(new_troops))
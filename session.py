@@ -0,0 +1,143 @@
+"""
+    Per-game session state for the /turn endpoint.
+
+    A /turn payload normally carries the whole game: every player and every country's owner and troops. When the
+    game JSON also has an "id", the board and players built from it are kept as that game's session, and later
+    payloads may send only what changed:
+
+        {"you": {...},
+         "game": {"id": "...", "version": 12, "delta": true, "base_version": 11,
+                  "players": [...], "countries": {only the countries whose owner or troops changed}}}
+
+    A delta is applied to the session's board in place. It is refused with ResyncRequired, and the session
+    dropped, when there is no session for the game (say it was evicted, or the request reached another worker),
+    when base_version is not the version the session is at, when it names a country or owner the session does
+    not know, or when the board it leads to does not give the player exactly the countries listed in "you".
+    The host is then expected to send the full game again.
+
+    Sessions are kept per process in an LRUCache, so the least recently used games are dropped first.
+"""
+from risk.cache import LRUCache
+from risk.models import Player
+from risk.cards import Hand
+
+SESSION_LIMIT = 64
+
+
+class ResyncRequired(Exception):
+    pass
+
+
+class Session(object):
+    """
+        The board and players of one game, as of `version`. players maps names to Player objects, and 'none'
+        to None, as owners appear in the game JSON.
+    """
+
+    def __init__(self, board, players, version=None):
+        self.board = board
+        self.players = players
+        self.version = version
+
+    def country(self, name):
+        if name not in self.board.countries:
+            raise ResyncRequired('no country %r' % (name,))
+        return self.board.countries[name]
+
+    def update_countries(self, countries):
+        for country_name, data in countries.items():
+            country = self.country(country_name)
+            if data['owner'] not in self.players:
+                raise ResyncRequired('%s is owned by unknown player %r' % (country_name, data['owner']))
+            country.set_owner(self.players[data['owner']])
+            country.set_troops(data['troops'])
+
+    def update_player(self, me_data):
+        """
+            Reads the requesting player's own state, which every payload carries in full, and returns them.
+
+        :param me_data:
+        :return:
+        """
+        me = self.players[me_data['name']]
+        me.earned_cards_this_turn = me_data['earned_cards_this_turn']
+        me.is_eliminated = me_data['is_eliminated']
+        me.troops_to_deploy = me_data['troops_to_deploy']
+        me.available_actions = me_data['available_actions']
+        me.countries = set(self.country(c) for c in me_data['countries'])
+        names = [c['country_name'] for c in me_data['cards']]
+        if not all(name in self.board.cards for name in names):
+            raise ResyncRequired('no card for one of %r' % (names,))
+        me.cards = Hand(self.board.cards[name] for name in names)
+        return me
+
+    def check_countries(self, me):
+        """
+            Raises ResyncRequired unless the board gives me exactly me.countries.
+        """
+        if me.countries != self.board.ownership.countries(me):
+            raise ResyncRequired('board does not match the countries of %s' % me.name)
+
+
+def full_session(template, r):
+    """
+        Builds a session from a full payload.
+
+    :param template: the BoardTemplate of the game's map
+    :param r: the decoded payload
+    :return:
+    """
+    game = r['game']
+    players = dict((name, Player(name)) for name in game['players'])
+    players.setdefault(r['you']['name'], Player(r['you']['name']))
+    players['none'] = None
+    session = Session(template.board(), players, game.get('version'))
+    session.update_countries(game['countries'])
+    return session
+
+
+class Sessions(object):
+    """
+        The sessions of every game this process is playing, up to `limit` of them.
+    """
+
+    def __init__(self, template, limit=SESSION_LIMIT):
+        self.template = template
+        self.cache = LRUCache(limit)
+
+    def unpack(self, r):
+        """
+            Brings the game's session up to date with a payload, full or delta, and returns the requesting
+            player, the players by name and the board.
+
+        :param r: the decoded payload
+        :return:
+        """
+        game = r['game']
+        game_id = game.get('id')
+        if game.get('delta'):
+            session = self.cache.get(game_id) if game_id is not None else None
+            if session is None:
+                raise ResyncRequired('no session for game %s' % game_id)
+            if game.get('base_version') != session.version:
+                self.cache.discard(game_id)
+                raise ResyncRequired('game %s is at version %s, not %s' %
+                                     (game_id, session.version, game.get('base_version')))
+            for name in game.get('players', []):
+                if name not in session.players:
+                    session.players[name] = Player(name)
+            try:
+                # a delta refused part way through has changed the board, so the session goes with it
+                session.update_countries(game['countries'])
+                session.version = game.get('version')
+                me = session.update_player(r['you'])
+                session.check_countries(me)
+            except ResyncRequired:
+                self.cache.discard(game_id)
+                raise
+        else:
+            session = full_session(self.template, r)
+            me = session.update_player(r['you'])
+            if game_id is not None:
+                self.cache.put(game_id, session)
+        return me, session.players, session.board
@@ -1,25 +1,634 @@
+import os
+# the decision log is read from the environment on import, and would otherwise print records between the results
+os.environ.setdefault('DECISION_LOG_LEVEL', 'off')
 from risk.models import *
 from ai import *
+from risk.mapcompiler import compile_map, generate_map, load_map, MapError, COMPILED_SUFFIX
+import benchmark
 import unittest2
+import json
+import shutil
+import tempfile
+import random
+import subprocess
+import sys
+import re
+import time
+import pstats
+import threading
+from StringIO import StringIO
+import BaseHTTPServer
+import SocketServer
+from risk.template import BoardTemplate, board_template
+from risk.host import Host
+from session import Sessions, ResyncRequired
+from risk.state import compact_map, CompactState
+from risk.moves import MoveLog
+from risk.zobrist import ZobristKeys
+from risk.cards import SETS, CARD_TYPES, TYPE_INDEX, hand_key, is_set
+import numpy as np
+from risk.game import Game, RandomPolicy
+from risk.dice import BufferedDice, RecordingDice, ReplayDice, RandomDice
+from risk import battle
+from policies import HeuristicPolicy, PlannerPolicy
+import planner
+import tournament
+import turnplan
+from risk import decisionlog
+from risk.metrics import METRICS, PROFILE, BUCKETS_MS
+import app
+
+
+class StubBot(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+        A stand-in bot server. Each /turn is answered by the next of server.answers[player name], a function of
+        the request giving the response, which is sent as JSON unless it is a string.
+    """
+
+    def do_GET(self):
+        self.reply({})
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.reply(self.server.answers[body['you']['name']].pop(0)(body) if self.path == '/turn' else {})
+
+    def reply(self, answer):
+        data = answer if isinstance(answer, str) else json.dumps(answer)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class BlockedStream(StringIO):
+    """
+        A stream whose writes wait for `release` to be set, setting `writing` as the first one starts.
+    """
+
+    def __init__(self):
+        StringIO.__init__(self)
+        self.writing = threading.Event()
+        self.release = threading.Event()
+
+    def write(self, s):
+        self.writing.set()
+        self.release.wait()
+        StringIO.write(self, s)
+
+
+class StubBotServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # a host giving up on a slow answer closes the connection under it, which is expected here
+        pass
+
+
+def rolled_battle(attackers, defenders, memo={}, dice_losses={}):
+    """
+        (win probability, expected attacker loss, expected defender loss) of a battle, by enumerating every
+        roll of the dice and recursing on its result.
+    """
+    if not defenders:
+        return 1.0, 0.0, 0.0
+    if not attackers:
+        return 0.0, 0.0, 0.0
+    if (attackers, defenders) not in memo:
+        attacking_die, defending_die = min(attackers, 3), min(defenders, 2)
+        if (attacking_die, defending_die) not in dice_losses:
+            counts = {}
+            for roll in itertools.product(range(1, 7), repeat=attacking_die + defending_die):
+                pairs = zip(sorted(roll[:attacking_die], reverse=True), sorted(roll[attacking_die:], reverse=True))
+                lost_a = sum(1 for a, d in pairs if a <= d)
+                counts[(lost_a, len(pairs) - lost_a)] = counts.get((lost_a, len(pairs) - lost_a), 0) + 1
+            dice_losses[(attacking_die, defending_die)] = counts
+        counts = dice_losses[(attacking_die, defending_die)]
+        result = np.zeros(3)
+        for (lost_a, lost_d), n in counts.items():
+            win, loss_a, loss_d = rolled_battle(attackers - lost_a, defenders - lost_d)
+            result += np.array([win, loss_a + lost_a, loss_d + lost_d]) * n
+        memo[(attackers, defenders)] = tuple(result / sum(counts.values()))
+    return memo[(attackers, defenders)]
+
+
+class LoggedPolicy(object):
+    """
+        Plays another policy and appends each order it gives to log, with countries and cards as names.
+    """
+
+    def __init__(self, policy, log):
+        self.policy = policy
+        self.log = log
+
+    def __getattr__(self, name):
+        def order(game, player, *args):
+            result = getattr(self.policy, name)(game, player, *args)
+            self.log.append((player.name, name, names_of(result)))
+            return result
+        return order
+
+
+def names_of(order):
+    if isinstance(order, dict):
+        return sorted((names_of(key), value) for key, value in order.items())
+    if isinstance(order, (list, tuple)):
+        return [names_of(item) for item in order]
+    return getattr(order, 'name', getattr(order, 'country_name', order))
+
+
+def first_unowned(body):
+    return {'action': 'choose_country',
+            'data': min(name for name, c in body['game']['countries'].items() if c['owner'] == 'none')}
+
+
+def too_slow(body):
+    time.sleep(1)
+    return first_unowned(body)
+
 
 class Test(unittest2.TestCase):
     def setUp(self):
         self.board = import_board_data('risk/board_graph.json')
+        self.G = make_graph(self.board)
         self.players  = [Player('Peter'), Player('Paul'), Player('Mary')]
 
+    def claim_all(self):
+        for player in itertools.cycle(self.players):
+            country_choice = best_country(self.G, self.board, player)
+            if not country_choice:
+                break
+            player.choose_country(country_choice)
+
     def test_choose_country(self):
-        while True:
-            for player in self.players:
-                country_choice = best_country(board)
-                if country_choice:
-                    player.choose_country(country_choice)
-                else:
-                    break
+        self.claim_all()
+        self.assertTrue(all(c.owner is not None for c in self.board.countries.values()))
+        self.assertEqual(sum(len(p.countries) for p in self.players), len(self.board.countries))
 
     def test_deploy_troops(self):
+        self.claim_all()
         for player in self.players:
-            orders = deploy_troops(player)
-            for country, num in orders.items():
-                player.deploy_troops(country, num)
+            player.troops_to_deploy = 10
+            orders = deploy_troops(self.G, player, self.board)
+            self.assertLessEqual(sum(orders.values()), 10)
+            for country_name, num in orders.items():
+                player.deploy_troops(self.board.countries[country_name], int(num))
+
+    def test_best_attack(self):
+        self.claim_all()
+        player = self.players[0]
+        for country in player.countries:
+            country.troops += 20
+        attack = best_attack(self.G, player, self.board)
+        self.assertIsNotNone(attack)
+        base, target = attack
+        self.assertEqual(base.owner, player)
+        self.assertNotEqual(target.owner, player)
+        self.assertIn(target, base.border_countries)
+
+    def test_reinforce_moves_across_the_widest_gap(self):
+        self.claim_all()
+        rng = random.Random(5)
+        player = self.players[0]
+        for _ in range(20):
+            for country in self.board.countries.values():
+                country.set_troops(rng.randint(1, 15))
+            risk = country_risk(self.G, player, self.board)
+            ratio = lambda c: c.troops / risk[c.name]
+            gaps = [ratio(a) / ratio(b) for a in player.countries for b in a.border_countries
+                    if a.troops > 1 and b.owner == player]
+            origin, destination, troops = reinforce(self.G, player, self.board)
+            self.assertIn(destination, origin.border_countries)
+            self.assertEqual(ratio(origin) / ratio(destination), max(gaps))
+            move = 1
+            while (origin.troops - move / risk[origin.name]) > (destination.troops + move / risk[destination.name]) \
+                    and origin.troops - move > 1:
+                move += 1
+            self.assertEqual(troops, move)
+
+    def test_country_risk_on_a_hand_scored_line(self):
+        # a - b - c - d - e, with a, b and c ours and 4 and 7 enemy troops on d and e
+        names = 'abcde'
+        countries = dict((name, {'border countries': [n for n in names[max(0, i - 1):i + 2] if n != name],
+                                 'card': 'cannon'}) for i, name in enumerate(names))
+        template = BoardTemplate(compile_map({'line': {'bonus': 1, 'countries': countries}}))
+        board, me, them = template.board(), Player('me'), Player('them')
+        for name, owner, troops in zip(names, (me, me, me, them, them), (1, 1, 1, 4, 7)):
+            owner.deploy_troops(board.countries[name], troops)
+        # threat, the enemy troops on a country's borders: a 0, b 0, c 4, d 7, e 4
+        risk = country_risk(template.graph, me, board)
+        self.assertEqual(sorted(risk), ['a', 'b', 'c'])
+        for name, expected in (('c', 4 + 0.5 * (0 + 7) + 0.25 * (0 + 4)),
+                               ('b', 0 + 0.5 * (0 + 4) + 0.25 * 7 + 0.125 * 4),
+                               ('a', 0 + 0.5 * 0 + 0.25 * 4 + 0.125 * 7 + 0.0625 * 4)):
+            self.assertAlmostEqual(risk[name], expected, places=6)
+        self.assertAlmostEqual(RiskMap(template.graph, me, board, depth=2).risk()['a'], 0.25 * 4, places=6)
+
+    def test_ownership_index(self):
+        self.claim_all()
+        player, other = self.players[0], self.players[1]
+        ownership = self.board.ownership
+        base, target = next((c1, c2) for c1 in player.countries for c2 in c1.border_countries if c2.owner == other)
+        base.troops, target.troops = 10, 1
+        keys = ZobristKeys(sorted(self.board.countries))
+        self.board.zobrist_hash(keys)
+        while target.owner != player:
+            base.attack(target, 3, 0)
+        player.deploy_troops(base, 4)
+        # plain assignments keep the hash and the index in step too
+        base.troops += 3
+        given = min(other.countries, key=lambda c: c.name)
+        given.owner = self.players[2]
+        self.assertNotIn(given, other.countries)
+        self.assertEqual(self.board.zobrist_hash(keys), keys.board_hash(self.board))
+        for owner in self.players:
+            self.assertEqual(ownership.countries(owner), owner.countries)
+            frontier = set(c for c in owner.countries if any(b.owner != owner for b in c.border_countries))
+            self.assertEqual(ownership.frontier(owner), frontier)
+            for continent in self.board.continents.values():
+                held = sum(1 for c in continent.countries.values() if c.owner == owner)
+                self.assertEqual(ownership.held_in(owner, continent), held)
+                self.assertEqual(ownership.controls(owner, continent), held == len(continent.countries))
+
+    def test_moves_unmake_exactly(self):
+        template = board_template('risk/board_graph.json')
+        cmap = compact_map(template)
+        board = template.board()
+        rng = random.Random(0)
+        players = [Player(name) for name in ('a', 'b', 'c')]
+        for i, name in enumerate(sorted(board.countries)):
+            board.countries[name].set_owner(players[i % 3])
+            board.countries[name].troops = rng.randint(1, 8)
+        state = CompactState.from_board(cmap, board, ['a', 'b', 'c'])
+        state.reserve[:] = [5, 0, 3]
+        state.cards[:] = [[1, 1, 1, 1], [3, 0, 0, 0], [0, 0, 2, 1]]
+        start = state.clone()
+        keys = ZobristKeys(cmap.names)
+        log = MoveLog(state, keys)
+        while len(log) < 300:
+            kind = rng.randrange(4)
+            player = rng.randrange(3)
+            if kind == 0 and state.reserve[player]:
+                log.deploy(player, rng.choice(state.countries(player)), rng.randint(1, state.reserve[player]))
+            elif kind == 1:
+                bases, targets = state.frontier(player)
+                strong = [(b, t) for b, t in zip(bases, targets) if state.troops[b] > 2]
+                if strong:
+                    base, target = rng.choice(strong)
+                    defender_loss = rng.randint(0, state.troops[target])
+                    log.attack(base, target, rng.randint(0, 1), defender_loss, 1)
+            elif kind == 2:
+                pairs = [(i, j) for i in state.countries(player) for j in cmap.borders(i)
+                         if state.owner[j] == player and state.troops[i] > 1]
+                if pairs:
+                    origin, destination = rng.choice(pairs)
+                    log.reinforce(origin, destination, rng.randint(1, state.troops[origin] - 1))
+            elif SETS[hand_key(state.cards[player])]:
+                pattern = rng.choice(SETS[hand_key(state.cards[player])])
+                types = [t for t, used in enumerate(pattern) for _ in range(used)]
+                log.trade_in(player, types, rng.choice([None, rng.choice(state.countries(player))]))
+            self.assertEqual(log.hash, keys.state_hash(state))
+        log.unmake_to(0)
+        for name in ('owner', 'troops', 'reserve', 'cards'):
+            before, after = getattr(start, name), getattr(state, name)
+            self.assertEqual((before.dtype, before.tobytes()), (after.dtype, after.tobytes()), name)
+        self.assertEqual(state.sets_traded, start.sets_traded)
+        self.assertEqual(log.hash, keys.state_hash(start))
+
+    def test_replayed_dice_replay_a_game(self):
+        template = board_template('risk/board_graph.json')
+        logs, dice = [], [RecordingDice(BufferedDice(7))]
+        for _ in range(2):
+            log = []
+            policies = {'a': RandomPolicy(), 'b': RandomPolicy(), 'c': HeuristicPolicy(blitz=True)}
+            game = Game(template, dict((name, LoggedPolicy(p, log)) for name, p in policies.items()), seed=3,
+                        max_turns=60, dice=dice[-1])
+            game.play()
+            logs.append(log)
+            dice.append(ReplayDice(dice[0].results))
+        self.assertGreater(len(dice[0].results), 20)
+        self.assertEqual(logs[0], logs[1])
+        self.assertEqual(dice[1].position, len(dice[0].results))
+
+    def test_blitz_outcomes(self):
+        self.claim_all()
+        rng = random.Random(0)
+        dice = RandomDice(rng)
+        base, target = next((c1, c2) for c1 in self.players[0].countries for c2 in c1.border_countries
+                            if c2.owner == self.players[1])
+        for _ in range(500):
+            base.set_owner(self.players[0])
+            target.set_owner(self.players[1])
+            base.troops, target.troops = rng.randint(2, 30), rng.randint(1, 30)
+            stop_at = rng.randint(1, base.troops - 1)
+            attackers, defenders = base.troops - stop_at, target.troops
+            fell = base.blitz(target, stop_at, dice=dice)
+            # either the defenders are wiped out and the surviving attackers move in, or the attackers are
+            # down to stop_at with the defenders holding
+            self.assertEqual(base.troops, stop_at)
+            self.assertEqual(target.owner, self.players[0] if fell else self.players[1])
+            self.assertTrue(1 <= target.troops <= (attackers if fell else defenders))
+        # whole battles drawn at once (5 against 4) and rolled out round by round (60 against 50)
+        for attackers, defenders, draws in ((5, 4, 20000), (60, 50, 4000)):
+            attacker_remaining, defender_remaining = battle.outcome_distribution(attackers, defenders)
+            expected = np.concatenate((attacker_remaining[::-1][:-1], defender_remaining[::-1][:-1]))
+            counts = np.zeros(attackers + defenders)
+            for _ in range(draws):
+                attacker_loss, defender_loss = battle.sample_battle(attackers, defenders, rng)
+                self.assertTrue(attacker_loss == attackers or defender_loss == defenders)
+                counts[attacker_loss if defender_loss == defenders else attackers + defender_loss] += 1
+            tolerance = 4 * np.sqrt(expected * (1 - expected) / draws) + 1.0 / draws
+            self.assertTrue(np.all(np.abs(counts / draws - expected) <= tolerance), (attackers, defenders))
+
+    def test_battle_tables_match_rolled_battles(self):
+        shipped = battle.load_tables()
+        self.assertIsNotNone(shipped)
+        solved = battle._solve(12)
+        for attackers, defenders in itertools.product(range(1, 13), range(1, 13)):
+            expected = rolled_battle(attackers, defenders)
+            for tables in (shipped, solved):
+                self.assertTrue(np.allclose([table[attackers, defenders] for table in tables], expected,
+                                            rtol=0, atol=1e-12), (attackers, defenders))
+            attacker_remaining, defender_remaining = battle.outcome_distribution(attackers, defenders)
+            self.assertAlmostEqual(attacker_remaining.sum(), expected[0], places=12)
+            self.assertAlmostEqual(attacker_remaining.sum() + defender_remaining.sum(), 1.0, places=12)
+        for attackers, defenders in ((12, 12), (40, 35), (90, 3), (4, 90)):
+            expected = [table[attackers, defenders] for table in shipped]
+            self.assertTrue(np.allclose(battle.large_battle(attackers, defenders), expected, rtol=0, atol=1e-9))
+        beyond = battle._solve(700)
+        for attackers, defenders in ((600, 620), (690, 540), (520, 700), (513, 513), (680, 20), (30, 690)):
+            expected = [table[attackers, defenders] for table in beyond]
+            self.assertTrue(np.allclose(battle.large_battle(attackers, defenders), expected, rtol=0, atol=1e-9),
+                            (attackers, defenders))
+
+    def test_card_sets_agree_with_the_set_table(self):
+        for values in itertools.product(CARD_TYPES, repeat=3):
+            cards = [Card(str(i), value) for i, value in enumerate(values)]
+            self.assertEqual(cards[0].is_set_with(cards[1], cards[2]), is_set([TYPE_INDEX[v] for v in values]), values)
+        self.assertFalse(Card('a', 'cannon').is_set_with(Card('b', 'horse'), Card('c', 'cannon')))
+
+    def test_best_card_set(self):
+        self.claim_all()
+        player = self.players[0]
+        owned = sorted(c.name for c in player.countries if self.board.cards[c.name].value == 'cannon')[0]
+        others = sorted(name for name, card in self.board.cards.items()
+                        if card.value == 'cannon' and self.board.countries[name].owner != player)
+        player.cards.update(self.board.cards[name] for name in others[:2] + [owned, 'wild1'])
+        self.assertTrue(player.has_card_set())
+        trade_in = player.best_card_set(self.board)
+        self.assertEqual(trade_in[0].country_name, owned)
+        self.assertEqual(sorted(card.country_name for card in trade_in), sorted(others[:2] + [owned]))
+        player.cards.remove(self.board.cards[others[0]])
+        self.assertIn(self.board.cards['wild1'], player.best_card_set(self.board))
+        player.cards.remove(self.board.cards['wild1'])
+        self.assertFalse(player.has_card_set())
+        self.assertIsNone(player.best_card_set(self.board))
+
+    def test_map_compiler_rejects_one_way_borders(self):
+        data = generate_map(20)
+        country = data['k0_0']['countries']['t0_0']
+        country['border countries'].remove('t1_0')
+        with self.assertRaises(MapError) as raised:
+            compile_map(data)
+        self.assertIn('t1_0 borders t0_0, but not the other way round', raised.exception.problems)
+
+    def test_load_map_rebuilds_a_corrupt_cache(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'map.json')
+            with open(path, 'w') as f:
+                json.dump(generate_map(30), f)
+            expected = load_map(path)
+            with open(path + COMPILED_SUFFIX, 'rb') as f:
+                whole = f.read()
+            with open(path + COMPILED_SUFFIX, 'wb') as f:
+                f.write(whole[:len(whole) // 2])
+            self.assertEqual(load_map(path).names, expected.names)
+            self.assertEqual(load_map(path, cache=False).names, expected.names)
+            with open(path + COMPILED_SUFFIX, 'rb') as f:
+                self.assertEqual(f.read(), whole)
+            self.assertEqual(sorted(os.listdir(directory)), ['map.json', 'map.json' + COMPILED_SUFFIX])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_sessions_apply_deltas_and_force_resyncs(self):
+        template = board_template('risk/board_graph.json')
+        sessions = Sessions(template)
+        names = sorted(template.country_names)
+        countries = dict((name, {'owner': ('me', 'p2')[i % 2], 'troops': 3}) for i, name in enumerate(names))
+
+        def payload(game, countries_of_me):
+            return {'you': {'name': 'me', 'earned_cards_this_turn': False, 'is_eliminated': False,
+                            'troops_to_deploy': 0, 'available_actions': ['attack'],
+                            'countries': countries_of_me, 'cards': []}, 'game': game}
+
+        def full(version):
+            return payload({'id': 'g', 'version': version, 'players': ['me', 'p2'], 'countries': countries},
+                           names[0::2])
+
+        def delta(base_version, changed, countries_of_me):
+            return payload({'id': 'g', 'version': base_version + 1, 'delta': True, 'base_version': base_version,
+                            'players': ['me', 'p2'], 'countries': changed}, countries_of_me)
+
+        sessions.unpack(full(1))
+        mine = names[0::2] + [names[1]]
+        me, players, board = sessions.unpack(delta(1, {names[1]: {'owner': 'me', 'troops': 5}}, mine))
+        self.assertEqual(board.countries[names[1]].owner, me)
+        self.assertEqual(board.countries[names[1]].troops, 5)
+        self.assertEqual(board.ownership.countries(me), set(board.countries[name] for name in mine))
+        self.assertEqual(sessions.cache.get('g').version, 2)
+        refused = [delta(1, {}, names[0::2]),
+                   delta(2, {'atlantis': {'owner': 'me', 'troops': 1}}, names[0::2]),
+                   delta(2, {names[3]: {'owner': 'nobody', 'troops': 1}}, names[0::2]),
+                   delta(2, {names[3]: {'owner': 'me', 'troops': 1}}, names[0::2])]
+        for request in refused:
+            sessions.unpack(full(2))
+            with self.assertRaises(ResyncRequired):
+                sessions.unpack(request)
+            self.assertIsNone(sessions.cache.get('g'))
+            with self.assertRaises(ResyncRequired):
+                sessions.unpack(delta(2, {}, names[0::2]))
+
+    def test_host_penalizes_bad_bots(self):
+        server = StubBotServer(('127.0.0.1', 0), StubBot)
+        threading.Thread(target=server.serve_forever).start()
+        url = 'http://127.0.0.1:%d' % server.server_address[1]
+        host = Host(board_template('risk/board_graph.json'), {'a': url, 'b': url, 'c': url}, seed=0, deadline=0.3)
+        try:
+            server.answers = {'a': [first_unowned],
+                              'b': [lambda body: 'not json', first_unowned],
+                              'c': [lambda body: [1, 2], lambda body: {'action': 'choose_country', 'data': [1]},
+                                    too_slow, first_unowned]}
+            choices = dict((player.name, host.policies[player.name].choose_country(host, player))
+                           for player in sorted(host.players, key=lambda p: p.name))
+            errors = dict((player.name, (player.errors, player.is_neutral)) for player in host.players)
+            self.assertEqual(errors, {'a': (0, False), 'b': (1, False), 'c': (3, True)})
+            self.assertEqual(choices['a'].name, min(host.board.countries))
+            self.assertEqual(choices['b'].name, min(host.board.countries))
+            self.assertIsNone(choices['c'].owner)
+            self.assertEqual(server.answers, {'a': [], 'b': [], 'c': [first_unowned]})
+        finally:
+            host.close()
+            server.shutdown()
+            server.server_close()
+
+    def test_decisions_scale_subquadratically(self):
+        # a map four times larger must cost well under the sixteen times a quadratic decision would
+        times = []
+        for size in (400, 1600):
+            template = benchmark.synthetic_template(size)
+            results = benchmark.run_case(template, benchmark.synthetic_bodies(template, positions=3), repeats=1)
+            times.append(dict((phase, max(results[(phase, 'decide')]['p50'], 0.5)) for phase in benchmark.PHASES))
+        for phase in benchmark.PHASES:
+            self.assertLess(times[1][phase], 10 * times[0][phase], phase)
+
+    def test_turn_plans_are_kept_only_for_their_turn(self):
+        template = board_template('risk/board_graph.json')
+        G = template.graph
+        game = Game(template, dict((name, RandomPolicy()) for name in ('a', 'b', 'c')), seed=0)
+        game.claim_countries()
+        game.place_starting_troops()
+        player, other, board = game.players[0], game.players[1], game.board
+        key = ('turn plans', player.name)
+        player.troops_to_deploy = 30
+        orders = deploy_troops(G, player, board)
+        plan = turnplan.plan_turn(template, player, board, key, deploy=orders)
+        for name, troops in orders.items():
+            player.deploy_troops(board.countries[name], int(troops))
+        self.assertTrue(plan.attacks)
+        # the deploy's plan serves the attack requests while the dice go its way
+        base, target = turnplan.next_attack(template, player, board, key)
+        self.assertEqual((base.name, target.name), plan.attacks[0])
+        target.add_troops(other, 2)
+        self.assertEqual(turnplan.next_attack(template, player, board, key), (base, target))
+        self.assertIs(turnplan.PLANS.get(key), plan)
+        # and is made again once they go against it
+        base.set_troops(2)
+        turnplan.next_attack(template, player, board, key)
+        self.assertIsNot(turnplan.PLANS.get(key), plan)
+        # a finished plan ends the attack phase only on the board it finished on
+        finished = turnplan.TurnPlan([], True)
+        finished.position = turnplan.position(G, board)
+        turnplan.PLANS.put(key, finished)
+        self.assertIsNone(turnplan.next_attack(template, player, board, key))
+        elsewhere = next(c for c in other.countries if c is not target)
+        elsewhere.add_troops(other, 3)
+        self.assertIsNotNone(turnplan.next_attack(template, player, board, key))
+        self.assertIsNot(turnplan.PLANS.get(key), finished)
+        # the reinforcement chosen as the attack phase ends is served while the board is unchanged
+        turnplan.end_attacks(G, player, board, key)
+        turnplan.PLANS.get(key).reinforcement = 'kept'
+        self.assertEqual(turnplan.planned_reinforcement(G, player, board, key), 'kept')
+        self.assertIsNone(turnplan.PLANS.get(key))
+        turnplan.end_attacks(G, player, board, key)
+        turnplan.PLANS.get(key).reinforcement = 'kept'
+        elsewhere.add_troops(other, 1)
+        self.assertEqual(turnplan.planned_reinforcement(G, player, board, key), reinforce(G, player, board))
+        self.assertIsNone(turnplan.PLANS.get(key))
+
+    def test_tournament_plays_every_registered_policy(self):
+        for name in sorted(tournament.POLICIES):
+            self.assertIsInstance(tournament.make_policy(name), tournament.POLICIES[name])
+        self.assertEqual(tournament.make_policy('planner').budget, planner.ATTACK_BUDGET)
+        entrants = ['heuristic', 'planner:budget=0.001', 'random']
+        result = tournament.run(entrants, games=2, processes=1, max_turns=6)
+        self.assertEqual(sorted(result['entrants']), entrants)
+        self.assertTrue(all(s['games'] == 2 for s in result['entrants'].values()))
+        self.assertEqual(result['turns'], 12)
+
+    def test_games_play_out_on_generated_maps(self):
+        # 120 countries is more than the classic starting troops can cover for three players
+        template = benchmark.synthetic_template(120)
+        policies = dict((name, RandomPolicy(min_troops=1, stop=0.0)) for name in ('a', 'b', 'c'))
+        game = Game(template, policies, seed=0, max_turns=3000)
+        game.claim_countries()
+        game.place_starting_troops()
+        for player in game.players:
+            self.assertEqual(sum(c.troops for c in player.countries), 100)
+        game = Game(template, policies, seed=0, max_turns=3000)
+        winner = game.play()
+        self.assertIsNotNone(winner)
+        self.assertTrue(all(c.owner is winner for c in game.board.countries.values()))
+
+    def test_decision_log_levels_drops_and_exit_flush(self):
+        stream = StringIO()
+        log = decisionlog.DecisionLog(stream, decisionlog.INFO)
+        self.assertFalse(log.enabled(decisionlog.DEBUG))
+        log.debug('skipped', n=0)
+        log.info('kept', n=1)
+        log.warning('kept', n=2)
+        log.flush()
+        written = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual([(r['lvl'], r['ev'], r['n']) for r in written], [('info', 'kept', 1), ('warning', 'kept', 2)])
+
+        stream = BlockedStream()
+        log = decisionlog.DecisionLog(stream, decisionlog.DEBUG, queue_size=2)
+        log.debug('taken', n=0)
+        self.assertTrue(stream.writing.wait(5))
+        for n in range(1, 6):
+            log.debug('queued', n=n)
+        self.assertEqual(log.dropped, 3)
+        stream.release.set()
+        log.flush()
+        self.assertEqual([json.loads(line)['n'] for line in stream.getvalue().splitlines()], [0, 1, 2])
+
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'decisions.log')
+            script = 'from risk.decisionlog import LOG\nfor n in range(5000):\n    LOG.info("exit", n=n)\n'
+            environ = dict(os.environ, DECISION_LOG=path, DECISION_LOG_LEVEL='info')
+            subprocess.check_call([sys.executable, '-c', script], env=environ)
+            self.assertEqual([r['n'] for r in decisionlog.records(path, 'exit')], range(5000))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_metrics_and_profile_endpoints(self):
+        client = app.app.test_client()
+        body = [b for b in benchmark.load_corpus(benchmark.CORPUS_PATH) if b['phase'] == 'deploy_troops'][0]['body']
+        METRICS.reset()
+        self.assertEqual(client.post('/turn', data=body).status_code, 200)
+        response = client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Content-Type'], 'text/plain; version=0.0.4')
+        sample = re.compile(r'^([a-z_]+)(\{[a-z_]+="[^"]*"(,[a-z_]+="[^"]*")*\})? -?[0-9.]+$')
+        families = {}
+        for line in response.data.splitlines():
+            if line.startswith('# TYPE '):
+                _, _, family, kind = line.split()
+                families[family] = kind
+            elif not line.startswith('# HELP '):
+                self.assertTrue(sample.match(line), line)
+                self.assertTrue(any(sample.match(line).group(1).startswith(f) for f in families), line)
+        self.assertEqual(families['turn_latency_ms'], 'histogram')
+        self.assertEqual(families['cache_hits_total'], 'counter')
+        buckets = [int(line.rsplit(' ', 1)[1]) for line in response.data.splitlines()
+                   if line.startswith('turn_latency_ms_bucket{phase="deploy_troops",stage="total",')]
+        self.assertEqual(len(buckets), len(BUCKETS_MS) + 1)
+        self.assertEqual(buckets, sorted(buckets))
+        self.assertEqual(buckets[-1], 1)
+        self.assertIn('turn_latency_ms_count{phase="deploy_troops",stage="total"} 1\n', response.data)
+        self.assertIn('cache_entries{cache="sessions"} ', response.data)
+
+        self.assertFalse(app.PROFILE_ENDPOINT)
+        self.assertEqual(client.post('/profile').status_code, 404)
+        directory, PROFILE.directory = PROFILE.directory, tempfile.mkdtemp()
+        try:
+            app.PROFILE_ENDPOINT = True
+            response = client.post('/profile')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(json.loads(response.data), {'armed': True, 'directory': PROFILE.directory})
+            client.post('/turn', data=body)
+            client.post('/turn', data=body)
+            self.assertEqual(os.listdir(PROFILE.directory), [os.path.basename(PROFILE.last_path)])
+            self.assertTrue(pstats.Stats(PROFILE.last_path).total_calls > 0)
+        finally:
+            app.PROFILE_ENDPOINT = False
+            shutil.rmtree(PROFILE.directory)
+            PROFILE.directory = directory
+
 
-    def test_
+if __name__ == '__main__':
+    unittest2.main()
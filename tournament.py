@@ -0,0 +1,176 @@
+"""
+    Tournaments between policies, played in-process with risk.game across a pool of worker processes.
+
+    Entrants are policy specs: a name from POLICIES, optionally followed by keyword arguments, as in
+
+        python tournament.py heuristic random "heuristic:threshold=3,decay=0.6" --games 200 --players 4
+
+    Each game seats --players entrants, drawn without replacement while there are enough, and gets its own seed,
+    all drawn from --seed, so a tournament is reproducible whatever the number of processes (the planner's time
+    budget aside, which makes its search depth depend on machine load). Results are collected in game order, so
+    the Elo ratings, which treat a win as beating every other player at the table and a draw as drawing with
+    them, come out the same too.
+"""
+import ast
+import sys
+import time
+import random
+import argparse
+import itertools
+import multiprocessing
+from risk.template import board_template
+from risk.game import Game, RandomPolicy
+from policies import HeuristicPolicy, PlannerPolicy
+
+BOARD_PATH = './risk/board_graph.json'
+POLICIES = {'random': RandomPolicy, 'heuristic': HeuristicPolicy, 'planner': PlannerPolicy}
+ELO_START = 1500.0
+ELO_K = 16.0
+
+
+def make_policy(spec):
+    """
+        Builds the policy described by spec, "name" or "name:key=value,key=value", with values read as
+        Python literals.
+
+    :param spec:
+    :return:
+    """
+    name, _, args = spec.partition(':')
+    kwargs = {}
+    for arg in filter(None, args.split(',')):
+        key, _, value = arg.partition('=')
+        kwargs[key.strip()] = ast.literal_eval(value.strip())
+    return POLICIES[name](**kwargs)
+
+
+def schedule(entrants, games, players, seed):
+    """
+        The seating and seed of every game, as a list of (entrant per seat, game seed).
+
+    :param entrants: policy specs
+    :param games:
+    :param players: seats per game
+    :param seed:
+    :return:
+    """
+    rng = random.Random(seed)
+    tables = []
+    for _ in range(games):
+        if len(entrants) >= players:
+            seats = rng.sample(entrants, players)
+        else:
+            seats = [entrants[i % len(entrants)] for i in range(players)]
+            rng.shuffle(seats)
+        tables.append((seats, rng.getrandbits(32)))
+    return tables
+
+
+def play_game(args):
+    """
+        Plays one scheduled game and returns the winning seat, or None for a draw, and the turns played.
+
+    :param args: (entrant per seat, game seed, max turns)
+    :return:
+    """
+    seats, seed, max_turns = args
+    policies = dict(('%d' % i, make_policy(spec)) for i, spec in enumerate(seats))
+    game = Game(board_template(BOARD_PATH), policies, seed, max_turns)
+    winner = game.play()
+    return (int(winner.name) if winner is not None else None), game.turns
+
+
+def update_elo(ratings, seats, winner, k=ELO_K):
+    """
+        Applies one game's result to ratings, {entrant: rating}, in place.
+
+    :param ratings:
+    :param seats:
+    :param winner: the winning seat, or None for a draw
+    :param k:
+    """
+    delta = dict((entrant, 0.0) for entrant in seats)
+    for i, j in itertools.combinations(range(len(seats)), 2):
+        a, b = seats[i], seats[j]
+        if a == b:
+            continue
+        if winner is None:
+            score = 0.5
+        elif winner in (i, j):
+            score = float(winner == i)
+        else:
+            continue
+        expected = 1 / (1 + 10 ** ((ratings[b] - ratings[a]) / 400.0))
+        delta[a] += k * (score - expected)
+        delta[b] -= k * (score - expected)
+    for entrant, change in delta.items():
+        ratings[entrant] += change
+
+
+def run(entrants, games, players=3, seed=0, processes=None, max_turns=500):
+    """
+        Plays a tournament and returns a dict with per-entrant games, wins, win_rate and elo, plus the number
+        of draws, wall-clock seconds and games per second.
+
+    :param entrants:
+    :param games:
+    :param players:
+    :param seed:
+    :param processes: worker processes, one per core by default
+    :param max_turns:
+    :return:
+    """
+    assert 3 <= players <= 6
+    for spec in set(entrants):
+        make_policy(spec)
+    tables = schedule(entrants, games, players, seed)
+    start = time.time()
+    pool = multiprocessing.Pool(processes)
+    try:
+        chunksize = max(1, games // (4 * (processes or multiprocessing.cpu_count())))
+        results = pool.map(play_game, [(seats, game_seed, max_turns) for seats, game_seed in tables], chunksize)
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = time.time() - start
+    stats = dict((entrant, {'games': 0, 'wins': 0, 'elo': ELO_START}) for entrant in entrants)
+    ratings = dict((entrant, ELO_START) for entrant in entrants)
+    draws = 0
+    for (seats, _), (winner, _) in zip(tables, results):
+        for entrant in set(seats):
+            stats[entrant]['games'] += 1
+        if winner is None:
+            draws += 1
+        else:
+            stats[seats[winner]]['wins'] += 1
+        update_elo(ratings, seats, winner)
+    for entrant, s in stats.items():
+        s['elo'] = ratings[entrant]
+        s['win_rate'] = float(s['wins']) / s['games'] if s['games'] else 0.0
+    return {'entrants': stats,
+            'draws': draws,
+            'turns': sum(turns for _, turns in results),
+            'seconds': elapsed,
+            'games_per_second': games / elapsed}
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Play a tournament between policies.')
+    parser.add_argument('entrants', nargs='+', help='policy specs, e.g. heuristic or "heuristic:threshold=3"')
+    parser.add_argument('--games', type=int, default=100)
+    parser.add_argument('--players', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--max-turns', type=int, default=500)
+    args = parser.parse_args(argv)
+    result = run(args.entrants, args.games, args.players, args.seed, args.processes, args.max_turns)
+    print '%-40s %6s %6s %8s %8s' % ('entrant', 'games', 'wins', 'win rate', 'elo')
+    for entrant, s in sorted(result['entrants'].items(), key=lambda item: -item[1]['elo']):
+        print '%-40s %6d %6d %8.3f %8.1f' % (entrant, s['games'], s['wins'], s['win_rate'], s['elo'])
+    print '%d games (%d draws, %d turns) in %.1fs: %.2f games/sec' % (args.games, result['draws'], result['turns'],
+                                                                     result['seconds'],
+                                                                     result['games_per_second'])
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
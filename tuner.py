@@ -0,0 +1,221 @@
+"""
+    Tunes the ai.py heuristics' parameters by self-play, with successive halving over a pool of worker processes.
+
+        python tuner.py --candidates 27 --max-games 8000 --checkpoint tune.json
+
+    Candidates are drawn from SPACE, the attack threshold and risk decay HeuristicPolicy takes, plus the
+    defaults as they stand. Each plays games against `--opponents` (policy specs as in tournament.py) and scores
+    1 for a win, 0 for a loss, and its share of the map for a game still undecided after --max-turns, which
+    ranks candidates from far fewer and shorter games than wins alone would. Every candidate in a round plays
+    the same seeds, so they are compared on the same deals and dice.
+
+    Round 0 gives every candidate the same number of games; each later round keeps the best 1/ETA of them by
+    mean score and gives each ETA times as many games in total, so every round costs about the same and most
+    games go to the candidates still in contention. The games per candidate in round 0 are set so the whole run
+    stays within --max-games.
+
+    Results are written to --checkpoint every CHECKPOINT_EVERY games and at the end of every round. Running
+    again with the same checkpoint resumes where it stopped: the schedule is rebuilt from the seed it kept,
+    and games already played are not played again.
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import signal
+import argparse
+import multiprocessing
+from ai import ATTACK_THRESHOLD, RISK_DECAY
+from tournament import make_policy, BOARD_PATH
+from risk.template import board_template
+from risk.game import Game
+
+SPACE = {'threshold': (1.0, 15.0), 'decay': (0.1, 0.9)}
+DEFAULTS = {'threshold': float(ATTACK_THRESHOLD), 'decay': RISK_DECAY}
+ETA = 3
+CHECKPOINT_EVERY = 50
+# seconds to wait for a game's result; long enough for any game to finish
+RESULT_TIMEOUT = 24 * 3600
+
+
+def candidate_spec(base, params):
+    """
+        The policy spec for base, a spec such as "heuristic:blitz=True", with params added as keyword arguments.
+    """
+    args = ','.join('%s=%r' % (key, value) for key, value in sorted(params.items()))
+    return base + (',' if ':' in base else ':') + args
+
+
+def sample_candidates(n, seed):
+    """
+        The defaults and n - 1 points drawn uniformly from SPACE, rounded to 3 decimals.
+    """
+    rng = random.Random(seed)
+    candidates = [dict(DEFAULTS)]
+    while len(candidates) < n:
+        candidates.append(dict((key, round(rng.uniform(low, high), 3)) for key, (low, high) in sorted(SPACE.items())))
+    return candidates
+
+
+def game_seed(seed, game):
+    return random.Random(seed * 1000003 + game).getrandbits(32)
+
+
+def play_scored(args):
+    """
+        Plays one game with the candidate in seat 0 and returns its score, as the module docstring defines it.
+
+    :param args: (candidate spec, opponent specs, game seed, max turns)
+    :return:
+    """
+    spec, opponents, seed, max_turns = args
+    policies = dict(('%d' % i, make_policy(s)) for i, s in enumerate([spec] + list(opponents)))
+    game = Game(board_template(BOARD_PATH), policies, seed, max_turns)
+    winner = game.play()
+    if winner is not None:
+        return float(winner.name == '0')
+    me = next(player for player in game.players if player.name == '0')
+    return float(len(me.countries)) / len(game.board.countries)
+
+
+def rounds(candidates, max_games, eta=ETA):
+    """
+        The number of rounds and the games per candidate in round 0 that keep the run within max_games.
+    """
+    count = int(math.floor(math.log(candidates, eta) + 1e-9)) + 1
+    return count, max(1, max_games // (count * candidates))
+
+
+class Tuning(object):
+    """
+        A tuning run's state: its settings, the candidates, the round reached, the candidates still in it, and
+        every score so far as {candidate index: [score of game 0, 1, ...]}. Saved to and loaded from JSON.
+    """
+
+    def __init__(self, settings, candidates):
+        self.settings = settings
+        self.candidates = candidates
+        self.round = 0
+        self.alive = range(len(candidates))
+        self.scores = dict((i, []) for i in range(len(candidates)))
+
+    def to_json(self):
+        return {'settings': self.settings, 'candidates': self.candidates, 'round': self.round,
+                'alive': self.alive, 'scores': dict((str(i), s) for i, s in self.scores.items())}
+
+    @classmethod
+    def from_json(cls, data):
+        tuning = cls(data['settings'], data['candidates'])
+        tuning.round = data['round']
+        tuning.alive = data['alive']
+        tuning.scores = dict((int(i), s) for i, s in data['scores'].items())
+        return tuning
+
+    def save(self, path):
+        if path is None:
+            return
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.to_json(), f)
+        os.rename(path + '.tmp', path)
+
+    def mean(self, i):
+        scores = self.scores[i]
+        return sum(scores) / len(scores) if scores else 0.0
+
+    def stderr(self, i):
+        scores = self.scores[i]
+        if len(scores) < 2:
+            return float('inf')
+        mean = self.mean(i)
+        return (sum((s - mean) ** 2 for s in scores) / (len(scores) - 1) / len(scores)) ** 0.5
+
+    def ranked(self, indices):
+        return sorted(indices, key=lambda i: (-self.mean(i), i))
+
+
+def tune(candidates=27, max_games=8000, opponents=('heuristic:blitz=True',) * 2, base='heuristic:blitz=True',
+         seed=0, processes=None, max_turns=150, checkpoint=None, log=sys.stdout):
+    """
+        Runs, or resumes from checkpoint, a successive halving search and returns the Tuning, whose alive list
+        is ranked best first when it is done.
+
+    :param candidates: how many parameter sets to start with
+    :param max_games: the cap on games played in the whole run
+    :param opponents: policy specs for the other seats
+    :param base: the policy spec the parameters are added to
+    :param seed:
+    :param processes: worker processes, one per core by default
+    :param max_turns: turns after which a game is scored by map share
+    :param checkpoint: a JSON file to save progress to and resume from
+    :param log: where progress is written
+    :return:
+    """
+    if checkpoint is not None and os.path.exists(checkpoint):
+        with open(checkpoint) as f:
+            tuning = Tuning.from_json(json.load(f))
+        log.write('resuming round %d from %s\n' % (tuning.round, checkpoint))
+    else:
+        settings = {'max_games': max_games, 'opponents': list(opponents), 'base': base, 'seed': seed,
+                    'max_turns': max_turns}
+        tuning = Tuning(settings, sample_candidates(candidates, seed))
+    settings = tuning.settings
+    count, first = rounds(len(tuning.candidates), settings['max_games'])
+    for spec in set(settings['opponents'] + [settings['base']]):
+        make_policy(spec)
+    # workers leave interrupts to the parent, which stops them once the last result is saved
+    pool = multiprocessing.Pool(processes, signal.signal, (signal.SIGINT, signal.SIG_IGN))
+    try:
+        while tuning.round < count:
+            games = first * ETA ** tuning.round
+            jobs = [(i, g) for i in tuning.alive for g in range(len(tuning.scores[i]), games)]
+            start = time.time()
+            args = [(candidate_spec(settings['base'], tuning.candidates[i]), settings['opponents'],
+                     game_seed(settings['seed'], g), settings['max_turns']) for i, g in jobs]
+            results = pool.imap(play_scored, args)
+            for n, (i, g) in enumerate(jobs, 1):
+                # waiting with a timeout, as a wait without one cannot be interrupted in Python 2
+                tuning.scores[i].append(results.next(RESULT_TIMEOUT))
+                if n % CHECKPOINT_EVERY == 0:
+                    tuning.save(checkpoint)
+            ranked = tuning.ranked(tuning.alive)
+            log.write('round %d: %d candidates x %d games in %.0fs, best %s at %.3f +- %.3f\n' %
+                      (tuning.round, len(tuning.alive), games, time.time() - start,
+                       tuning.candidates[ranked[0]], tuning.mean(ranked[0]), tuning.stderr(ranked[0])))
+            tuning.round += 1
+            tuning.alive = ranked if tuning.round == count else ranked[:max(1, len(ranked) // ETA)]
+            tuning.save(checkpoint)
+    except KeyboardInterrupt:
+        tuning.save(checkpoint)
+        log.write('interrupted in round %d; progress saved to %s\n' % (tuning.round, checkpoint))
+        raise
+    finally:
+        pool.terminate()
+        pool.join()
+    return tuning
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Tune the heuristics by successive halving over self-play.')
+    parser.add_argument('--candidates', type=int, default=27)
+    parser.add_argument('--max-games', type=int, default=8000)
+    parser.add_argument('--opponents', nargs='+', default=['heuristic:blitz=True'] * 2)
+    parser.add_argument('--base', default='heuristic:blitz=True')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--max-turns', type=int, default=150)
+    parser.add_argument('--checkpoint', default=None)
+    args = parser.parse_args(argv)
+    tuning = tune(args.candidates, args.max_games, args.opponents, args.base, args.seed, args.processes,
+                  args.max_turns, args.checkpoint)
+    print '%-40s %6s %7s %7s' % ('parameters', 'games', 'score', 'stderr')
+    # the finalists first, then the rest by how far they got
+    for i in sorted(tuning.scores, key=lambda i: (-len(tuning.scores[i]), -tuning.mean(i), i)):
+        if tuning.scores[i]:
+            print '%-40s %6d %7.3f %7.3f' % (candidate_spec('', tuning.candidates[i])[1:], len(tuning.scores[i]),
+                                             tuning.mean(i), tuning.stderr(i))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,191 @@
+"""
+    Whole-turn plans, so that most /turn requests of a turn are answered from a plan made on its first.
+
+    When the deploy request comes in, the attacks for the rest of the turn are planned as well, on the board as
+    it will be after the deployment, and kept by (game id, player name). Each attack request is then served from
+    the plan: steps whose target has already been taken are skipped, and the plan is only made again when the
+    dice have gone against it, i.e. the next planned base can no longer attack or the battle under way has lost
+    more than half of the win probability it started with, or when the plan runs out before the planner meant
+    to stop. When the attack phase ends the reinforcement is chosen for the final board, along with that board's
+    Zobrist hash, and served by the reinforce request if the board still hashes the same.
+
+    A plan only serves the request that follows the one it last answered in the same turn. It keeps the Zobrist
+    hash of the board it expects next, leaving out the two countries of the attack it last gave, whose troops
+    the dice decide. A plan left from an earlier turn, or one that missed a request answered by another worker
+    process, does not match the board and is made again.
+
+    Payloads without a game id cannot tell one game from another, so their key is None: nothing is kept for
+    them, and each attack request makes a plan of its own.
+"""
+from ai import reinforce, zobrist_keys
+from planner import plan_attacks, ATTACK_BUDGET
+from risk import battle
+from risk.cache import LRUCache
+
+PLAN_LIMIT = 64
+REPLAN_ODDS_RATIO = 0.5
+
+PLANS = LRUCache(PLAN_LIMIT)
+
+
+def plan_key(game, player):
+    """
+        The key of player's plans in the game JSON game, or None if the game has no id.
+    """
+    game_id = game.get('id')
+    return (game_id, player.name) if game_id is not None else None
+
+
+class TurnPlan(object):
+    """
+        The rest of a player's turn: attacks still to make, as (base, target) country names, the win
+        probability the first of them started with once it is under way, whether the attack phase ends after
+        them, and once it has ended the chosen reinforcement with the hash of the board it was chosen for.
+        position is the hash of the board the next request should show, as position() gives it leaving out the
+        countries named in last_attack, the attack last served.
+    """
+    __slots__ = ('attacks', 'odds', 'finished', 'reinforcement', 'board_hash', 'position', 'last_attack')
+
+    def __init__(self, attacks, finished):
+        self.attacks = attacks
+        self.odds = None
+        self.finished = finished
+        self.reinforcement = None
+        self.board_hash = None
+        self.position = None
+        self.last_attack = ()
+
+
+def position(G, board, skip=(), deploy=None):
+    """
+        The Zobrist hash of board, leaving out the countries named in skip, once deploy ({country name: troops})
+        is added to it if given.
+
+    :param G:
+    :param board:
+    :param skip:
+    :param deploy:
+    :return:
+    """
+    keys = zobrist_keys(G)
+    h = board.zobrist_hash(keys)
+    for name, troops in (deploy or {}).items():
+        country = board.countries[name]
+        h = keys.update(h, keys.index[name], country.owner.name, country.troops, country.owner.name,
+                        country.troops + int(troops))
+    for name in skip:
+        country = board.countries[name]
+        h ^= keys.key(keys.index[name], country.owner.name if country.owner else None, country.troops)
+    return h
+
+
+def plan_turn(template, player, board, key, deploy=None, budget=ATTACK_BUDGET):
+    """
+        Plans the player's attacks, after deploying `deploy` ({country name: troops}) if given, and keeps the
+        plan under key.
+
+    :param template: the BoardTemplate board was made from
+    :param player:
+    :param board:
+    :param key:
+    :param deploy:
+    :param budget:
+    :return: the new TurnPlan
+    """
+    plan = TurnPlan(*plan_attacks(template, player, board, budget, deploy=deploy))
+    plan.position = position(template.graph, board, deploy=deploy)
+    if key is not None:
+        PLANS.put(key, plan)
+    return plan
+
+
+def next_attack(template, player, board, key):
+    """
+        The attack to make next as a (base, target) pair of board countries, or None to end the attack phase,
+        following the plan kept under key and planning again if there is none, it was made for another turn or
+        another request, or the dice have diverged from it. A request plans at most once, so it answers within
+        one planning budget: should a fresh plan's first attack not be open either, the attack phase ends.
+
+    :param template:
+    :param player:
+    :param board:
+    :param key:
+    :return:
+    """
+    plan = PLANS.get(key) if key is not None else None
+    if plan is not None and plan.position != position(template.graph, board, plan.last_attack):
+        plan = None
+    if plan is not None:
+        attack = planned_attack(plan, player, board)
+        if attack is None and (plan.attacks or not plan.finished):
+            plan = None
+    if plan is None:
+        plan = plan_turn(template, player, board, key)
+        attack = planned_attack(plan, player, board)
+    plan.last_attack = (attack[0].name, attack[1].name) if attack is not None else ()
+    plan.position = position(template.graph, board, plan.last_attack)
+    return attack
+
+
+def planned_attack(plan, player, board):
+    """
+        The plan's next attack as a (base, target) pair of board countries, after skipping the attacks whose
+        target the player already holds, or None if the plan has run out or the dice have diverged from it.
+    """
+    while plan.attacks and board.countries[plan.attacks[0][1]].owner == player:
+        plan.attacks.pop(0)
+        plan.odds = None
+    if not plan.attacks:
+        return None
+    base, target = board.countries[plan.attacks[0][0]], board.countries[plan.attacks[0][1]]
+    if base.owner != player or base.troops <= 1:
+        return None
+    odds = battle.win_probabilities(base.troops - 1, target.troops)
+    if plan.odds is None:
+        plan.odds = odds
+    return (base, target) if odds >= REPLAN_ODDS_RATIO * plan.odds else None
+
+
+def end_attacks(G, player, board, key):
+    """
+        Chooses the reinforcement for the board the attack phase ended on and keeps it in the plan under key.
+    """
+    if key is None:
+        return
+    plan = PLANS.get(key)
+    if plan is None:
+        plan = TurnPlan([], True)
+        PLANS.put(key, plan)
+    plan.reinforcement = choose_reinforcement(G, player, board)
+    plan.board_hash = board.zobrist_hash(zobrist_keys(G))
+
+
+def planned_reinforcement(G, player, board, key):
+    """
+        The reinforcement to make, as (origin, destination, troops) or None to end the turn: the one chosen when
+        the attack phase ended if the board has not changed since, otherwise chosen now. The turn's plan is
+        dropped either way.
+
+    :param G:
+    :param player:
+    :param board:
+    :param key:
+    :return:
+    """
+    plan = PLANS.get(key) if key is not None else None
+    PLANS.discard(key)
+    if plan is not None and plan.board_hash == board.zobrist_hash(zobrist_keys(G)):
+        return plan.reinforcement
+    return choose_reinforcement(G, player, board)
+
+
+def choose_reinforcement(G, player, board):
+    """
+        ai.reinforce's choice, or None if no troops are worth moving.
+
+    :param G:
+    :param player:
+    :param board:
+    :return:
+    """
+    return reinforce(G, player, board)